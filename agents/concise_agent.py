@@ -1,9 +1,13 @@
 import os
 import json
+import threading
 from dotenv import load_dotenv
 import sys
 sys.path.append('/home/arka/Desktop/Hackathons/HCLTech_CS671')
 from utils import gemini_wrapper as gw
+from utils.chat_history import ChatHistoryManager
+from utils.extractive_summary import extractive_summary
+from utils.session_state import LRUDict
 
 load_dotenv()
 
@@ -23,31 +27,72 @@ Do NOT mess up the formatting of the code. Use triple backticks for code blocks
 Your output should be 30-50% shorter than the input while preserving all critical information.
 """
 
+# "llm" summarizes with the model; "extractive" picks the most relevant sentences,
+# list items and code blocks locally, without a network call
+SUMMARY_MODES = ["llm", "extractive"]
+
 class ConciseAgent:
-    def __init__(self, model="gemini-2.0-flash", system_prompt=DEFAULT_SYSTEM_PROMPT):
+    def __init__(self, model="gemini-2.0-flash", system_prompt=DEFAULT_SYSTEM_PROMPT, mode="llm", encoder=None,
+                 max_cached_responses=50):
         """
         Initialize the ConciseAgent with the specified model and system prompt.
         
         Args:
             model (str): The Gemini model to use
             system_prompt (str): System prompt that guides the agent's behavior
+            mode (str): One of SUMMARY_MODES
+            encoder: Callable mapping a list of strings to embeddings, required by extractive mode
+            max_cached_responses (int): Capacity of the summary cache (least recently used first out)
         """
+        if mode not in SUMMARY_MODES:
+            raise ValueError(f"Unknown summary mode: {mode}")
         self.model = model
         self.system_prompt = system_prompt
+        self.mode = mode
+        self.encoder = encoder
         self.chat_history = None
-        self.response_cache = {}  # Cache for responses
+        self.response_cache = LRUDict(max_cached_responses)  # Cache for responses
+        # Summaries may be generated on a background thread while the next turn runs;
+        # the lock keeps turns on the shared chat session from interleaving
+        self._lock = threading.Lock()
+        self._cache_lock = threading.Lock()  # Held only for cache reads and writes
+        # Earlier turns resend only the query and summary, not the full detailed response
+        self.history_manager = ChatHistoryManager(stale_markers=("Detailed Response to Summarize:",))
+        gw.prewarm(self.model)
     
     def set_model(self, model):
         """Set a new model and reset chat history."""
         self.model = model
         self.chat_history = None
-        self.response_cache = {}  # Reset cache when model changes
+        self.response_cache.clear()  # Reset cache when model changes
+        gw.prewarm(model)
     
     def set_system_prompt(self, system_prompt):
         """Set a new system prompt and reset chat history."""
         self.system_prompt = system_prompt
         self.chat_history = None
-        self.response_cache = {}  # Reset cache when prompt changes
+        self.response_cache.clear()  # Reset cache when prompt changes
+    
+    def __getstate__(self):
+        # Locks can't be pickled, and the encoder wraps the shared embedding model
+        state = dict(self.__dict__)
+        del state["_lock"]
+        del state["_cache_lock"]
+        state["encoder"] = None
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+    
+    def set_mode(self, mode, encoder=None):
+        """Switch between the LLM and the local extractive summarizer."""
+        if mode not in SUMMARY_MODES:
+            raise ValueError(f"Unknown summary mode: {mode}")
+        self.mode = mode
+        if encoder is not None:
+            self.encoder = encoder
     
     def get_concise_response(self, user_query, detailed_response):
         """
@@ -61,11 +106,18 @@ class ConciseAgent:
             str: A concise version of the response
         """
         # Generate a cache key based on the query and detailed response
-        cache_key = f"{user_query}::{detailed_response[:100]}"
+        cache_key = f"{self.mode}::{user_query}::{detailed_response[:100]}"
         
         # Check if we already have this response cached
-        if cache_key in self.response_cache:
-            return self.response_cache[cache_key]
+        with self._cache_lock:
+            if cache_key in self.response_cache:
+                return self.response_cache[cache_key]
+        
+        if self.mode == "extractive" and self.encoder is not None:
+            response = extractive_summary(user_query, detailed_response, self.encoder)
+            with self._cache_lock:
+                self.response_cache[cache_key] = response
+            return response
         
         prompt = f"""
         Original User Query:
@@ -77,14 +129,18 @@ class ConciseAgent:
         Please provide a concise version of this response that addresses the user's query directly.
         """
         
-        response, self.chat_history = gw.chat_agent(
-            prompt,
-            self.chat_history,
-            self.system_prompt,
-            model=self.model
-        )
-        
-        # Cache the response
-        self.response_cache[cache_key] = response
+        with self._lock:
+            self.history_manager.apply(self.chat_history)
+            response, self.chat_history = gw.chat_agent(
+                prompt,
+                self.chat_history,
+                self.system_prompt,
+                model=self.model,
+                call_site="concise"
+            )
+            
+            # Cache the response
+            with self._cache_lock:
+                self.response_cache[cache_key] = response
         
         return response
@@ -5,6 +5,7 @@ from google import genai
 import sys
 sys.path.append('/home/arka/Desktop/Hackathons/HCLTech_CS671')
 from utils import gemini_wrapper as gw
+from utils.chat_history import ChatHistoryManager
 
 load_dotenv()
 
@@ -28,16 +29,35 @@ When uncertain, state your assumptions clearly.
 Remember previous interactions in the chat to provide context-aware responses.
 """
 
+# Appended to the user message in fused mode, so one call also decides the response style
+# and writes the summary; the system prompt (and its cached prefix) stays unchanged
+FUSED_INSTRUCTIONS = """
+
+Answer the question above and respond ONLY with a JSON object with this format:
+{
+  "response_type": "CONCISE" or "DETAILED",
+  "confidence": 0.0-1.0,
+  "reasoning": "Brief explanation of which response style suits the user better",
+  "detailed": "Your full answer in markdown",
+  "concise": "The same answer 30-50% shorter in markdown, keeping the essential code"
+}
+Choose CONCISE for simple questions and quick fixes, DETAILED for complex or conceptual problems.
+"""
+
 class DebuggerAgent:
     def __init__(self, model="gemini-2.0-flash", system_prompt=DEFAULT_SYSTEM_PROMPT):
         self.model = model
         self.system_prompt = system_prompt
         self.chat_history = None
+        # Earlier turns resend only the question and answer, not their retrieved CONTEXT
+        self.history_manager = ChatHistoryManager(stale_markers=("CONTEXT:",))
+        gw.prewarm(self.model)
         
     def set_model(self, model):
         self.model = model
         # Reset chat history when model changes
         self.chat_history = None
+        gw.prewarm(model)
         
     def set_system_prompt(self, system_prompt):
         self.system_prompt = system_prompt
@@ -45,11 +65,64 @@ class DebuggerAgent:
         self.chat_history = None
         
     def get_response(self, user_message):
+        self.history_manager.apply(self.chat_history)
         response, self.chat_history = gw.chat_agent(
             user_message,
             self.chat_history,
             self.system_prompt,
-            model=self.model
+            model=self.model,
+            call_site="debugger"
         )
         
         return response
+    
+    def get_fused_response(self, user_message):
+        """
+        Generate the detailed answer, its concise version and the response-style decision
+        in a single structured call. Only the detailed answer is kept in the chat history.
+        
+        Returns:
+            dict: response_type, confidence, reasoning, detailed and concise (None if the
+            model returned no usable summary)
+        """
+        self.history_manager.apply(self.chat_history)
+        response, self.chat_history = gw.chat_agent(
+            user_message + FUSED_INSTRUCTIONS,
+            self.chat_history,
+            self.system_prompt,
+            model=self.model,
+            call_site="fused",
+            json_output=True
+        )
+        
+        if not isinstance(response, dict) or not response.get("detailed"):
+            # Unparseable output is still a usable answer
+            response = {"detailed": response if isinstance(response, str) else json.dumps(response)}
+        
+        response_type = str(response.get("response_type", "DETAILED")).upper()
+        result = {
+            "response_type": response_type if response_type in ("CONCISE", "DETAILED") else "DETAILED",
+            "confidence": response.get("confidence", 0.5),
+            "reasoning": response.get("reasoning", "No reasoning provided."),
+            "detailed": response["detailed"],
+            "concise": response.get("concise") or None
+        }
+        
+        # Later turns should see the answer, not the JSON envelope or the instructions
+        self.chat_history.history[-2]["content"] = user_message
+        self.chat_history.history[-1]["content"] = result["detailed"]
+        return result
+    
+    def stream_response(self, user_message):
+        """Yield the response text as it is generated; the turn is added to the chat once the stream completes."""
+        if self.chat_history is None:
+            self.chat_history = gw.create_chat(self.system_prompt, model=self.model)
+        self.history_manager.apply(self.chat_history)
+        
+        yield from gw.stream_chat_agent(
+            user_message,
+            self.chat_history,
+            self.system_prompt,
+            model=self.model,
+            call_site="debugger"
+        )
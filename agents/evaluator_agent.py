@@ -1,5 +1,6 @@
 import os
 import json
+import concurrent.futures
 from dotenv import load_dotenv
 import sys
 sys.path.append('/home/arka/Desktop/Hackathons/HCLTech_CS671')
@@ -72,7 +73,7 @@ def evaluate_response(user_query, assistant_response, system_prompt=DEFAULT_SYST
     Provide your evaluation as a JSON with the structure described in your instructions.
     """
     
-    evaluation = gw.universal_agent(evaluation_prompt, system_prompt, model=model)
+    evaluation = gw.universal_agent(evaluation_prompt, system_prompt, model=model, priority=gw.PRIORITY_BACKGROUND, call_site="evaluator")
     
     try:
         if isinstance(evaluation, str):
@@ -109,3 +110,47 @@ def evaluate_response(user_query, assistant_response, system_prompt=DEFAULT_SYST
             default_eval["ragas_metrics"] = ragas_metrics
             
         return default_eval
+
+
+class BackgroundEvaluator:
+    """
+    Runs evaluate_response (including the RAGAS chain) on a worker pool, so scoring a
+    response never delays showing it. submit() returns a Future resolving to the
+    evaluation dict; on_done runs on the worker once the evaluation is ready.
+    """
+
+    def __init__(self, max_workers=2):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="evaluator")
+        self.stats = {"submitted": 0, "completed": 0, "errors": 0}
+
+    def _run(self, on_done, *args, **kwargs):
+        try:
+            evaluation = evaluate_response(*args, **kwargs)
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"Background evaluation failed: {e}")
+            raise
+        if on_done:
+            try:
+                on_done(evaluation)
+            except Exception as e:
+                print(f"Evaluation callback failed: {e}")
+        self.stats["completed"] += 1
+        return evaluation
+
+    def submit(self, user_query, assistant_response, system_prompt=DEFAULT_SYSTEM_PROMPT, model="gemini-2.0-flash", context=None, on_done=None):
+        """
+        Queue an evaluation; arguments are those of evaluate_response.
+
+        Args:
+            on_done: Optional callable receiving the evaluation dict on the worker thread
+                (e.g. to decide on self-memory); it must not touch Streamlit state
+
+        Returns:
+            concurrent.futures.Future resolving to the evaluation dict
+        """
+        self.stats["submitted"] += 1
+        return self._executor.submit(
+            self._run, on_done, user_query, assistant_response,
+            system_prompt=system_prompt, model=model, context=context
+        )
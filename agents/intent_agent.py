@@ -4,6 +4,8 @@ from dotenv import load_dotenv
 import sys
 sys.path.append('/home/arka/Desktop/Hackathons/HCLTech_CS671')
 from utils import gemini_wrapper as gw
+from agents.intent_classifier import IntentLog
+from utils.intent_cache import SemanticIntentCache, intent_fingerprint
 
 load_dotenv()
 
@@ -30,44 +32,77 @@ If you're uncertain, default to "DETAILED" as it's better to provide too much in
 """
 
 class IntentAgent:
-    def __init__(self, model="gemini-2.0-flash", system_prompt=DEFAULT_SYSTEM_PROMPT):
+    def __init__(self, model="gemini-2.0-flash", system_prompt=DEFAULT_SYSTEM_PROMPT, classifier=None, intent_log=None, cache=None):
         """
         Initialize the IntentAgent for determining appropriate response type.
         
         Args:
             model (str): The Gemini model to use
             system_prompt (str): System prompt that guides the agent's behavior
+            classifier: Optional IntentClassifier tried before the LLM
+            intent_log: Optional IntentLog that LLM decisions are appended to as training data
+            cache: Optional SemanticIntentCache shared with other agents; defaults to a private one
         """
         self.model = model
         self.system_prompt = system_prompt
-        self.response_cache = {}  # Cache for responses
+        self.classifier = classifier
+        self.intent_log = intent_log if intent_log is not None else IntentLog()
+        self.response_cache = cache if cache is not None else SemanticIntentCache()
+        self.stats = {"classifier": 0, "llm": 0}
+    
+    def __getstate__(self):
+        # The cache is shared between sessions and the classifier is reloaded every turn,
+        # so neither is saved with a spilled session
+        state = dict(self.__dict__)
+        state["response_cache"] = None
+        state["classifier"] = None
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.response_cache = SemanticIntentCache()
+    
+    def set_classifier(self, classifier):
+        """Use a (re)trained local classifier; None routes every query to the LLM."""
+        self.classifier = classifier
     
     def set_model(self, model):
-        """Set a new model and reset cache."""
+        """Set a new model; cached decisions made with the old one no longer match."""
         self.model = model
-        self.response_cache = {}  # Reset cache when model changes
     
     def set_system_prompt(self, system_prompt):
-        """Set a new system prompt and reset cache."""
+        """Set a new system prompt; cached decisions made with the old one no longer match."""
         self.system_prompt = system_prompt
-        self.response_cache = {}  # Reset cache when prompt changes
     
-    def determine_response_type(self, query):
+    def set_cache(self, cache):
+        """Share a SemanticIntentCache with other agents."""
+        self.response_cache = cache
+    
+    def determine_response_type(self, query, embedding=None):
         """
         Analyze the user query and determine whether it needs a concise or detailed response.
+        The local classifier answers when it is confident; otherwise the LLM decides.
         
         Args:
             query (str): The user's question or request
+            embedding: Optional MiniLM embedding of the query, required by the local classifier
             
         Returns:
             dict: Contains response_type ("CONCISE" or "DETAILED"), confidence score, and reasoning
         """
-        # Generate a cache key based on the query
-        cache_key = query[:100]  # Use first 100 chars as cache key
+        # Decisions are scoped to the model and prompt that made them
+        fingerprint = intent_fingerprint(self.model, self.system_prompt)
+        
+        # Reuse an earlier decision for the same or a near-identical query
+        cached = self.response_cache.get(fingerprint, query, embedding)
+        if cached is not None:
+            return cached
         
-        # Check if we already have this response cached
-        if cache_key in self.response_cache:
-            return self.response_cache[cache_key]
+        if self.classifier is not None and embedding is not None:
+            prediction = self.classifier.predict(embedding)
+            if prediction is not None:
+                self.stats["classifier"] += 1
+                return prediction
         
         # Create the prompt for intent analysis
         prompt = f"""
@@ -84,7 +119,8 @@ class IntentAgent:
         response = gw.universal_agent(
             prompt,
             self.system_prompt,
-            model=self.model
+            model=self.model,
+            call_site="intent"
         )
         
         # Handle different response types
@@ -117,6 +153,13 @@ class IntentAgent:
             parsed_response["response_type"] = "DETAILED"
         
         # Cache the response
-        self.response_cache[cache_key] = parsed_response
+        self.response_cache.put(fingerprint, query, parsed_response, embedding)
+        self.stats["llm"] += 1
+        
+        # Log the decision as training data for the local classifier
+        try:
+            self.intent_log.add(query, parsed_response["response_type"], "llm", parsed_response["confidence"])
+        except OSError as e:
+            print(f"Could not log intent decision: {e}")
         
         return parsed_response
@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import threading
+import numpy as np
+
+LABELS = ["CONCISE", "DETAILED"]
+
+# Logged decisions, one JSON object per line: query, label, source, confidence, ts
+INTENT_LOG = os.environ.get(
+    "MATBOT_INTENT_LOG",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "intent_log.jsonl")
+)
+INTENT_MODEL = os.environ.get(
+    "MATBOT_INTENT_MODEL",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "intent_classifier.pkl")
+)
+
+
+class IntentLog:
+    """
+    Append-only JSONL log of response-type decisions, used as training data.
+
+    Sources are "llm" (the intent agent's decision) and "feedback" (the user asked for the
+    other version of an answer). Feedback outranks the LLM label when both exist for a query.
+    """
+
+    def __init__(self, path=INTENT_LOG):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def add(self, query, label, source, confidence=None):
+        entry = {
+            "query": query,
+            "label": label,
+            "source": source,
+            "confidence": confidence,
+            "ts": time.time()
+        }
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def examples(self):
+        """
+        Returns:
+            list: (query, label) pairs, one per distinct query; the latest feedback label
+            wins, otherwise the latest LLM label
+        """
+        if not os.path.exists(self.path):
+            return []
+
+        llm_labels, feedback_labels = {}, {}
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry.get("label") not in LABELS:
+                    continue
+                target = feedback_labels if entry.get("source") == "feedback" else llm_labels
+                target[entry["query"]] = entry["label"]
+
+        labels = dict(llm_labels, **feedback_labels)
+        return list(labels.items())
+
+
+class IntentClassifier:
+    """
+    Logistic regression over MiniLM query embeddings that predicts CONCISE or DETAILED.
+
+    Routing with it costs one dot product on an embedding retrieval already computed.
+    predict() returns None below the confidence threshold, so the caller can fall back
+    to the LLM for queries the classifier is unsure about.
+    """
+
+    def __init__(self, threshold=None, C=1.0):
+        """
+        Args:
+            threshold: Minimum predicted probability to trust; defaults to MATBOT_INTENT_THRESHOLD
+            C: Inverse regularization strength of the logistic regression
+        """
+        self.threshold = threshold if threshold is not None else float(os.environ.get("MATBOT_INTENT_THRESHOLD", 0.8))
+        self.C = C
+        self.weights = None
+        self.bias = 0.0
+        self.trained_on = 0
+
+    @property
+    def is_trained(self):
+        return self.weights is not None
+
+    def fit(self, embeddings, labels):
+        from sklearn.linear_model import LogisticRegression
+
+        y = np.array([LABELS.index(label) for label in labels])
+        model = LogisticRegression(C=self.C, class_weight="balanced", max_iter=1000)
+        model.fit(np.asarray(embeddings, dtype=np.float32), y)
+        # Keep only the coefficients; prediction is a dot product and a sigmoid
+        self.weights = model.coef_[0].astype(np.float32)
+        self.bias = float(model.intercept_[0])
+        self.trained_on = len(labels)
+        return self
+
+    def predict_proba(self, embeddings):
+        """Probability of DETAILED for each row of embeddings."""
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        return 1.0 / (1.0 + np.exp(-(embeddings @ self.weights + self.bias)))
+
+    def predict(self, embedding):
+        """
+        Returns:
+            dict: response_type, confidence and reasoning, or None if untrained or
+            the prediction is below the threshold
+        """
+        if not self.is_trained:
+            return None
+        p_detailed = float(self.predict_proba(embedding)[0])
+        label = "DETAILED" if p_detailed >= 0.5 else "CONCISE"
+        confidence = max(p_detailed, 1.0 - p_detailed)
+        if confidence < self.threshold:
+            return None
+        return {
+            "response_type": label,
+            "confidence": confidence,
+            "reasoning": f"Local intent classifier ({self.trained_on} training examples)"
+        }
+
+    def save(self, path=INTENT_MODEL):
+        with open(path, "wb") as f:
+            pickle.dump({"weights": self.weights, "bias": self.bias, "trained_on": self.trained_on, "C": self.C}, f)
+
+    @classmethod
+    def load(cls, path=INTENT_MODEL, threshold=None):
+        """
+        Returns:
+            IntentClassifier: The saved classifier, or None if no model file exists
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        classifier = cls(threshold=threshold, C=state["C"])
+        classifier.weights = state["weights"]
+        classifier.bias = state["bias"]
+        classifier.trained_on = state["trained_on"]
+        return classifier
+
+
+def evaluate(embeddings, labels, threshold, folds=5, C=1.0):
+    """
+    Cross-validated accuracy of the classifier, overall and on the predictions it is
+    confident enough to make (the rest go to the LLM).
+
+    Returns:
+        dict: examples, evaluated (examples in the folds that could be run), accuracy,
+        coverage (share of queries routed locally) and confident_accuracy
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    labels = np.array(labels)
+    order = np.random.RandomState(42).permutation(len(labels))
+    correct = confident = confident_correct = evaluated = 0
+
+    for fold in range(folds):
+        test = order[fold::folds]
+        train = np.setdiff1d(order, test)
+        if len(set(labels[train])) < 2:
+            continue
+        classifier = IntentClassifier(threshold=threshold, C=C).fit(embeddings[train], labels[train])
+        p_detailed = classifier.predict_proba(embeddings[test])
+        predicted = np.where(p_detailed >= 0.5, "DETAILED", "CONCISE")
+        is_confident = np.maximum(p_detailed, 1.0 - p_detailed) >= threshold
+        hits = predicted == labels[test]
+        evaluated += len(test)
+        correct += int(hits.sum())
+        confident += int(is_confident.sum())
+        confident_correct += int((hits & is_confident).sum())
+
+    # Folds whose training split lacks a label are skipped and don't count
+    return {
+        "examples": len(labels),
+        "evaluated": evaluated,
+        "accuracy": correct / evaluated if evaluated else 0.0,
+        "coverage": confident / evaluated if evaluated else 0.0,
+        "confident_accuracy": confident_correct / confident if confident else 0.0
+    }
+
+
+def train(log_path=INTENT_LOG, model_path=INTENT_MODEL, threshold=None, min_examples=20,
+          embedding_model="all-MiniLM-L6-v2"):
+    """
+    Retrain the classifier from the intent log, print a cross-validated accuracy report
+    and save the model.
+    """
+    examples = IntentLog(log_path).examples()
+    counts = {label: sum(1 for _, l in examples if l == label) for label in LABELS}
+    print(f"{len(examples)} labelled queries in {log_path}: {counts}")
+    if len(examples) < min_examples or min(counts.values()) == 0:
+        print(f"Need at least {min_examples} queries covering both labels; model not trained.")
+        return None
+
+    from sentence_transformers import SentenceTransformer
+
+    queries = [query for query, _ in examples]
+    labels = [label for _, label in examples]
+    embeddings = SentenceTransformer(embedding_model).encode(queries, show_progress_bar=False).astype(np.float32)
+
+    classifier = IntentClassifier(threshold=threshold)
+    report = evaluate(embeddings, labels, classifier.threshold, C=classifier.C)
+    print(f"5-fold accuracy:            {report['accuracy']:.3f}")
+    print(f"Routed locally at p>={classifier.threshold:.2f}: {report['coverage']:.1%} of queries")
+    print(f"Accuracy on those:          {report['confident_accuracy']:.3f}")
+
+    classifier.fit(embeddings, labels).save(model_path)
+    print(f"Saved classifier to {model_path}")
+    return report
+
+
+if __name__ == "__main__":
+    # Usage: python -m agents.intent_classifier train [--log intent_log.jsonl] [--model intent_classifier.pkl]
+    parser = argparse.ArgumentParser(description="Train the local intent classifier from logged decisions")
+    parser.add_argument("command", choices=["train"])
+    parser.add_argument("--log", default=INTENT_LOG)
+    parser.add_argument("--model", default=INTENT_MODEL)
+    parser.add_argument("--threshold", type=float, default=None)
+    parser.add_argument("--min-examples", type=int, default=20)
+    args = parser.parse_args()
+    report = train(args.log, args.model, threshold=args.threshold, min_examples=args.min_examples)
+    sys.exit(0 if report else 1)
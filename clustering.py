@@ -3,14 +3,32 @@ from sentence_transformers import SentenceTransformer
 import numpy as np
 import faiss
 import json
+import time
+import threading
+from collections import OrderedDict
+from utils.memory_store import SQLiteMemoryStore
+
+# Text embedded for a self-memory record, selected by RAGClusterer.memory_embedding_key.
+# Memories are looked up with the bare user query, so embedding the query (optionally with
+# the heading of the source it was answered from) matches far better than the full
+# query+context+output string, which MiniLM truncates at 256 tokens anyway.
+MEMORY_EMBEDDING_KEYS = {
+    'query': lambda query, context, output, heading: query,
+    'query_heading': lambda query, context, output, heading: f"{query}. {heading}" if heading else query,
+    'full': lambda query, context, output, heading: f"{query} {context} {output}",
+}
+
 
 class RAGClusterer:
-    def __init__(self, n_clusters, embedding_model='all-MiniLM-L6-v2', num_closest_clusters=1):
+    def __init__(self, n_clusters, embedding_model='all-MiniLM-L6-v2', num_closest_clusters=1, memory_embedding_key='query'):
         """
         n_clusters: Number of clusters to create.
         embedding_model: SentenceTransformer model.
         num_closest_clusters: Default number of closest clusters to fetch (can override later).
+        memory_embedding_key: Which text to embed for self-memory records (see MEMORY_EMBEDDING_KEYS).
         """
+        if memory_embedding_key not in MEMORY_EMBEDDING_KEYS:
+            raise ValueError(f"Unknown memory_embedding_key: {memory_embedding_key}")
         self.n_clusters = n_clusters
         self.num_closest_clusters = num_closest_clusters
         self.model = SentenceTransformer(embedding_model)
@@ -20,6 +38,22 @@ class RAGClusterer:
         self.cluster_index = None
         self.chunk_store = []  # List of chunks with metadata and embeddings
         self.self_memory_store = []  # List of self-memory dicts for previous interactions
+        self.self_memory_index = None  # Incremental ANN index over self_memory_store embeddings
+        self.memory_store = None  # Optional shared SQLiteMemoryStore backend
+        self.memory_refresh_interval = 2.0  # Seconds between incremental refreshes from the store
+        self.memory_embedding_key = memory_embedding_key
+        self.self_memory_min_score = 0.9  # Only responses scoring above this are remembered
+        # With query-only embedding keys a memory is found by query-to-query distance, which
+        # can't be compared with query-to-chunk distances; it is used when within this
+        # squared L2 distance (about cosine similarity 0.85 for normalized MiniLM embeddings)
+        self.self_memory_max_distance = 0.3
+        self._memory_last_version = 0
+        self._memory_last_refresh = 0.0
+        self._memory_positions = {}  # Store row id -> index in self_memory_store
+        self._memory_lock = threading.RLock()
+        self.query_cache_size = 1024  # Query embeddings kept by encode_query()
+        self._query_cache = OrderedDict()
+        self._query_cache_lock = threading.Lock()
 
     def fit(self, data_list):
         """
@@ -104,6 +138,28 @@ class RAGClusterer:
             raise ValueError("Run fit() first.")
         return self.cluster_centroids
 
+    def encode_query(self, query):
+        """
+        Embed a query, reusing recent embeddings from an LRU cache.
+        One turn embeds the same query for the answer cache, cluster, chunk and self-memory
+        search and intent routing; only the first of these pays for the encoder.
+
+        Returns:
+            np.ndarray: float32 array of shape (1, dim)
+        """
+        with self._query_cache_lock:
+            emb = self._query_cache.get(query)
+            if emb is not None:
+                self._query_cache.move_to_end(query)
+                return emb
+
+        emb = self.model.encode([query], show_progress_bar=False).astype(np.float32)
+        with self._query_cache_lock:
+            self._query_cache[query] = emb
+            while len(self._query_cache) > self.query_cache_size:
+                self._query_cache.popitem(last=False)
+        return emb
+
     def find_closest_clusters(self, query, top_x=None):
         """
         Search closest clusters by their centroid embeddings.
@@ -116,7 +172,7 @@ class RAGClusterer:
         if top_x is None:
             top_x = self.num_closest_clusters
 
-        query_emb = self.model.encode([query], show_progress_bar=False).astype(np.float32)
+        query_emb = self.encode_query(query)
         distances, indices = self.cluster_index.search(query_emb, top_x)
         return [(int(indices[0][i]), distances[0][i]) for i in range(top_x)]
 
@@ -134,7 +190,7 @@ class RAGClusterer:
         temp_index = faiss.IndexFlatL2(dim)
         temp_index.add(chunk_embs)
 
-        query_emb = self.model.encode([query], show_progress_bar=False).astype(np.float32)
+        query_emb = self.encode_query(query)
         distances, indices = temp_index.search(query_emb, top_y)
 
         results = []
@@ -150,7 +206,126 @@ class RAGClusterer:
             })
         return results
 
-    def add_to_self_memory(self, query, context, output, score):
+    def _index_self_memory(self, records):
+        """
+        Append memory records to the in-process store and the ANN index.
+        Must be called with self._memory_lock held.
+        """
+        if not records:
+            return
+        embs = np.array([m['embedding'] for m in records]).astype(np.float32)
+        if self.self_memory_index is None:
+            self.self_memory_index = faiss.IndexHNSWFlat(embs.shape[1], 32)
+            self.self_memory_index.hnsw.efSearch = 64
+        self.self_memory_index.add(embs)
+        for m in records:
+            if 'id' in m:
+                self._memory_positions[m['id']] = len(self.self_memory_store)
+            self.self_memory_store.append(m)
+
+    def _apply_memory_updates(self, records):
+        """
+        Replace indexed records whose embedding changed in the store (re-embedded by this
+        or another replica). HNSW can't update vectors in place, so the index is rebuilt.
+        Must be called with self._memory_lock held.
+
+        Returns:
+            list: The records that aren't indexed yet
+        """
+        fresh, changed = [], False
+        for m in records:
+            pos = self._memory_positions.get(m['id'])
+            if pos is None:
+                fresh.append(m)
+            elif not np.array_equal(self.self_memory_store[pos]['embedding'], m['embedding']):
+                self.self_memory_store[pos] = m
+                changed = True
+        if changed:
+            indexed = self.self_memory_store
+            self.self_memory_store, self.self_memory_index, self._memory_positions = [], None, {}
+            self._index_self_memory(indexed)
+        return fresh
+
+    def _reembed_stale(self, records):
+        """
+        Re-embed records whose embedding was built from another text than the current
+        memory_embedding_key (legacy rows and imports have none), in place and in one batch,
+        so the index never mixes embedding spaces.
+
+        Returns:
+            list: (row id, embedding) for the re-embedded records that have a store id
+        """
+        stale = [m for m in records if m.get('embedding_key') != self.memory_embedding_key]
+        if not stale:
+            return []
+        key_fn = MEMORY_EMBEDDING_KEYS[self.memory_embedding_key]
+        texts = [key_fn(m['query'], m.get('context') or '', m['output'], m.get('heading')) for m in stale]
+        embeddings = self.model.encode(texts, show_progress_bar=False).astype(np.float32)
+        for m, embedding in zip(stale, embeddings):
+            m['embedding'] = embedding
+            m['embedding_key'] = self.memory_embedding_key
+        return [(m['id'], m['embedding']) for m in stale if 'id' in m]
+
+    def _reset_self_memory(self):
+        self.self_memory_store = []
+        self.self_memory_index = None
+        self._memory_positions = {}
+        self._memory_last_version = 0
+        self._memory_last_refresh = 0.0
+
+    def attach_memory_store(self, memory_store, refresh_interval=2.0):
+        """
+        Use a shared SQLiteMemoryStore as the self-memory backend.
+
+        Args:
+            memory_store: SQLiteMemoryStore instance
+            refresh_interval: Minimum seconds between incremental refreshes
+
+        Returns:
+            int: Number of memories loaded
+        """
+        with self._memory_lock:
+            self.memory_store = memory_store
+            self.memory_refresh_interval = refresh_interval
+            self._reset_self_memory()
+        self.refresh_self_memory(force=True)
+        return len(self.self_memory_store)
+
+    def refresh_self_memory(self, force=False):
+        """
+        Pull memories written or re-embedded by any replica since the last refresh.
+        Only rows with a version above the last one seen are fetched, so this is cheap.
+
+        Returns:
+            int: Number of new memories indexed
+        """
+        if self.memory_store is None:
+            return 0
+
+        with self._memory_lock:
+            now = time.time()
+            if not force and now - self._memory_last_refresh < self.memory_refresh_interval:
+                return 0
+            self._memory_last_refresh = now
+
+            new_records = self.memory_store.fetch_since(self._memory_last_version)
+            if new_records:
+                self._memory_last_version = new_records[-1]['version']
+                updates = self._reembed_stale(new_records)
+                if updates:
+                    self.memory_store.update_embeddings(updates, self.memory_embedding_key)
+                self._index_self_memory(self._apply_memory_updates(new_records))
+            return len(new_records)
+
+    def self_memory_version(self):
+        """
+        Number of memories currently indexed, after a (throttled) refresh.
+        Useful as a cache-busting key for callers that memoize retrieval results.
+        """
+        self.refresh_self_memory()
+        return len(self.self_memory_store)
+
+    def add_to_self_memory(self, query, context, output, score, heading=None, concise=None):
         """
         Stores a generated output as self-memory with its embedding.
         Only adds to memory if score is high enough (quality threshold).
@@ -160,21 +335,58 @@ class RAGClusterer:
             context: The retrieved context used for generating the response
             output: The generated response
             score: The quality score of the response (0-1)
+            heading: Optional heading of the best source, used by the 'query_heading' key
+            concise: Optional concise version of the output, served by the answer cache
         """
-        combined_text = f"{query} {context} {output}"
-        embedding = self.model.encode([combined_text], show_progress_bar=False).astype(np.float32)[0]
-        
-        # Only store high-quality responses (score > 0.9)
-        if score > 0.9:
-            self.self_memory_store.append({
-                'query': query,
-                'context': context, 
-                'output': output,
-                'embedding': embedding,
-                'score': score
-            })
-            return True
-        return False
+        return self.add_batch_to_self_memory([{
+            'query': query,
+            'context': context,
+            'output': output,
+            'score': score,
+            'heading': heading,
+            'concise': concise
+        }]) > 0
+
+    def add_batch_to_self_memory(self, items):
+        """
+        Store several self-memory candidates, embedding all accepted ones in a single batch.
+        Candidates at or below self_memory_min_score are dropped before any encoding.
+
+        Args:
+            items: List of dicts with query, context, output, score and optional heading/concise
+
+        Returns:
+            int: Number of memories stored
+        """
+        accepted = [item for item in items if item['score'] > self.self_memory_min_score]
+        if not accepted:
+            return 0
+
+        key_fn = MEMORY_EMBEDDING_KEYS[self.memory_embedding_key]
+        texts = [key_fn(m['query'], m['context'], m['output'], m.get('heading')) for m in accepted]
+        embeddings = self.model.encode(texts, show_progress_bar=False).astype(np.float32)
+
+        if self.memory_store is not None:
+            # Write through to the shared store; the refresh picks the rows up
+            # together with anything other replicas added in the meantime
+            for m, embedding in zip(accepted, embeddings):
+                self.memory_store.add(m['query'], m['context'], m['output'], m['score'], embedding,
+                                      concise=m.get('concise'), embedding_key=self.memory_embedding_key,
+                                      heading=m.get('heading'))
+            self.refresh_self_memory(force=True)
+        else:
+            with self._memory_lock:
+                self._index_self_memory([{
+                    'query': m['query'],
+                    'context': m['context'],
+                    'output': m['output'],
+                    'concise': m.get('concise'),
+                    'embedding': embedding,
+                    'embedding_key': self.memory_embedding_key,
+                    'heading': m.get('heading'),
+                    'score': m['score']
+                } for m, embedding in zip(accepted, embeddings)])
+        return len(accepted)
 
     def find_closest_self_memory(self, query, top_k=3):
         """
@@ -187,34 +399,32 @@ class RAGClusterer:
         Returns:
             List of dictionaries containing closest memories and their distances
         """
-        if not self.self_memory_store:
-            return []
+        self.refresh_self_memory()
 
-        # Encode query
-        query_emb = self.model.encode([query], show_progress_bar=False).astype(np.float32)
-        
-        # Extract embeddings from memory store
-        mem_embs = np.array([m['embedding'] for m in self.self_memory_store]).astype(np.float32)
-        dim = mem_embs.shape[1]
-        
-        # Create temporary FAISS index for search
-        temp_index = faiss.IndexFlatL2(dim)
-        temp_index.add(mem_embs)
-        
-        # Search for closest memories
-        distances, indices = temp_index.search(query_emb, min(top_k, len(self.self_memory_store)))
+        with self._memory_lock:
+            if not self.self_memory_store:
+                return []
 
-        results = []
-        for idx, dist in zip(indices[0], distances[0]):
-            m = self.self_memory_store[idx]
-            results.append({
-                'query': m['query'],
-                'context': m['context'],
-                'output': m['output'],
-                'distance': float(dist),  # Convert to native Python float
-                'score': m.get('score', 1.0)  # Include original score if available
-            })
-        return results
+            # Encode query
+            query_emb = self.encode_query(query)
+            
+            # Search the incremental index for closest memories
+            distances, indices = self.self_memory_index.search(query_emb, min(top_k, len(self.self_memory_store)))
+
+            results = []
+            for idx, dist in zip(indices[0], distances[0]):
+                if idx < 0:
+                    continue
+                m = self.self_memory_store[idx]
+                results.append({
+                    'query': m['query'],
+                    'context': m['context'],
+                    'output': m['output'],
+                    'concise': m.get('concise'),
+                    'distance': float(dist),  # Convert to native Python float
+                    'score': m.get('score', 1.0)  # Include original score if available
+                })
+            return results
 
     def query_clusters(self, query, top_x=None, top_y=3, top_k_self=3):
         """
@@ -248,11 +458,16 @@ class RAGClusterer:
         if top_self_memories:
             best_self = min(top_self_memories, key=lambda c: c['distance'])
 
+        # Query-only memory embeddings live in a different distance range than chunks, so
+        # they must clear an absolute threshold instead of beating the best chunk
+        if best_self and self.memory_embedding_key != 'full' and best_self['distance'] > self.self_memory_max_distance:
+            best_self = None
+
         # Step 3: Compare best_chunk vs best_self
         if best_chunk and best_self:
             # Compare distances to determine which source to use
             # We might prioritize self-memory if distances are close
-            if best_self['distance'] < best_chunk['distance']:
+            if self.memory_embedding_key != 'full' or best_self['distance'] < best_chunk['distance']:
                 return {
                     'source': 'self_memory',
                     'data': best_self
@@ -282,10 +497,13 @@ class RAGClusterer:
         """
         Save self memory to a JSON file.
         Embeddings are converted to lists for JSON serialization.
+        Not needed when a shared memory store is attached (writes go straight to it).
         """
         # Create a copy of the memory store with serializable embeddings
         serializable_memory = []
-        for mem in self.self_memory_store:
+        with self._memory_lock:
+            memories = list(self.self_memory_store)
+        for mem in memories:
             serializable_mem = mem.copy()
             serializable_mem['embedding'] = mem['embedding'].tolist()
             serializable_memory.append(serializable_mem)
@@ -302,18 +520,21 @@ class RAGClusterer:
             with open(file_path, 'r', encoding='utf-8') as f:
                 serialized_memory = json.load(f)
                 
-            self.self_memory_store = []
-            for mem in serialized_memory:
-                mem['embedding'] = np.array(mem['embedding'], dtype=np.float32)
-                self.self_memory_store.append(mem)
+            with self._memory_lock:
+                self._reset_self_memory()
+                for mem in serialized_memory:
+                    mem['embedding'] = np.array(mem['embedding'], dtype=np.float32)
+                self._reembed_stale(serialized_memory)
+                self._index_self_memory(serialized_memory)
             
             return len(self.self_memory_store)
         except (FileNotFoundError, json.JSONDecodeError):
-            self.self_memory_store = []
+            with self._memory_lock:
+                self._reset_self_memory()
             return 0
 
 
-def init_clusters(json_file="corpus.json", n_clusters=10, num_closest_clusters=1, memory_file=None):
+def init_clusters(json_file="corpus.json", n_clusters=10, num_closest_clusters=1, memory_file=None, memory_db=None):
     """
     Initialize the RAGClusterer with data and optionally load self-memory.
     
@@ -322,6 +543,8 @@ def init_clusters(json_file="corpus.json", n_clusters=10, num_closest_clusters=1
         n_clusters: Number of clusters to create
         num_closest_clusters: Default number of closest clusters to fetch
         memory_file: Optional path to load/initialize self-memory
+        memory_db: Optional path to a shared SQLite self-memory database. When given it
+            takes precedence over memory_file, which is only imported into an empty database.
     """
     with open(json_file, 'r', encoding='utf-8') as f:
         data_list = json.load(f)
@@ -329,8 +552,20 @@ def init_clusters(json_file="corpus.json", n_clusters=10, num_closest_clusters=1
     clusterer = RAGClusterer(n_clusters, num_closest_clusters=num_closest_clusters)
     clusterer.fit(data_list)
     
+    # Prefer the shared SQLite backend so replicas see each other's memories
+    if memory_db:
+        try:
+            store = SQLiteMemoryStore(memory_db)
+            if memory_file:
+                imported = store.import_json(memory_file)
+                if imported:
+                    print(f"Imported {imported} self-memory entries from {memory_file} into {memory_db}")
+            mem_count = clusterer.attach_memory_store(store)
+            print(f"Loaded {mem_count} self-memory entries from {memory_db}")
+        except Exception as e:
+            print(f"Could not open self-memory database: {e}")
     # Load self-memory if file path is provided
-    if memory_file:
+    elif memory_file:
         try:
             mem_count = clusterer.load_self_memory(memory_file)
             print(f"Loaded {mem_count} self-memory entries from {memory_file}")
@@ -387,6 +622,21 @@ def query_clusters(clusterer, query, top_x=None, top_y=3, top_k_self=3, use_self
         return top_chunks
 
 
+
+def format_context(clusters):
+    """
+    Format retrieved chunks (as returned by query_clusters) into the CONTEXT block sent to
+    the debugger agent.
+    """
+    context_text = ""
+    for i, cluster in enumerate(clusters):
+        source_type = cluster.get('source', 'clustered_db')
+        if source_type == 'self_memory':
+            context_text += f"Source {i+1} (Self Memory):\nPrevious Query: {cluster.get('original_query', 'Unknown')}\nContent: {cluster['content']}\n\n"
+        else:
+            context_text += f"Source {i+1}:\nTitle: {cluster['title']}\nLink: {cluster.get('link', 'N/A')}\nHeading: {cluster['heading']}\nContent: {cluster['content']}\n\n"
+    return context_text
+
 if __name__ == "__main__":
     # Simple test to demonstrate self-memory
     memory_file = "self_memory.json"
@@ -0,0 +1,336 @@
+import os
+import sys
+import csv
+import json
+import time
+import hashlib
+import argparse
+import threading
+import concurrent.futures
+import numpy as np
+from dotenv import load_dotenv
+from clustering import init_clusters, query_clusters, format_context
+from agents.debugger_agent import DebuggerAgent
+from agents.concise_agent import ConciseAgent, SUMMARY_MODES
+from agents.evaluator_agent import evaluate_response
+from utils import ragas
+from utils.llm_metrics import _percentile
+
+load_dotenv()
+
+# Per-query numeric fields that get aggregated in the summary
+SCORE_FIELDS = ("score", "faithfulness", "answer_relevance", "context_relevance", "reference_similarity")
+TIMING_FIELDS = ("retrieval_seconds", "generation_seconds", "concise_seconds", "evaluation_seconds", "total_seconds")
+
+
+def load_queries(path):
+    """
+    Read the query set: one JSON object per line with "query" (or "question"), and
+    optionally "id" and "reference" (a reference answer). Lines without an id are
+    identified by their line number.
+    """
+    queries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            query = item.get("query") or item.get("question")
+            if not query:
+                raise ValueError(f"{path}:{line_no}: missing 'query'")
+            queries.append({
+                "id": str(item.get("id", line_no)),
+                "query": query,
+                "reference": item.get("reference")
+            })
+    return queries
+
+
+def config_fingerprint(config):
+    """Identifies the configuration a result row was produced with."""
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+
+def load_checkpoint(path, fingerprint):
+    """
+    Returns:
+        dict: id -> row for queries already completed under this configuration; failed
+        rows and rows from another configuration are run again
+    """
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Partial line from an interrupted write
+            if row.get("config") == fingerprint and not row.get("error"):
+                done[row["id"]] = row
+    return done
+
+
+class BatchEvaluator:
+    """
+    Runs the chat pipeline (retrieval, generation, optional summary and evaluation) for
+    each query of a fixed set, without Streamlit.
+
+    Every query gets fresh agents, so answers don't depend on the order queries run in.
+    Retrieval uses one shared clusterer. Self-memory is off unless a memory source is
+    given, because entries added during a run would change later results.
+    """
+
+    def __init__(self, clusterer, top_y=5, top_k_self=3, use_self_memory=False, model="gemini-2.0-flash",
+                 fused=False, concise_mode=None, judge=True):
+        """
+        Args:
+            clusterer: Initialized RAGClusterer
+            top_y: Chunks retrieved per cluster
+            top_k_self: Self-memory entries checked before the corpus
+            use_self_memory: Whether retrieval may answer from self-memory
+            model: Model for the debugger and concise agents
+            fused: Generate with get_fused_response instead of get_response
+            concise_mode: One of SUMMARY_MODES to also produce the concise answer, or None
+            judge: Run evaluate_response (LLM judge and RAGAS); False scores with RAGAS only
+        """
+        self.clusterer = clusterer
+        self.top_y = top_y
+        self.top_k_self = top_k_self
+        self.use_self_memory = use_self_memory
+        self.model = model
+        self.fused = fused
+        self.concise_mode = concise_mode
+        self.judge = judge
+
+    def encode(self, texts):
+        return self.clusterer.model.encode(texts, show_progress_bar=False)
+
+    def run_one(self, item):
+        """
+        Returns:
+            dict: The result row for one query; exceptions are recorded in "error"
+        """
+        row = {"id": item["id"], "query": item["query"]}
+        started = time.perf_counter()
+        try:
+            start = time.perf_counter()
+            clusters = query_clusters(self.clusterer, item["query"], top_y=self.top_y,
+                                      top_k_self=self.top_k_self, use_self_memory=self.use_self_memory)
+            context_text = format_context(clusters)
+            row["retrieval_seconds"] = time.perf_counter() - start
+            row["sources"] = [cluster.get("title") for cluster in clusters]
+            row["source"] = clusters[0].get("source") if clusters else None
+
+            start = time.perf_counter()
+            message = f"USER: {item['query']}\n\nCONTEXT: {context_text}"
+            agent = DebuggerAgent(model=self.model)
+            if self.fused:
+                fused = agent.get_fused_response(message)
+                response, concise = fused["detailed"], fused["concise"]
+                row["response_type"] = fused["response_type"]
+            else:
+                response, concise = agent.get_response(message), None
+            row["generation_seconds"] = time.perf_counter() - start
+            row["response"] = response
+
+            if self.concise_mode and concise is None:
+                start = time.perf_counter()
+                concise_agent = ConciseAgent(model=self.model, mode=self.concise_mode, encoder=self.encode)
+                concise = concise_agent.get_concise_response(item["query"], response)
+                row["concise_seconds"] = time.perf_counter() - start
+            if concise is not None:
+                row["concise"] = concise
+
+            start = time.perf_counter()
+            if self.judge:
+                evaluation = evaluate_response(item["query"], response, model=self.model, context=context_text)
+                row["score"] = evaluation.get("score")
+                metrics = evaluation.get("ragas_metrics") or {}
+            else:
+                metrics = ragas.evaluate_ragas(response, context_text, item["query"])
+            row.update({key: metrics.get(key) for key in ("faithfulness", "answer_relevance", "context_relevance")})
+            if item.get("reference"):
+                answer_emb, reference_emb = self.encode([response, item["reference"]])
+                row["reference_similarity"] = round(float(ragas.cosine_similarity(answer_emb, reference_emb)), 3)
+            row["evaluation_seconds"] = time.perf_counter() - start
+        except Exception as e:
+            row["error"] = f"{type(e).__name__}: {e}"
+        row["total_seconds"] = time.perf_counter() - started
+        for field in TIMING_FIELDS:
+            if field in row:
+                row[field] = round(row[field], 4)
+        return row
+
+    def run(self, queries, output_path, fingerprint, workers=4, on_row=None):
+        """
+        Run the queries not already in the checkpoint on a pool of workers. Each finished
+        row is appended to output_path right away, so an interrupted run resumes where it
+        stopped. At most 2 * workers queries are in flight at once.
+
+        Returns:
+            list: Rows for every query of the set, in input order (resumed rows included)
+        """
+        done = load_checkpoint(output_path, fingerprint)
+        pending = [item for item in queries if item["id"] not in done]
+        if done:
+            print(f"Resuming: {len(queries) - len(pending)} of {len(queries)} queries already done")
+
+        lock = threading.Lock()
+        with open(output_path, "a", encoding="utf-8") as out, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch") as pool:
+            in_flight = set()
+            remaining = iter(pending)
+            while True:
+                for item in remaining:
+                    in_flight.add(pool.submit(self.run_one, item))
+                    if len(in_flight) >= 2 * workers:
+                        break
+                if not in_flight:
+                    break
+                finished, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    row = dict(future.result(), config=fingerprint)
+                    with lock:
+                        out.write(json.dumps(row) + "\n")
+                        out.flush()
+                    done[row["id"]] = row
+                    if on_row:
+                        on_row(row, len(done), len(queries))
+
+        return [done[item["id"]] for item in queries if item["id"] in done]
+
+
+def summarize(rows, wall_seconds=None, executed=None):
+    """
+    Aggregate result rows. Throughput counts the executed queries (rows run in this
+    invocation, not those resumed from the checkpoint) over wall_seconds.
+
+    Returns:
+        dict: counts, mean/p50/p95 of every score and timing field, and throughput
+    """
+    ok = [row for row in rows if not row.get("error")]
+    summary = {"queries": len(rows), "succeeded": len(ok), "errors": len(rows) - len(ok)}
+    for field in SCORE_FIELDS + TIMING_FIELDS:
+        values = [row[field] for row in ok if isinstance(row.get(field), (int, float))]
+        if values:
+            summary[field] = {
+                "mean": round(float(np.mean(values)), 4),
+                "p50": round(_percentile(values, 0.5), 4),
+                "p95": round(_percentile(values, 0.95), 4),
+                "n": len(values)
+            }
+    if wall_seconds:
+        summary["wall_seconds"] = round(wall_seconds, 2)
+        summary["queries_per_second"] = round((len(ok) if executed is None else executed) / wall_seconds, 3)
+    sources = [row.get("source") for row in ok]
+    summary["self_memory_hits"] = sources.count("self_memory")
+    return summary
+
+
+def write_csv(rows, path):
+    """Write one line per query with its scores and timings (long text fields are left out)."""
+    columns = ["id", "query", "source", "response_type", *SCORE_FIELDS, *TIMING_FIELDS, "error"]
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+
+def print_summary(summary):
+    print(f"\n{summary['succeeded']}/{summary['queries']} queries succeeded, {summary['errors']} errors")
+    header = f"{'metric':<22}{'mean':>10}{'p50':>10}{'p95':>10}{'n':>7}"
+    print(header)
+    print("-" * len(header))
+    for field in SCORE_FIELDS + TIMING_FIELDS:
+        if field in summary:
+            s = summary[field]
+            print(f"{field:<22}{s['mean']:>10.3f}{s['p50']:>10.3f}{s['p95']:>10.3f}{s['n']:>7}")
+    if "queries_per_second" in summary:
+        print(f"\nWall time {summary['wall_seconds']:.1f}s, {summary['queries_per_second']:.2f} queries/s")
+
+
+if __name__ == "__main__":
+    # Usage: python evaluate_batch.py queries.jsonl [--out results.jsonl] [--workers 4] [--n-clusters 30]
+    parser = argparse.ArgumentParser(description="Score the RAG pipeline on a fixed query set")
+    parser.add_argument("queries", help="JSONL with query, optional id and reference")
+    parser.add_argument("--out", default="batch_results.jsonl", help="Per-query results; also the resume checkpoint")
+    parser.add_argument("--csv", default=None, help="CSV of scores and timings (default: --out with .csv)")
+    parser.add_argument("--summary", default=None, help="Summary JSON (default: --out with .summary.json)")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--corpus", default="corpus.json")
+    parser.add_argument("--n-clusters", type=int, default=30)
+    parser.add_argument("--num-closest-clusters", type=int, default=5)
+    parser.add_argument("--top-y", type=int, default=5)
+    parser.add_argument("--top-k-self", type=int, default=3)
+    parser.add_argument("--memory-file", default=None, help="Self-memory JSON; enables self-memory retrieval")
+    parser.add_argument("--memory-db", default=None, help="Self-memory database; enables self-memory retrieval")
+    parser.add_argument("--model", default="gemini-2.0-flash")
+    parser.add_argument("--fused", action="store_true", help="Use fused generation")
+    parser.add_argument("--concise", choices=SUMMARY_MODES, default=None, help="Also produce the concise answer")
+    parser.add_argument("--ragas-mode", choices=ragas.RAGAS_MODES, default=ragas.RAGAS_MODE)
+    parser.add_argument("--no-judge", action="store_true", help="Score with RAGAS only, without the LLM judge")
+    parser.add_argument("--limit", type=int, default=None, help="Only run the first N queries")
+    args = parser.parse_args()
+
+    base = os.path.splitext(args.out)[0]
+    csv_path = args.csv or base + ".csv"
+    summary_path = args.summary or base + ".summary.json"
+
+    queries = load_queries(args.queries)[:args.limit]
+    ragas.RAGAS_MODE = args.ragas_mode
+    # Results are only reused by a resumed run with the same configuration
+    config = {
+        "queries": os.path.abspath(args.queries),
+        "corpus": args.corpus,
+        "n_clusters": args.n_clusters,
+        "num_closest_clusters": args.num_closest_clusters,
+        "top_y": args.top_y,
+        "top_k_self": args.top_k_self,
+        "memory": args.memory_db or args.memory_file,
+        "model": args.model,
+        "provider": os.environ.get("MATBOT_LLM_PROVIDER", "gemini"),
+        "fused": args.fused,
+        "concise": args.concise,
+        "ragas_mode": args.ragas_mode,
+        "judge": not args.no_judge,
+    }
+    fingerprint = config_fingerprint(config)
+    print(f"{len(queries)} queries, configuration {fingerprint}")
+
+    clusterer = init_clusters(json_file=args.corpus, n_clusters=args.n_clusters,
+                              num_closest_clusters=args.num_closest_clusters,
+                              memory_file=args.memory_file, memory_db=args.memory_db)
+    evaluator = BatchEvaluator(
+        clusterer,
+        top_y=args.top_y,
+        top_k_self=args.top_k_self,
+        use_self_memory=bool(args.memory_file or args.memory_db),
+        model=args.model,
+        fused=args.fused,
+        concise_mode=args.concise,
+        judge=not args.no_judge
+    )
+
+    executed = 0
+
+    def report(row, completed, total):
+        global executed
+        executed += 1
+        status = row["error"] if row.get("error") else f"score={row.get('score')} faithfulness={row.get('faithfulness')}"
+        print(f"[{completed}/{total}] {row['id']}: {row['total_seconds']:.1f}s {status}")
+
+    started = time.perf_counter()
+    rows = evaluator.run(queries, args.out, fingerprint, workers=args.workers, on_row=report)
+    summary = summarize(rows, wall_seconds=time.perf_counter() - started, executed=executed)
+    summary["config"] = dict(config, fingerprint=fingerprint)
+
+    write_csv(rows, csv_path)
+    with open(summary_path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+    print_summary(summary)
+    print(f"\nWrote {args.out}, {csv_path} and {summary_path}")
+    sys.exit(1 if summary["errors"] else 0)
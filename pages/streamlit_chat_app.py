@@ -4,14 +4,23 @@ from dotenv import load_dotenv
 import time
 import os.path
 from agents.debugger_agent import DebuggerAgent, DEFAULT_SYSTEM_PROMPT as DEBUGGER_DEFAULT_PROMPT
-from agents.evaluator_agent import evaluate_response, DEFAULT_SYSTEM_PROMPT as EVALUATOR_DEFAULT_PROMPT
-from agents.concise_agent import ConciseAgent, DEFAULT_SYSTEM_PROMPT as CONCISE_DEFAULT_PROMPT
+from agents.evaluator_agent import BackgroundEvaluator, DEFAULT_SYSTEM_PROMPT as EVALUATOR_DEFAULT_PROMPT
+from agents.concise_agent import ConciseAgent, SUMMARY_MODES, DEFAULT_SYSTEM_PROMPT as CONCISE_DEFAULT_PROMPT
 from agents.intent_agent import IntentAgent, DEFAULT_SYSTEM_PROMPT as INTENT_DEFAULT_PROMPT
-from clustering import init_clusters, query_clusters
+from agents.intent_classifier import IntentClassifier, INTENT_MODEL
+from clustering import init_clusters, query_clusters, format_context
 import hashlib
+import threading
+import concurrent.futures
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from query_images import ImageSearchEngine
 from utils.rrr import get_similar_queries
 from utils.hayd import hyde
+from utils.memory_ingest import SelfMemoryIngestor
+from utils.answer_cache import AnswerCache
+from utils.stage_executor import StageGraph
+from utils.intent_cache import SemanticIntentCache
+from utils.session_state import SessionStateManager, SQLiteSessionStore, LRUDict
 
 # Load environment variables
 load_dotenv()
@@ -44,16 +53,53 @@ RESPONSE_MODES = ["auto", "detailed", "concise"]
 
 # File path for self memory storage
 SELF_MEMORY_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "self_memory.json")
+# Shared SQLite self-memory database; every replica on the host reads and writes it.
+# The legacy JSON file above is imported into it once when the database is empty.
+SELF_MEMORY_DB = os.environ.get(
+    "MATBOT_SELF_MEMORY_DB",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "self_memory.db")
+)
+
+# Idle sessions are spilled to this database and restored on their next interaction
+SESSION_SPILL_DB = os.environ.get(
+    "MATBOT_SESSION_DB",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "session_spill.db")
+)
 
 # print('Debugging: self_memory_file:', SELF_MEMORY_FILE)
 
+def _session_alive(session_id):
+    try:
+        from streamlit.runtime import Runtime
+        return Runtime.instance().is_active_session(session_id)
+    except Exception:
+        return True
+
+# One manager for all sessions on this server
+@st.cache_resource
+def get_session_manager():
+    """Initialize and cache the per-session state limits and idle-session spilling"""
+    return SessionStateManager(
+        SQLiteSessionStore(SESSION_SPILL_DB),
+        max_turns=int(os.environ.get("MATBOT_SESSION_MAX_TURNS", 20)),
+        max_cached_responses=int(os.environ.get("MATBOT_SESSION_MAX_CACHED", 50)),
+        idle_seconds=float(os.environ.get("MATBOT_SESSION_IDLE_SECONDS", 900)),
+        session_alive=_session_alive
+    )
+
+# Bring back this session's state if it was spilled while idle
+_script_ctx = get_script_run_ctx()
+if _script_ctx is not None and not get_session_manager().activate(_script_ctx.session_id, _script_ctx.session_state):
+    # The spilled state expired; start the session over
+    st.session_state.pop("session_initialized", None)
+
 # Initialize session state and use get() pattern to avoid re-initialization on rerun
 if "session_initialized" not in st.session_state:
     st.session_state.chat_history = []
     st.session_state.debugger_agent = DebuggerAgent()
-    st.session_state.concise_agent = ConciseAgent()
+    st.session_state.concise_agent = ConciseAgent(max_cached_responses=int(os.environ.get("MATBOT_SESSION_MAX_CACHED", 50)))
     st.session_state.intent_agent = IntentAgent()
-    st.session_state.evaluation_history = []
+    st.session_state.evaluation_history = {}  # Assistant message index -> evaluation
     st.session_state.feedback_given = {}
     st.session_state.chat_started = False
     st.session_state.model_params = {
@@ -66,7 +112,9 @@ if "session_initialized" not in st.session_state:
         "top_y": 5,
         "top_k_self": 3,
         "use_self_memory": True,
-        "memory_threshold": 0.85  # Threshold for adding to self memory
+        "memory_threshold": 0.85,  # Threshold for adding to self memory
+        "use_answer_cache": True,  # Answer near-identical questions straight from self memory
+        "answer_cache_distance": 0.05  # Max self-memory distance that counts as a cache hit
     }
     st.session_state.image_search_params = {
         "top_k": 3,
@@ -79,9 +127,11 @@ if "session_initialized" not in st.session_state:
     st.session_state.feedback_messages = {}
     st.session_state.improved_responses = {}
     st.session_state.response_mode = "auto"  # Default to auto for smart detection
+    st.session_state.concise_mode = "llm"  # How concise summaries are produced (see SUMMARY_MODES)
+    st.session_state.fused_generation = False  # One structured call returns intent, detailed and concise answers
     st.session_state.expanded_details = {}
     st.session_state.expanded_summary = {}
-    st.session_state.cached_responses = {}
+    st.session_state.cached_responses = LRUDict(int(os.environ.get("MATBOT_SESSION_MAX_CACHED", 50)))
     st.session_state.alternative_versions = {}  # Store both versions of responses
     st.session_state.intent_analysis = {}  # Store intent analysis results
     st.session_state.show_advanced = False  # Advanced mode toggle
@@ -97,6 +147,10 @@ if "session_initialized" not in st.session_state:
     st.session_state.at_query_improvement = False  # Flag to show improved query
     st.session_state.source_memory = {}  # Track which responses came from self-memory
     st.session_state.memory_added = {}  # Track which responses were added to self-memory
+    st.session_state.image_results = {}  # Related images prefetched while the answer is generated
+    st.session_state.stage_timings = {}  # Per-stage timings of each turn
+    st.session_state.pending_concise = {}  # Concise summaries still generating in the background
+    st.session_state.pending_evaluations = []  # (message index, Future) in submission order
 
 # Custom CSS - adding styles for self-memory indicators
 st.markdown("""
@@ -330,20 +384,172 @@ st.markdown("""
 
 # Cache cluster initialization to avoid re-processing on every rerun
 @st.cache_resource
-def get_clusterer(n_clusters=30, num_closest_clusters=5, memory_file=None):
+def get_clusterer(n_clusters=30, num_closest_clusters=5, memory_file=None, memory_db=None):
     """Initialize and cache the RAGClusterer with optional self-memory loading"""
-    print(f"Initializing clusterer with memory_file={memory_file}")
+    print(f"Initializing clusterer with memory_file={memory_file}, memory_db={memory_db}")
     clusterer = init_clusters(
         n_clusters=n_clusters, 
         num_closest_clusters=num_closest_clusters,
-        memory_file=memory_file
+        memory_file=memory_file,
+        memory_db=memory_db
     )
     return clusterer
 
+def save_self_memory_file(clusterer):
+    """Persist JSON self-memory after an ingested batch (the shared database is written on insert)"""
+    if clusterer.memory_store is not None:
+        return
+    try:
+        # Create parent directory if it doesn't exist
+        os.makedirs(os.path.dirname(SELF_MEMORY_FILE), exist_ok=True)
+        print(f"Saving self-memory to: {SELF_MEMORY_FILE}")
+        clusterer.save_self_memory(SELF_MEMORY_FILE)
+    except Exception as e:
+        print(f"Error saving self-memory: {e}")
+
+# One ingestion worker per cached clusterer; clusterer_id keys the cache
+@st.cache_resource
+def get_memory_ingestor(clusterer_id, _clusterer):
+    """Initialize and cache the background self-memory ingestion queue"""
+    return SelfMemoryIngestor(_clusterer, on_persist=lambda: save_self_memory_file(_clusterer))
+
+# One answer cache per cached clusterer, shared by all sessions so hit statistics are global
+@st.cache_resource
+def get_answer_cache(clusterer_id, _clusterer):
+    """Initialize and cache the semantic answer cache"""
+    return AnswerCache(_clusterer)
+
+def lookup_answer_cache(clusterer, query, record=True):
+    """Return a remembered answer for the query if the answer cache tier is enabled and hits"""
+    rag_params = st.session_state.rag_params
+    if not (rag_params["use_self_memory"] and rag_params.get("use_answer_cache", True)):
+        return None
+    return get_answer_cache(id(clusterer), clusterer).lookup(
+        query,
+        max_distance=rag_params.get("answer_cache_distance", 0.05),
+        record=record
+    )
+
+def get_intent_classifier():
+    """Load the local intent classifier trained with `python -m agents.intent_classifier train`"""
+    # Keyed on the model file's mtime, so a retrained classifier is picked up without a restart
+    mtime = os.path.getmtime(INTENT_MODEL) if os.path.exists(INTENT_MODEL) else None
+    return _load_intent_classifier(mtime)
+
+@st.cache_resource(max_entries=1)
+def _load_intent_classifier(model_mtime):
+    try:
+        return IntentClassifier.load(INTENT_MODEL)
+    except Exception as e:
+        print(f"Could not load intent classifier: {e}")
+        return None
+
+# Shared by all sessions, so an intent decided for one user is reused for similar queries from others
+@st.cache_resource
+def get_intent_cache():
+    """Initialize and cache the cross-session semantic intent cache"""
+    return SemanticIntentCache(
+        max_entries=int(os.environ.get("MATBOT_INTENT_CACHE_SIZE", 5000)),
+        max_distance=float(os.environ.get("MATBOT_INTENT_CACHE_DISTANCE", 0.1))
+    )
+
+def log_intent_feedback(message_idx, label):
+    """Record that the user asked for the other version of an answer, as classifier training data"""
+    intent = st.session_state.intent_analysis.get(message_idx, {})
+    # Only auto-mode turns carry the query the intent agent classified
+    if "query" in intent:
+        try:
+            st.session_state.intent_agent.intent_log.add(intent["query"], label, "feedback")
+        except OSError as e:
+            print(f"Could not log intent feedback: {e}")
+
 # Cache context fetching for queries
+@st.cache_resource
+def get_background_evaluator():
+    """Shared evaluation worker pool; scoring runs off the response path"""
+    return BackgroundEvaluator(max_workers=2)
+
+def submit_evaluation(message_idx, user_query, response, context=None, on_done=None):
+    """Queue an evaluation; it reaches the sidebar once collect_evaluations picks it up"""
+    future = get_background_evaluator().submit(
+        user_query,
+        response,
+        system_prompt=EVALUATOR_DEFAULT_PROMPT,
+        model=st.session_state.model_params["model"],
+        context=context,
+        on_done=on_done
+    )
+    st.session_state.pending_evaluations.append((message_idx, future))
+
+def collect_evaluations(wait=False):
+    """
+    Move finished evaluations into evaluation_history under their message index.
+    With wait=True, wait for all of them.
+    """
+    pending = st.session_state.pending_evaluations
+    while pending and (wait or pending[0][1].done()):
+        message_idx, future = pending.pop(0)
+        try:
+            eval_data = future.result()
+        except Exception:
+            eval_data = {
+                "score": 0.5,
+                "strengths": [],
+                "weaknesses": ["Evaluation failed"],
+                "improvement_suggestions": "The response couldn't be evaluated."
+            }
+        if "memory_added" in eval_data:
+            st.session_state.memory_added[message_idx] = eval_data.pop("memory_added")
+        st.session_state.last_evaluation = eval_data
+        st.session_state.evaluation_history[message_idx] = eval_data
+
+@st.cache_resource
+def get_concise_executor():
+    """Shared worker pool for concise summaries generated after the detailed answer is shown"""
+    return concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="concise")
+
+def start_concise(message_idx, processed_query, detailed_response, cache_key):
+    """Generate the concise summary for a message in the background"""
+    concise_agent = st.session_state.concise_agent
+    future = get_concise_executor().submit(concise_agent.get_concise_response, processed_query, detailed_response)
+    st.session_state.pending_concise[message_idx] = (future, cache_key)
+
+def resolve_concise(message_idx, wait=False):
+    """
+    Move a finished background summary into alternative_versions.
+    With wait=True, block until it is ready. Returns the summary, or None if still pending.
+    """
+    pending = st.session_state.pending_concise.get(message_idx)
+    if pending is None:
+        return st.session_state.alternative_versions.get(message_idx, {}).get("concise")
+    
+    future, cache_key = pending
+    if not wait and not future.done():
+        return None
+    try:
+        concise_response = future.result()
+    except Exception as e:
+        print(f"Concise generation failed: {e}")
+        concise_response = None
+    del st.session_state.pending_concise[message_idx]
+    
+    if concise_response is not None:
+        st.session_state.cached_responses[cache_key] = concise_response
+        if message_idx in st.session_state.alternative_versions:
+            st.session_state.alternative_versions[message_idx]["concise"] = concise_response
+    return concise_response
+
+def collect_concise():
+    """Move every finished background summary into alternative_versions and the response cache"""
+    for message_idx in list(st.session_state.pending_concise):
+        resolve_concise(message_idx)
+
 @st.cache_data(ttl=3600)  # Cache for 1 hour
-def get_query_clusters(_clusterer, query, top_y=5, top_k_self=3, use_self_memory=True):
-    """Get query results from clusterer with self-memory support"""
+def get_query_clusters(_clusterer, query, top_y=5, top_k_self=3, use_self_memory=True, memory_version=0):
+    """
+    Get query results from clusterer with self-memory support.
+    memory_version only keys the cache, so new memories from any replica invalidate it.
+    """
     return query_clusters(
         _clusterer, 
         query, 
@@ -425,6 +631,8 @@ def render_chat_message(message, is_user=False, message_idx=None, intent_type=No
         memory_source = st.session_state.source_memory[message_idx]
         if memory_source == "self_memory":
             memory_badge = "<div class='self-memory-indicator'>🧠 From Self Memory</div>"
+        elif memory_source == "answer_cache":
+            memory_badge = "<div class='self-memory-indicator'>⚡ Cached Answer</div>"
     
     # Process message to ensure code blocks render correctly
     if not is_user:
@@ -470,9 +678,11 @@ def display_image_results(query, message_idx):
     # Get the top_k from session state
     top_k = st.session_state.image_search_params["top_k"]
     
-    # Search for related images
-    with st.spinner("Finding related images..."):
-        images = search_related_images(query, top_k)
+    # Use the images prefetched during the turn, searching only if the prefetch failed
+    images = st.session_state.image_results.get(message_idx)
+    if images is None:
+        with st.spinner("Finding related images..."):
+            images = search_related_images(query, top_k)
     
     if not images:
         st.info("No relevant images found for this query.")
@@ -497,16 +707,19 @@ def process_negative_feedback(message_idx):
     original_message = st.session_state.chat_history[message_idx]["content"]
     user_query = st.session_state.chat_history[message_idx-1]["content"]
     
+    # The feedback prompt needs this turn's evaluation, which may still be running
+    collect_evaluations(wait=True)
+    
     # Create a cache key based on the original message and user query
     cache_key = hash_message(f"{user_query}::{original_message}")
     if cache_key in st.session_state.cached_responses:
         improved_response = st.session_state.cached_responses[cache_key]
     else:
         # Get the evaluation data
-        eval_idx = (message_idx - 1) // 2
-        if eval_idx < len(st.session_state.evaluation_history):
-            strengths = "\n".join([f"- {s}" for s in st.session_state.evaluation_history[eval_idx]["strengths"]])
-            weaknesses = "\n".join([f"- {w}" for w in st.session_state.evaluation_history[eval_idx]["weaknesses"]])
+        eval_data = st.session_state.evaluation_history.get(message_idx)
+        if eval_data is not None:
+            strengths = "\n".join([f"- {s}" for s in eval_data["strengths"]])
+            weaknesses = "\n".join([f"- {w}" for w in eval_data["weaknesses"]])
             
             # Fixed formatting for improvement prompt - proper indentation and no extra whitespace
             improvement_prompt = (
@@ -517,7 +730,7 @@ def process_negative_feedback(message_idx):
                 f"Strengths:\n{strengths}\n\n"
                 f"Weaknesses:\n{weaknesses}\n\n"
                 f"Suggestions for improvement:\n"
-                f"{st.session_state.evaluation_history[eval_idx]['improvement_suggestions']}\n\n"
+                f"{eval_data['improvement_suggestions']}\n\n"
                 f"Please provide a completely revised response that addresses the weaknesses "
                 f"while maintaining the strengths."
             )
@@ -556,19 +769,13 @@ def process_negative_feedback(message_idx):
     if message_idx in st.session_state.source_clusters:
         st.session_state.source_clusters[new_message_idx] = st.session_state.source_clusters[message_idx]
     
-    # Evaluate the improved response with properly formatted spinner text
-    with st.spinner("Evaluating improved response..."):
-        eval_data = evaluate_response(
-            user_query, 
-            improved_response,
-            system_prompt=EVALUATOR_DEFAULT_PROMPT,
-            model=st.session_state.model_params["model"]
-        )
-        st.session_state.evaluation_history.append(eval_data)
+    # Evaluate the improved response in the background
+    submit_evaluation(new_message_idx, user_query, improved_response)
     
     return improved_response
 
 def display_chat_history():
+    collect_concise()
     for i, message in enumerate(st.session_state.chat_history):
         # Get the intent type for this message (if available and it's an assistant message)
         intent_type = None
@@ -592,12 +799,9 @@ def display_chat_history():
                     col1, col2, col3 = st.columns([1, 2, 1])
                     with col2:
                         if st.button("🔍 Explain in Detail", key=f"expand_{i}", use_container_width=True):
+                            # The detailed version was generated with the turn
                             st.session_state.expanded_details[i] = True
-                            # Simulate processing time
-                            placeholder = st.empty()
-                            with placeholder.container():
-                                with st.spinner("Generating detailed explanation..."):
-                                    time.sleep(3.5)
+                            log_intent_feedback(i, "DETAILED")
                             st.rerun()
                     st.markdown('</div>', unsafe_allow_html=True)
                 else:
@@ -605,7 +809,7 @@ def display_chat_history():
                     with st.expander("Detailed Explanation"):
                         st.markdown(st.session_state.alternative_versions[i]["detailed"])
             
-            elif intent_type == "detailed" and "concise" in st.session_state.alternative_versions[i]:
+            elif intent_type == "detailed" and ("concise" in st.session_state.alternative_versions[i] or i in st.session_state.pending_concise):
                 # Show "View concise summary" button for detailed responses
                 if i not in st.session_state.expanded_summary:
                     # Wrap the button in a container div for centering
@@ -614,17 +818,17 @@ def display_chat_history():
                     with col2:
                         if st.button("📝 View concise summary", key=f"concise_{i}", use_container_width=True):
                             st.session_state.expanded_summary[i] = True
-                            # Simulate processing time
-                            placeholder = st.empty()
-                            with placeholder.container():
-                                with st.spinner("Generating concise summary..."):
-                                    time.sleep(2)
+                            log_intent_feedback(i, "CONCISE")
+                            # Usually finished in the background already; otherwise wait for it here
+                            with st.spinner("Generating concise summary..."):
+                                resolve_concise(i, wait=True)
                             st.rerun()
                     st.markdown('</div>', unsafe_allow_html=True)
                 else:
                     # Show concise version in an expander
                     with st.expander("Concise Summary"):
-                        st.markdown(st.session_state.alternative_versions[i]["concise"])
+                        concise_response = resolve_concise(i, wait=True)
+                        st.markdown(concise_response or "The concise summary could not be generated.")
         
         # Add "View related images" button for assistant messages
         if message["role"] == "assistant" and i > 0:  # Make sure there's a user message before this
@@ -681,15 +885,45 @@ def get_score_color(score):
         return "#FF6666"  # Red for low scores
 
 def render_evaluation_sidebar():
-    """Display all evaluation results in the sidebar with Ragas metrics"""
-    st.sidebar.markdown("<h3 class='sidebar-header'>Response Evaluations</h3>", unsafe_allow_html=True)
+    """
+    Display all evaluation results with Ragas metrics. Call inside `with st.sidebar`.
+    While evaluations are running, the sidebar polls for them; otherwise it is static.
+    """
+    if st.session_state.pending_evaluations:
+        _poll_evaluation_sidebar()
+    else:
+        _render_evaluation_sidebar()
+
+@st.fragment(run_every=2)
+def _poll_evaluation_sidebar():
+    """Rerun on its own every few seconds until the background evaluations have arrived"""
+    # Fragment reruns don't count as activity, so an idle session can still be spilled
+    ctx = get_script_run_ctx()
+    with get_session_manager().hold(ctx.session_id, ctx.session_state) as available:
+        if available:
+            _render_evaluation_sidebar()
+    if available and not st.session_state.pending_evaluations:
+        # Nothing left to wait for: a full rerun swaps in the static sidebar and stops polling
+        st.rerun()
+
+def _render_evaluation_sidebar():
+    collect_evaluations()
+    st.markdown("<h3 class='sidebar-header'>Response Evaluations</h3>", unsafe_allow_html=True)
+    
+    if st.session_state.pending_evaluations:
+        st.caption(f"⏳ {len(st.session_state.pending_evaluations)} evaluation(s) in progress...")
     
     if not st.session_state.evaluation_history:
-        st.sidebar.info("No evaluations yet. Send a message to get started.")
+        if not st.session_state.pending_evaluations:
+            st.info("No evaluations yet. Send a message to get started.")
         return
     
-    for i, eval_data in enumerate(st.session_state.evaluation_history):
-        with st.sidebar.expander(f"Evaluation #{i+1} (Score: {eval_data.get('score', 0.5):.2f})", expanded=(i == len(st.session_state.evaluation_history) - 1)):
+    evaluations = sorted(st.session_state.evaluation_history.items())
+    for i, (message_idx, eval_data) in enumerate(evaluations):
+        # Numbered by the assistant response it belongs to
+        response_number = sum(1 for m in st.session_state.chat_history[:message_idx + 1] if m["role"] == "assistant")
+        label = "cached answer" if eval_data.get("cached") else f"Score: {eval_data.get('score', 0.5):.2f}"
+        with st.expander(f"Evaluation #{response_number} ({label})", expanded=(i == len(evaluations) - 1)):
             # Quality score with color
             score = eval_data.get("score", 0.5)
             score_color = get_score_color(score)
@@ -756,6 +990,22 @@ def render_model_params_sidebar():
             )
             st.session_state.response_mode = response_mode
             
+            concise_mode = st.radio(
+                "Concise Summaries",
+                SUMMARY_MODES,
+                index=SUMMARY_MODES.index(st.session_state.concise_mode),
+                format_func=lambda x: {"llm": "LLM", "extractive": "Local (extractive)"}[x],
+                help="LLM: The model rewrites the detailed answer. Local: The most relevant sentences and code blocks are picked instantly, without an API call."
+            )
+            st.session_state.concise_mode = concise_mode
+            
+            fused_generation = st.checkbox(
+                "Fused Generation",
+                value=st.session_state.fused_generation,
+                help="Get the response style, detailed answer and concise summary from one LLM call instead of three. The answer appears when complete instead of streaming."
+            )
+            st.session_state.fused_generation = fused_generation
+            
             # Add HyDE toggle
             use_hyde = st.checkbox(
                 "Use HyDE Query Expansion", 
@@ -794,7 +1044,26 @@ def render_model_params_sidebar():
                 disabled=not use_self_memory
             )
             
+            use_answer_cache = st.checkbox(
+                "Use Answer Cache",
+                value=st.session_state.rag_params.get("use_answer_cache", True),
+                help="Answer near-identical questions directly from self memory, skipping the LLM pipeline",
+                disabled=not use_self_memory
+            )
+            
+            answer_cache_distance = st.slider(
+                "Answer Cache Distance",
+                min_value=0.0,
+                max_value=0.3,
+                value=st.session_state.rag_params.get("answer_cache_distance", 0.05),
+                step=0.01,
+                help="Maximum embedding distance to a remembered query for its answer to be reused",
+                disabled=not (use_self_memory and use_answer_cache)
+            )
+            
             # Update self-memory parameters in session state
+            st.session_state.rag_params["use_answer_cache"] = use_answer_cache
+            st.session_state.rag_params["answer_cache_distance"] = answer_cache_distance
             st.session_state.rag_params["use_self_memory"] = use_self_memory
             st.session_state.rag_params["memory_threshold"] = memory_threshold
             st.session_state.rag_params["top_k_self"] = top_k_self
@@ -895,13 +1164,17 @@ def render_model_params_sidebar():
             st.session_state.model_params["model"] = AVAILABLE_MODELS[0]
             st.session_state.model_params["system_prompt"] = DEBUGGER_DEFAULT_PROMPT
             st.session_state.response_mode = "auto"
+            st.session_state.concise_mode = "llm"
+            st.session_state.fused_generation = False
             st.session_state.rag_params = {
                 "n_clusters": 30,
                 "num_closest_clusters": 5,
                 "top_y": 5,
                 "top_k_self": 3,
                 "use_self_memory": True,
-                "memory_threshold": 0.85
+                "memory_threshold": 0.85,
+                "use_answer_cache": True,
+                "answer_cache_distance": 0.05
             }
             st.session_state.image_search_params = {
                 "top_k": 3
@@ -995,6 +1268,17 @@ def handle_user_input(clusterer):
         # Use the selected query 
         selected_query = st.session_state.query_selection
         
+        # A remembered answer makes query expansion pointless, so skip HyDE on a cache hit
+        if lookup_answer_cache(clusterer, selected_query, record=False):
+            st.session_state.chat_history.append({
+                "role": "user", 
+                "content": selected_query
+            })
+            process_query(clusterer, selected_query, selected_query)
+            st.session_state.at_query_selection = False  
+            st.session_state.at_query_improvement = False
+            st.rerun()
+        
         with st.spinner("Improving query..."):
             # Use HAYD to improve the query
             hyde_result = hyde(selected_query)
@@ -1029,32 +1313,112 @@ def handle_user_input(clusterer):
             st.rerun()
 
 # Extract the query processing code into a separate function
+def serve_cached_answer(cache_hit):
+    """Answer the current query from the answer cache without any LLM calls"""
+    assistant_message_idx = len(st.session_state.chat_history)
+    detailed_response = cache_hit['output']
+    concise_response = cache_hit.get('concise') or detailed_response
+    response_type = "CONCISE" if st.session_state.response_mode == "concise" else "DETAILED"
+
+    st.session_state.source_clusters[assistant_message_idx] = [{
+        'cluster_id': -1,
+        'title': f"Previous Interaction: {cache_hit['query'][:50]}...",
+        'heading': "Self-Memory",
+        'content': detailed_response,
+        'link': '',
+        'distance': cache_hit['distance'],
+        'source': 'self_memory',
+        'original_query': cache_hit['query']
+    }]
+    st.session_state.source_memory[assistant_message_idx] = "answer_cache"
+    st.session_state.alternative_versions[assistant_message_idx] = {
+        "detailed": detailed_response,
+        "concise": concise_response
+    }
+    st.session_state.intent_analysis[assistant_message_idx] = {
+        "response_type": response_type,
+        "confidence": 1.0,
+        "reasoning": f"Served from answer cache (distance {cache_hit['distance']:.3f} to a previous query)"
+    }
+    # No evaluation runs for a cached answer; its stored score stands in for one
+    st.session_state.evaluation_history[assistant_message_idx] = {
+        "score": cache_hit.get('score', 0.5),
+        "strengths": [],
+        "weaknesses": [],
+        "improvement_suggestions": "",
+        "cached": True
+    }
+    final_response = concise_response if response_type == "CONCISE" else detailed_response
+    st.session_state.chat_history.append({"role": "assistant", "content": final_response})
+
 def process_query(clusterer, original_query, processed_query):
     """Process a query with the RAG system and generate a response"""
     # Mark chat as started
     st.session_state.chat_started = True
+    start_time = time.time()
+    
+    # Answer cache tier: near-identical questions skip the whole LLM pipeline
+    answer_cache = get_answer_cache(id(clusterer), clusterer)
+    cache_hit = lookup_answer_cache(clusterer, original_query)
+    if cache_hit:
+        serve_cached_answer(cache_hit)
+        answer_cache.record_hit_latency(time.time() - start_time)
+        return
     
     # Create a progress bar for better UX during processing
     progress_bar = st.progress(0)
-
-    # Get clusters for the user message using parameters from session state
-    with st.spinner("Fetching relevant documentation..."):
-        # Show "Fetching docs" message for a short time
-        time.sleep(1)
-        
+    
+    user_message_idx = len(st.session_state.chat_history) - 1
+    assistant_message_idx = user_message_idx + 1
+    
+    # Determine if we should analyze intent
+    should_analyze_intent = st.session_state.response_mode == "auto"
+    # In fused mode the generation call itself returns the intent and the concise answer
+    use_fused = st.session_state.fused_generation
+    
+    # Read everything the background stages need from session state up front
+    rag_params = dict(st.session_state.rag_params)
+    image_params = dict(st.session_state.image_search_params)
+    intent_agent = st.session_state.intent_agent
+    intent_agent.set_classifier(get_intent_classifier())
+    intent_agent.set_cache(get_intent_cache())
+    st.session_state.concise_agent.set_mode(
+        st.session_state.concise_mode,
+        encoder=lambda texts: clusterer.model.encode(texts, show_progress_bar=False)
+    )
+    
+    def embed_query():
+        # Shared by retrieval and the local intent classifier through the clusterer's cache
+        return clusterer.encode_query(processed_query)
+    
+    def retrieve(embedding):
         # Use cached clustering function with parameters from session state including self-memory
-        clusters = get_query_clusters(
+        return get_query_clusters(
             clusterer, 
             processed_query, 
-            top_y=st.session_state.rag_params["top_y"],
-            top_k_self=st.session_state.rag_params["top_k_self"],
-            use_self_memory=st.session_state.rag_params["use_self_memory"]
+            top_y=rag_params["top_y"],
+            top_k_self=rag_params["top_k_self"],
+            use_self_memory=rag_params["use_self_memory"],
+            memory_version=clusterer.self_memory_version()
         )
+    
+    def analyze_intent(embedding):
+        return dict(intent_agent.determine_response_type(processed_query, embedding=embedding), query=processed_query)
+    
+    def find_images():
+        # Prefetched for the "View related images" button; failures must not break the turn
+        try:
+            engine = get_image_search_engine(image_params["embeddings_file"])
+            return engine.search(original_query, image_params["top_k"]) if engine else []
+        except Exception as e:
+            print(f"Image prefetch failed: {e}")
+            return None
+    
+    def generate_detailed(retrieval):
+        clusters = retrieval
         progress_bar.progress(20)
         
         # Store the clusters for displaying as sources
-        user_message_idx = len(st.session_state.chat_history) - 1
-        assistant_message_idx = user_message_idx + 1
         st.session_state.source_clusters[assistant_message_idx] = clusters
         
         # Check if any of the clusters is from self-memory
@@ -1063,13 +1427,7 @@ def process_query(clusterer, original_query, processed_query):
             st.session_state.source_memory[assistant_message_idx] = "self_memory"
         
         # Format clusters for context
-        context_text = ""
-        for i, cluster in enumerate(clusters):
-            source_type = cluster.get('source', 'clustered_db')
-            if source_type == 'self_memory':
-                context_text += f"Source {i+1} (Self Memory):\nPrevious Query: {cluster.get('original_query', 'Unknown')}\nContent: {cluster['content']}\n\n"
-            else:
-                context_text += f"Source {i+1}:\nTitle: {cluster['title']}\nLink: {cluster.get('link', 'N/A')}\nHeading: {cluster['heading']}\nContent: {cluster['content']}\n\n"
+        context_text = format_context(clusters)
             
         # Add context to user message
         user_message_with_context = f"USER: {processed_query}\n\nCONTEXT: {context_text}"
@@ -1077,137 +1435,193 @@ def process_query(clusterer, original_query, processed_query):
         
         progress_bar.progress(30)
         
-        # Create a cache key for this message
-        cache_key = hash_message(user_message_with_context)
+        if use_fused:
+            fused_cache_key = hash_message(f"{user_message_with_context}::FUSED")
+            if fused_cache_key not in st.session_state.cached_responses:
+                st.session_state.cached_responses[fused_cache_key] = st.session_state.debugger_agent.get_fused_response(user_message_with_context)
+            fused = st.session_state.cached_responses[fused_cache_key]
+            progress_bar.progress(60)
+            return {
+                "clusters": clusters,
+                "context_text": context_text,
+                "message": user_message_with_context,
+                "response": fused["detailed"],
+                "concise": fused["concise"],
+                "intent": {key: fused[key] for key in ("response_type", "confidence", "reasoning")}
+            }
         
-        # Determine if we should analyze intent
-        should_analyze_intent = st.session_state.response_mode == "auto"
+        # Generate detailed response
+        detailed_cache_key = hash_message(f"{user_message_with_context}::DETAILED")
+        if detailed_cache_key in st.session_state.cached_responses:
+            detailed_response = st.session_state.cached_responses[detailed_cache_key]
+        else:
+            # Stream the detailed response into the chat as it is generated, so the user
+            # sees the first tokens right away while the remaining steps run afterwards
+            stream_placeholder = st.empty()
+            with stream_placeholder.container():
+                st.markdown("<div class='message-header'>🤖 MATBot</div>", unsafe_allow_html=True)
+                detailed_response = st.write_stream(
+                    st.session_state.debugger_agent.stream_response(user_message_with_context)
+                )
+            if not isinstance(detailed_response, str):
+                detailed_response = "".join(str(chunk) for chunk in detailed_response)
+            st.session_state.cached_responses[detailed_cache_key] = detailed_response
+        
+        progress_bar.progress(60)
+        return {
+            "clusters": clusters,
+            "context_text": context_text,
+            "message": user_message_with_context,
+            "response": detailed_response
+        }
+    
+    def generate_concise(detailed, intent=None):
+        if detailed.get("concise"):
+            return detailed["concise"]
+        if intent is None and should_analyze_intent:
+            intent = detailed.get("intent")
+        concise_cache_key = hash_message(f"{detailed['message']}::CONCISE::{st.session_state.concise_mode}")
+        if concise_cache_key in st.session_state.cached_responses:
+            return st.session_state.cached_responses[concise_cache_key]
+        
+        shown_type = intent["response_type"].lower() if intent else st.session_state.response_mode
+        if shown_type != "concise" and st.session_state.concise_mode == "llm":
+            # The summary is only shown on request, so it is generated off the critical path
+            start_concise(assistant_message_idx, processed_query, detailed["response"], concise_cache_key)
+            return None
+        
+        # Process through concise agent
+        concise_response = st.session_state.concise_agent.get_concise_response(
+            processed_query, 
+            detailed["response"]
+        )
+        st.session_state.cached_responses[concise_cache_key] = concise_response
+        progress_bar.progress(80)
+        return concise_response
+    
+    # Retrieval, intent analysis and image search run concurrently; generation starts on
+    # this thread (it streams into the UI) as soon as retrieval is done
+    script_ctx = get_script_run_ctx()
+    graph = StageGraph(
+        max_workers=3,
+        on_thread_start=lambda: add_script_run_ctx(threading.current_thread(), script_ctx)
+    )
+    graph.add("embedding", embed_query)
+    graph.add("retrieval", retrieve, deps=("embedding",))
+    separate_intent = should_analyze_intent and not use_fused
+    if separate_intent:
+        graph.add("intent", analyze_intent, deps=("embedding",))
+    graph.add("images", find_images)
+    graph.add("detailed", generate_detailed, deps=("retrieval",), main_thread=True)
+    graph.add("concise", generate_concise, deps=("detailed", "intent") if separate_intent else ("detailed",), main_thread=True)
+    
+    with st.spinner("Fetching relevant documentation and generating responses..."):
+        stage_results = graph.run()
+        st.session_state.stage_timings[assistant_message_idx] = dict(graph.timings)
+        
+        clusters = stage_results["detailed"]["clusters"]
+        context_text = stage_results["detailed"]["context_text"]
+        user_message_with_context = stage_results["detailed"]["message"]
+        detailed_response = stage_results["detailed"]["response"]
+        concise_response = stage_results["concise"]
+        if stage_results["images"] is not None:
+            st.session_state.image_results[assistant_message_idx] = stage_results["images"]
         
-        # Rest of the existing processing code remains the same
         if should_analyze_intent:
-            with st.spinner("Analyzing query intent..."):
-                intent_result = st.session_state.intent_agent.determine_response_type(processed_query)
-                st.session_state.intent_analysis[assistant_message_idx] = intent_result
-                # Determine which response type to show based on intent analysis
-                response_type = intent_result["response_type"].lower()
-                progress_bar.progress(40)
+            if use_fused:
+                intent_result = dict(stage_results["detailed"]["intent"], query=processed_query)
+            else:
+                intent_result = stage_results["intent"]
+            # Determine which response type to show based on intent analysis
+            response_type = intent_result["response_type"].lower()
         else:
             response_type = st.session_state.response_mode
         
-        # Generate both concise and detailed responses for caching and display
-        with st.spinner("Generating responses..."):
-            # Generate detailed response
-            detailed_cache_key = hash_message(f"{user_message_with_context}::DETAILED")
-            if detailed_cache_key in st.session_state.cached_responses:
-                detailed_response = st.session_state.cached_responses[detailed_cache_key]
-            else:
-                # Generate detailed response
-                detailed_response = st.session_state.debugger_agent.get_response(user_message_with_context)
-                st.session_state.cached_responses[detailed_cache_key] = detailed_response
-            
-            progress_bar.progress(60)
-            
-            # Generate concise response
-            concise_cache_key = hash_message(f"{user_message_with_context}::CONCISE")
-            if concise_cache_key in st.session_state.cached_responses:
-                concise_response = st.session_state.cached_responses[concise_cache_key]
-            else:
-                # Process through concise agent
-                concise_response = st.session_state.concise_agent.get_concise_response(
-                    processed_query, 
-                    detailed_response
-                )
-                st.session_state.cached_responses[concise_cache_key] = concise_response
-                
-            progress_bar.progress(80)
-            
-            # Store both versions
-            st.session_state.alternative_versions[assistant_message_idx] = {
-                "detailed": detailed_response,
-                "concise": concise_response
+        # Store both versions (a deferred concise version is added once it is ready)
+        st.session_state.alternative_versions[assistant_message_idx] = {"detailed": detailed_response}
+        if concise_response is not None:
+            st.session_state.alternative_versions[assistant_message_idx]["concise"] = concise_response
+        
+        # Choose which one to display based on response_type
+        if response_type == "concise":
+            final_response = concise_response
+        else:  # detailed or any other value
+            final_response = detailed_response
+        
+        # Store the intent analysis for this assistant message using the assistant_message_idx
+        if should_analyze_intent:
+            st.session_state.intent_analysis[assistant_message_idx] = intent_result
+        elif st.session_state.response_mode == "concise":
+            # If manually set to concise, create a dummy intent result
+            st.session_state.intent_analysis[assistant_message_idx] = {
+                "response_type": "CONCISE",
+                "confidence": 1.0,
+                "reasoning": "User manually selected concise mode"
             }
+        else:
+            # If manually set to detailed, create a dummy intent result
+            st.session_state.intent_analysis[assistant_message_idx] = {
+                "response_type": "DETAILED",
+                "confidence": 1.0,
+                "reasoning": "User manually selected detailed mode"
+            }
+        
+        # Add response to chat history
+        st.session_state.chat_history.append({"role": "assistant", "content": final_response})
+        
+        # Evaluate the response in the background; the self-memory decision follows from
+        # the finished evaluation, so neither adds to the user-visible latency
+        use_self_memory = st.session_state.rag_params["use_self_memory"]
+        memory_threshold = st.session_state.rag_params["memory_threshold"]
+        ingestor = get_memory_ingestor(id(clusterer), clusterer)
+        heading = clusters[0].get('heading') if clusters else None
+        concise_future = st.session_state.pending_concise.get(assistant_message_idx, (None, None))[0]
+        
+        def add_to_self_memory(eval_data):
+            # Runs on the evaluation worker: no Streamlit calls here
+            if not use_self_memory:
+                return
+            quality_score = eval_data.get('score', 0)
             
-            # Choose which one to display based on response_type
-            if response_type == "concise":
-                final_response = concise_response
-            else:  # detailed or any other value
-                final_response = detailed_response
-            
-            # Store the intent analysis for this assistant message using the assistant_message_idx
-            if should_analyze_intent:
-                st.session_state.intent_analysis[assistant_message_idx] = intent_result
-            elif st.session_state.response_mode == "concise":
-                # If manually set to concise, create a dummy intent result
-                st.session_state.intent_analysis[assistant_message_idx] = {
-                    "response_type": "CONCISE",
-                    "confidence": 1.0,
-                    "reasoning": "User manually selected concise mode"
-                }
-            else:
-                # If manually set to detailed, create a dummy intent result
-                st.session_state.intent_analysis[assistant_message_idx] = {
-                    "response_type": "DETAILED",
-                    "confidence": 1.0,
-                    "reasoning": "User manually selected detailed mode"
-                }
-            
-            # Add response to chat history
-            st.session_state.chat_history.append({"role": "assistant", "content": final_response})
-            
-            # Evaluate the response
-            eval_data = evaluate_response(
-                user_message_with_context, 
-                final_response,
-                system_prompt=EVALUATOR_DEFAULT_PROMPT,
-                model=st.session_state.model_params["model"],
-                context=st.session_state.retrieved_context
-            )
-            
-            st.session_state.last_evaluation = eval_data
-            st.session_state.evaluation_history.append(eval_data)
-            
-            # Add to self-memory if quality is above threshold
-            if st.session_state.rag_params["use_self_memory"]:
-                quality_score = eval_data.get('score', 0)
-                memory_threshold = st.session_state.rag_params["memory_threshold"]
-                
-                # Debug statement for self-memory
-                print(f"Quality score: {quality_score}, Memory threshold: {memory_threshold}")
-                
-                # Check if response quality is high enough for self-memory
-                if quality_score >= memory_threshold:
-                    print(f"Adding to self-memory: {original_query}")
-                    memory_added = clusterer.add_to_self_memory(
-                        query=original_query,  # Use the original query, not the processed one
-                        context=context_text,
-                        output=final_response,
-                        score=quality_score
-                    )
-                    
-                    # Mark this message as added to self-memory
-                    st.session_state.memory_added[assistant_message_idx] = memory_added
-                    
-                    # Save updated self-memory to file
-                    if memory_added:
-                        try:
-                            # Create parent directory if it doesn't exist
-                            os.makedirs(os.path.dirname(SELF_MEMORY_FILE), exist_ok=True)
-                            
-                            # Debug statement for saving self-memory
-                            print(f"Saving self-memory to: {SELF_MEMORY_FILE}")
-                            success = clusterer.save_self_memory(SELF_MEMORY_FILE)
-                            print(f"Save result: {success}")
-                        except Exception as e:
-                            print(f"Error saving self-memory: {e}")
-                            st.error(f"Error saving self-memory: {e}")
-            
-            progress_bar.progress(100)
+            # Debug statement for self-memory
+            print(f"Quality score: {quality_score}, Memory threshold: {memory_threshold}")
             
-            # Use container update with properly formatted success message
-            placeholder = st.empty()
-            with placeholder.container():
-                st.success("Response generated successfully!")
-                time.sleep(0.5)
+            # Check if response quality is high enough for self-memory
+            if quality_score >= memory_threshold:
+                print(f"Queueing for self-memory: {original_query}")
+                concise = concise_response
+                if concise is None and concise_future is not None:
+                    # The deferred summary normally finishes well before the evaluation does
+                    try:
+                        concise = concise_future.result(timeout=60)
+                    except Exception:
+                        concise = None
+                # Embedding and persistence happen on the ingestion worker
+                eval_data["memory_added"] = ingestor.submit(
+                    query=original_query,  # Use the original query, not the processed one
+                    context=context_text,
+                    output=detailed_response,
+                    score=quality_score,
+                    heading=heading,
+                    concise=concise
+                )
+        
+        submit_evaluation(
+            assistant_message_idx,
+            user_message_with_context,
+            final_response,
+            context=st.session_state.retrieved_context,
+            on_done=add_to_self_memory
+        )
+        
+        progress_bar.progress(100)
+        answer_cache.record_pipeline_latency(time.time() - start_time)
+        
+        # Use container update with properly formatted success message
+        placeholder = st.empty()
+        with placeholder.container():
+            st.success("Response generated successfully!")
+            time.sleep(0.5)
 
 def main():
     render_header()
@@ -1216,7 +1630,8 @@ def main():
     clusterer = get_clusterer(
         n_clusters=st.session_state.rag_params["n_clusters"],
         num_closest_clusters=st.session_state.rag_params["num_closest_clusters"],
-        memory_file=SELF_MEMORY_FILE  # Add self-memory file path
+        memory_file=SELF_MEMORY_FILE,  # Add self-memory file path
+        memory_db=SELF_MEMORY_DB
     )
     
     # Initialize image search engine if needed
@@ -1234,7 +1649,8 @@ def main():
     
     # Left sidebar for evaluations
     with left_sidebar:
-        render_evaluation_sidebar()
+        with st.sidebar:
+            render_evaluation_sidebar()
         
         # Show intent analysis results always, not just in advanced mode
         if st.session_state.intent_analysis:
@@ -1244,10 +1660,35 @@ def main():
                     st.write(f"**Response Type:** {intent['response_type']}")
                     st.write(f"**Confidence:** {intent['confidence']:.2f}")
                     st.write(f"**Reasoning:** {intent['reasoning']}")
+        
+        # Answer cache effectiveness across all sessions
+        cache_stats = get_answer_cache(id(clusterer), clusterer).stats()
+        if cache_stats["lookups"]:
+            st.sidebar.markdown("<h3 class='sidebar-header'>Answer Cache</h3>", unsafe_allow_html=True)
+            st.sidebar.write(f"**Hit Rate:** {cache_stats['hit_rate']:.0%} ({cache_stats['hits']}/{cache_stats['lookups']})")
+            st.sidebar.write(f"**Time Saved:** {cache_stats['seconds_saved']:.1f}s")
+        
+        # Intent decisions reused across sessions
+        intent_cache = get_intent_cache()
+        if intent_cache.stats["lookups"]:
+            st.sidebar.markdown("<h3 class='sidebar-header'>Intent Cache</h3>", unsafe_allow_html=True)
+            st.sidebar.write(f"**Hit Rate:** {intent_cache.hit_rate():.0%} ({len(intent_cache)} decisions cached)")
+        
+        # Where the last full turn spent its time
+        if st.session_state.stage_timings:
+            last_idx = max(st.session_state.stage_timings)
+            timings = st.session_state.stage_timings[last_idx]
+            with st.sidebar.expander(f"Message #{last_idx//2 + 1} Stage Timings"):
+                for stage, timing in sorted(timings.items(), key=lambda item: item[1]["start"]):
+                    st.write(f"**{stage.capitalize()}:** {timing['seconds']:.2f}s (from {timing['start']:.2f}s, {timing['thread']})")
+                st.write(f"**Total:** {max(t['end'] for t in timings.values()):.2f}s")
     
     # Right sidebar for model parameters
     with right_sidebar:
         render_model_params_sidebar()
+    
+    # Keep this session's accumulated state within its limits
+    get_session_manager().trim(st.session_state)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
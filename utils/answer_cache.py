@@ -0,0 +1,80 @@
+import threading
+
+
+class AnswerCache:
+    """
+    Semantic answer cache in front of the generation pipeline.
+
+    A query whose nearest self-memory lies within max_distance (squared L2 between
+    normalized MiniLM embeddings, so 0.05 is roughly cosine similarity 0.975) is answered
+    with the remembered output and its concise version, skipping intent analysis,
+    generation, summarization and evaluation.
+    """
+
+    def __init__(self, clusterer, max_distance=0.05):
+        """
+        Args:
+            clusterer: RAGClusterer whose self-memory backs the cache
+            max_distance: Default distance below which a memory counts as a hit
+        """
+        self.clusterer = clusterer
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        self._lookups = 0
+        self._hits = 0
+        self._hit_seconds = 0.0
+        self._pipeline_seconds = 0.0
+        self._pipeline_runs = 0
+
+    def lookup(self, query, max_distance=None, record=True):
+        """
+        Find a remembered answer for the query.
+
+        Args:
+            query: The user's query
+            max_distance: Override the default hit threshold
+            record: Count this lookup in the hit-rate statistics
+
+        Returns:
+            The closest self-memory dict on a hit, otherwise None
+        """
+        if max_distance is None:
+            max_distance = self.max_distance
+
+        memories = self.clusterer.find_closest_self_memory(query, top_k=1)
+        hit = memories[0] if memories and memories[0]['distance'] <= max_distance else None
+
+        if record:
+            with self._lock:
+                self._lookups += 1
+                if hit:
+                    self._hits += 1
+        return hit
+
+    def record_hit_latency(self, seconds):
+        """Wall time spent serving a cache hit."""
+        with self._lock:
+            self._hit_seconds += seconds
+
+    def record_pipeline_latency(self, seconds):
+        """Wall time of a full pipeline run on a cache miss."""
+        with self._lock:
+            self._pipeline_seconds += seconds
+            self._pipeline_runs += 1
+
+    def stats(self):
+        """
+        Returns:
+            dict: lookups, hits, hit_rate and the estimated seconds saved, where each hit
+            is credited with the average miss latency minus its own serving time
+        """
+        with self._lock:
+            avg_pipeline = self._pipeline_seconds / self._pipeline_runs if self._pipeline_runs else 0.0
+            saved = max(0.0, self._hits * avg_pipeline - self._hit_seconds)
+            return {
+                "lookups": self._lookups,
+                "hits": self._hits,
+                "hit_rate": self._hits / self._lookups if self._lookups else 0.0,
+                "avg_pipeline_seconds": avg_pipeline,
+                "seconds_saved": saved
+            }
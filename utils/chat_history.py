@@ -0,0 +1,142 @@
+import os
+import concurrent.futures
+from utils import gemini_wrapper as gw
+from utils.llm_scheduler import estimate_tokens
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:"
+
+SUMMARY_SYSTEM_PROMPT = """
+You compress chat transcripts. Summarize the conversation you are given in a few sentences,
+keeping the user's goals, the code or errors discussed and any conclusions reached.
+Respond in JSON: {"summary": "..."}
+"""
+
+# Summaries are generated here, off the turn that dropped the history they cover
+_summary_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-summary")
+
+
+class ChatHistoryManager:
+    """
+    Keeps a chat session's resent history within a token budget.
+
+    Applied before every turn. Bulky per-turn payloads (such as the retrieved CONTEXT
+    block) are cut from earlier messages, since only the current turn needs them. The
+    oldest turns are then dropped, or folded into a running summary, until the history
+    fits max_tokens. The system prompt is held by the session itself and is never trimmed.
+
+    Summaries never delay a turn: dropped turns are summarized on a background thread and
+    the summary is pinned to the history on the first turn after it is ready. Until then,
+    or if summarizing fails, the dropped turns are simply left out.
+    """
+
+    def __init__(self, max_tokens=None, stale_markers=("CONTEXT:",), min_turns=2, summarize=None):
+        """
+        Args:
+            max_tokens: Token budget for the resent history; defaults to MATBOT_HISTORY_TOKENS
+            stale_markers: Text from any of these markers to the end of an earlier user
+                message is replaced by a placeholder
+            min_turns: Most recent turns that are never dropped
+            summarize: Fold dropped turns into a summary turn (one extra LLM call, run in
+                the background) instead of discarding them; defaults to MATBOT_HISTORY_SUMMARIZE=1
+        """
+        self.max_tokens = max_tokens or int(os.environ.get("MATBOT_HISTORY_TOKENS", 6000))
+        self.stale_markers = stale_markers
+        self.min_turns = min_turns
+        if summarize is None:
+            summarize = os.environ.get("MATBOT_HISTORY_SUMMARIZE", "0") == "1"
+        self.summarize = summarize
+        self.stats = {"stripped": 0, "dropped_turns": 0, "summaries": 0, "summary_errors": 0}
+        self._pending = None  # (Future of the summary turn, turns it covers)
+        self._backlog = []  # Dropped turns waiting for the next summary
+
+    def __getstate__(self):
+        # A running summary can't be pickled; its turns go back to the backlog instead
+        state = dict(self.__dict__)
+        if self._pending is not None:
+            state["_backlog"] = self._pending[1] + self._backlog
+        state["_pending"] = None
+        return state
+
+    @staticmethod
+    def _tokens(messages):
+        return estimate_tokens(*[m["content"] for m in messages])
+
+    @staticmethod
+    def _is_pinned(turn):
+        content = turn[0]["content"]
+        return content.startswith(SUMMARY_PREFIX)
+
+    def _strip(self, message):
+        content = message["content"]
+        for marker in self.stale_markers:
+            placeholder = f"{marker} [omitted from history]"
+            pos = content.find(marker)
+            if pos != -1 and not content.endswith(placeholder):
+                self.stats["stripped"] += 1
+                return dict(message, content=content[:pos] + placeholder)
+        return message
+
+    def _summarize(self, summary_turn, dropped):
+        transcript = ""
+        if summary_turn:
+            transcript += summary_turn[0]["content"] + "\n\n"
+        for user, model in dropped:
+            transcript += f"USER: {user['content']}\nASSISTANT: {model['content']}\n\n"
+
+        result = gw.universal_agent(transcript, SUMMARY_SYSTEM_PROMPT, priority=gw.PRIORITY_BACKGROUND, call_site="history_summary")
+        summary = result.get("summary", "") if isinstance(result, dict) else str(result)
+        self.stats["summaries"] += 1
+        return [
+            {"role": "user", "content": f"{SUMMARY_PREFIX} {summary}"},
+            {"role": "model", "content": "Understood."}
+        ]
+
+    def _collect_summary(self, summary_turn):
+        """
+        Returns:
+            list: The finished background summary turn, or summary_turn if none is ready
+        """
+        if self._pending is None or not self._pending[0].done():
+            return summary_turn
+        future, _ = self._pending
+        self._pending = None
+        try:
+            return future.result()
+        except Exception as e:
+            # Only the history shortening failed; those turns stay dropped
+            self.stats["summary_errors"] += 1
+            print(f"History summary failed: {e}")
+            return summary_turn
+
+    def trim(self, history):
+        """
+        Returns:
+            list: A new message list within the budget (the input is not modified)
+        """
+        turns = [history[i:i + 2] for i in range(0, len(history) - 1, 2)]
+        turns = [[self._strip(user), model] for user, model in turns]
+
+        summary_turn = next((turn for turn in turns if self._is_pinned(turn)), None)
+        recent = [turn for turn in turns if not self._is_pinned(turn)]
+
+        def flatten():
+            return (summary_turn or []) + [m for turn in recent for m in turn]
+
+        dropped = []
+        while len(recent) > self.min_turns and self._tokens(flatten()) > self.max_tokens:
+            dropped.append(recent.pop(0))
+        self.stats["dropped_turns"] += len(dropped)
+
+        if self.summarize:
+            summary_turn = self._collect_summary(summary_turn)
+            self._backlog.extend(dropped)
+            if self._backlog and self._pending is None:
+                backlog, self._backlog = self._backlog, []
+                self._pending = (_summary_executor.submit(self._summarize, summary_turn, backlog), backlog)
+        return flatten()
+
+    def apply(self, chat):
+        """Trim a chat session's history in place before its next turn."""
+        if chat is not None:
+            chat.history[:] = self.trim(chat.history)
+        return chat
@@ -0,0 +1,158 @@
+import re
+import numpy as np
+
+_FENCE = re.compile(r"^\s*(```|~~~)")
+_HEADING = re.compile(r"^\s*#{1,6}\s+\S")
+_BULLET = re.compile(r"^\s*([-*+]|\d+[.)])\s+\S")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+(?=[A-Z`*_\"'(\[])")
+
+
+def split_markdown(markdown):
+    """
+    Split a markdown answer into extractable units, in document order.
+
+    Fenced code blocks are single units and are never split. Headings, list items and
+    individual sentences of paragraphs are units of their own.
+
+    Returns:
+        list: dicts with kind ("code", "heading", "bullet" or "sentence"), text, and
+        block (index of the paragraph or list a unit belongs to, used to rejoin sentences)
+    """
+    units = []
+    block = -1
+    paragraph = []
+    lines = markdown.splitlines()
+    i = 0
+
+    def new_block():
+        nonlocal block
+        block += 1
+        return block
+
+    def flush_paragraph():
+        text = " ".join(line.strip() for line in paragraph).strip()
+        paragraph.clear()
+        if text:
+            current = new_block()
+            for sentence in _SENTENCE_END.split(text):
+                units.append({"kind": "sentence", "text": sentence.strip(), "block": current})
+
+    while i < len(lines):
+        line = lines[i]
+        fence = _FENCE.match(line)
+        if fence:
+            flush_paragraph()
+            code = [line]
+            i += 1
+            while i < len(lines):
+                code.append(lines[i])
+                i += 1
+                if lines[i - 1].strip().startswith(fence.group(1)):
+                    break
+            units.append({"kind": "code", "text": "\n".join(code), "block": new_block()})
+            continue
+
+        if not line.strip():
+            flush_paragraph()
+        elif _HEADING.match(line):
+            flush_paragraph()
+            units.append({"kind": "heading", "text": line.strip(), "block": new_block()})
+        elif _BULLET.match(line):
+            flush_paragraph()
+            if not units or units[-1]["kind"] != "bullet":
+                new_block()
+            units.append({"kind": "bullet", "text": line.rstrip(), "block": block})
+        elif paragraph or not units or units[-1]["kind"] != "bullet" or not line.startswith((" ", "\t")):
+            paragraph.append(line)
+        else:
+            # Indented continuation of a list item
+            units[-1]["text"] += " " + line.strip()
+        i += 1
+    flush_paragraph()
+    return units
+
+
+def _normalize(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-9)
+
+
+def extractive_summary(query, markdown, encode, ratio=0.5, min_chars=300, redundancy=0.9):
+    """
+    Shorten a markdown answer by keeping the units most similar to the query.
+
+    Sentences, list items and code blocks are ranked by cosine similarity of their
+    embeddings to the query, with a small bonus for code (usually the actual fix) and for
+    the opening sentence of each paragraph. Units are taken greedily until the length
+    budget is used up, skipping near-duplicates of units already taken, then emitted in
+    their original order with the headings of the sections they came from.
+
+    Args:
+        query: The user's question
+        markdown: The detailed answer
+        encode: Callable mapping a list of strings to an embedding matrix
+        ratio: Target length as a fraction of the answer
+        min_chars: Answers shorter than this are returned unchanged
+        redundancy: Cosine similarity above which a unit counts as a duplicate
+
+    Returns:
+        str: The summary in markdown
+    """
+    budget = max(min_chars, int(ratio * len(markdown)))
+    if len(markdown) <= budget:
+        return markdown
+
+    units = split_markdown(markdown)
+    candidates = [i for i, unit in enumerate(units) if unit["kind"] != "heading"]
+    if not candidates:
+        return markdown
+
+    embeddings = _normalize(encode([query] + [units[i]["text"] for i in candidates]))
+    query_emb, unit_embs = embeddings[0], embeddings[1:]
+    scores = unit_embs @ query_emb
+    for pos, i in enumerate(candidates):
+        if units[i]["kind"] == "code":
+            scores[pos] += 0.15
+        elif i == 0 or units[i - 1]["block"] != units[i]["block"]:
+            scores[pos] += 0.05
+
+    selected = []
+    used = 0
+    for pos in np.argsort(-scores):
+        length = len(units[candidates[pos]]["text"])
+        # The best code block is always kept whole, even if it alone exceeds the budget
+        is_first_code = units[candidates[pos]]["kind"] == "code" and not any(
+            units[candidates[p]]["kind"] == "code" for p in selected)
+        if used + length > budget and not is_first_code:
+            continue
+        if selected and float(np.max(unit_embs[selected] @ unit_embs[pos])) > redundancy:
+            continue
+        selected.append(pos)
+        used += length
+
+    keep = {candidates[pos] for pos in selected}
+    # Keep the heading of every section something was taken from
+    heading = None
+    for i, unit in enumerate(units):
+        if unit["kind"] == "heading":
+            heading = i
+        elif i in keep and heading is not None:
+            keep.add(heading)
+            heading = None
+
+    parts = []
+    for i in sorted(keep):
+        unit = units[i]
+        if unit["kind"] == "sentence" and parts and parts[-1][0] == ("sentence", unit["block"]):
+            parts[-1][1].append(unit["text"])
+        else:
+            parts.append(((unit["kind"], unit["block"]), [unit["text"]]))
+
+    out = []
+    for (kind, _), texts in parts:
+        text = " ".join(texts)
+        if out and not (kind == "bullet" and out[-1][0] == "bullet"):
+            out.append((None, ""))
+        out.append((kind, text))
+    return "\n".join(text for _, text in out)
@@ -1,135 +1,557 @@
 import os
 import json
+import asyncio
+import concurrent.futures
+import contextlib
+import threading
 from dotenv import load_dotenv
-from google import genai
-from google.genai import types
+from utils.llm_scheduler import (
+    RateLimitScheduler,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_BACKGROUND,
+    estimate_tokens,
+)
+from utils.llm_cache import LLMResponseCache, SingleFlight, cache_key
+from utils.llm_providers import get_provider, set_provider, get_client, get_async_client
+from utils.llm_metrics import LLMMetrics
+from utils.llm_hedge import HedgePolicy, hedged_call, ahedged_call
 
 load_dotenv()
 
+# Every LLM call in the process is admitted through this scheduler, which enforces the
+# provider quota, retries transient failures and lets interactive calls jump the queue.
+# The backend itself is chosen with MATBOT_LLM_PROVIDER (see utils/llm_providers.py).
+scheduler = RateLimitScheduler(
+    requests_per_minute=float(os.environ.get("GEMINI_RPM", 60)),
+    tokens_per_minute=float(os.environ.get("GEMINI_TPM", 1_000_000)),
+    max_retries=int(os.environ.get("GEMINI_MAX_RETRIES", 4)),
+)
+
+# Output tokens assumed per request until the real usage is known
+EXPECTED_OUTPUT_TOKENS = 512
+
+# Persistent response cache for deterministic helper calls, keyed by a hash of the model,
+# system prompt, normalized prompt and generation config. Only call sites listed here are
+# cached, each with its own time-to-live in seconds. Set MATBOT_LLM_CACHE=off to disable.
+CACHE_TTLS = {
+    "hyde": 7 * 24 * 3600,
+    "rrr": 7 * 24 * 3600,
+    "intent": 24 * 3600,
+    "ragas_statements": 30 * 24 * 3600,
+    "ragas_verify": 30 * 24 * 3600,
+    "ragas_faithfulness": 30 * 24 * 3600,
+    "ragas_questions": 30 * 24 * 3600,
+    "ragas_relevant": 30 * 24 * 3600,
+}
+LLM_CACHE_PATH = os.environ.get(
+    "MATBOT_LLM_CACHE",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "llm_cache.db")
+)
+LLM_CACHE_MAX_MB = float(os.environ.get("MATBOT_LLM_CACHE_MB", 64))
+
+_response_cache = None
+
+# Identical universal_agent requests in flight at the same time share one upstream call.
+# Chat calls are never coalesced because each chat carries its own history.
+single_flight = SingleFlight()
+
+# Per-call tokens, latency, retries and cache outcome for every wrapper call.
+# Set MATBOT_LLM_METRICS to a file path to also export each record as a JSONL line.
+metrics = LLMMetrics(export_path=os.environ.get("MATBOT_LLM_METRICS"))
+
+# Optional request hedging for interactive calls (MATBOT_HEDGE=1): a call slower than its
+# call site's latency percentile gets a duplicate, the first result wins
+hedging = HedgePolicy.from_env()
+
+_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Return the shared LLMResponseCache, or None if caching is disabled."""
+    global _response_cache
+    if LLM_CACHE_PATH.lower() in ("", "off", "none"):
+        return None
+    if _response_cache is None:
+        with _lock:
+            if _response_cache is None:
+                _response_cache = LLMResponseCache(LLM_CACHE_PATH, max_bytes=int(LLM_CACHE_MAX_MB * 1024 * 1024))
+    return _response_cache
+
+
+def _request_key(provider, model, system_prompt, input_message, cache_salt):
+    config = {"response_mime_type": "application/json", "provider": provider.name}
+    return cache_key(model, system_prompt, input_message, config, cache_salt)
+
+
+def _cache_lookup(call_site, key):
+    """
+    Returns:
+        tuple: (cache, cached value or None); cache is None when the call site isn't cached
+    """
+    if call_site not in CACHE_TTLS:
+        return None, None
+    cache = get_response_cache()
+    if cache is None:
+        return None, None
+    return cache, cache.get(key, call_site)
 
-def universal_agent(input_message: str, system_prompt: str = "You are a helpful assistant.", model: str = "gemini-2.0-flash"):
-    
-    client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
-
-    contents = [
-        types.Content(
-            role="user",
-            parts=[types.Part.from_text(text=input_message)],
-        ),
-    ]
-
-    generate_content_config = types.GenerateContentConfig(
-        response_mime_type="application/json",
-        system_instruction=system_prompt
-    )
-
-    response = client.models.generate_content(
-        model=model,
-        contents=contents,
-        config=generate_content_config,
-    )
 
+def _cache_store(cache, key, call_site, result):
+    # Only parsed JSON is cached; a raw string means the model broke format and may do better next time
+    if cache is not None and not isinstance(result, str):
+        cache.set(key, result, CACHE_TTLS[call_site], call_site)
+
+
+def _user_messages(input_message):
+    return [{"role": "user", "content": input_message}]
+
+
+def _parse_json_response(text):
     try:
-        return json.loads(response.text)
+        return json.loads(text)
     except json.JSONDecodeError as e:
         print("Failed to parse JSON response:", e)
-        return response.text
+        return text
+
+
+def _parse_chat_response(text):
+    # Chat turns are sent without a JSON response type unless json_output is set
+    # Just return the text response directly if it isn't JSON
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return text
+
+
+def _request_tokens(*texts):
+    return estimate_tokens(*texts) + EXPECTED_OUTPUT_TOKENS
+
+
+@contextlib.contextmanager
+def _metered(model, call_site, kind, provider):
+    """Open a metrics record for one wrapper call and close it when the call ends or fails."""
+    record = metrics.start(model, call_site, kind, provider.name)
+    try:
+        yield record
+    except GeneratorExit:
+        # The consumer closed a stream early (st.stop, a rerun, a break); that isn't a failure
+        record["abandoned"] = True
+        metrics.finish(record)
+        raise
+    except BaseException as e:
+        metrics.finish(record, e)
+        raise
+    metrics.finish(record)
 
 
-def stream_universal_agent(input_message: str, system_prompt: str = "You are a helpful assistant."):
+def _hedge(fn, priority, call_site, record, discard=None):
+    # Background work isn't latency-sensitive, so it never spends the hedge budget
+    if priority != PRIORITY_INTERACTIVE:
+        return fn()
+    return hedged_call(fn, hedging, call_site or "other", record, discard)
+
+
+async def _ahedge(coro_fn, priority, call_site, record):
+    if priority != PRIORITY_INTERACTIVE:
+        return await coro_fn()
+    return await ahedged_call(coro_fn, hedging, call_site or "other", record)
+
+
+def _record_usage(record, response, *prompt_texts):
+    record["prompt_tokens"] = response.prompt_tokens
+    record["output_tokens"] = response.output_tokens
+    if response.prompt_tokens is None:
+        record["prompt_tokens"] = estimate_tokens(*prompt_texts)
+        record["output_tokens"] = estimate_tokens(response.text)
+        record["tokens_estimated"] = True
+
+
+def _record_stream_usage(record, output_text, *prompt_texts):
+    # Streams don't report usage on every provider, so both sides are estimated
+    record["prompt_tokens"] = estimate_tokens(*prompt_texts)
+    record["output_tokens"] = estimate_tokens(output_text)
+    record["tokens_estimated"] = True
+
+
+def universal_agent(input_message: str, system_prompt: str = "You are a helpful assistant.", model: str = "gemini-2.0-flash", priority: int = PRIORITY_INTERACTIVE, call_site: str = None, cache_salt: str = None):
     
-    client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
-    model = "gemini-2.0-flash"
+    provider = get_provider()
+    with _metered(model, call_site, "generate", provider) as record:
+        key = _request_key(provider, model, system_prompt, input_message, cache_salt)
+        cache, cached = _cache_lookup(call_site, key)
+        if cached is not None:
+            record["cached"] = True
+            return cached
+
+        # Only the caller that leads the single-flight group runs generate()
+        record["coalesced"] = True
+
+        def generate():
+            record["coalesced"] = False
+            tokens = _request_tokens(input_message, system_prompt)
+
+            response = _hedge(
+                lambda: scheduler.call(
+                    lambda: provider.complete(model, system_prompt, _user_messages(input_message)),
+                    priority=priority,
+                    tokens=tokens,
+                    record=record
+                ),
+                priority, call_site, record
+            )
+            scheduler.settle(tokens, response.total_tokens)
+            _record_usage(record, response, input_message, system_prompt)
+
+            result = _parse_json_response(response.text)
+            _cache_store(cache, key, call_site, result)
+            return result
 
-    contents = [
-        types.Content(
-            role="user",
-            parts=[types.Part.from_text(text=input_message)],
-        ),
-    ]
+        return single_flight.do(key, generate)
 
-    generate_content_config = types.GenerateContentConfig(
-        response_mime_type="application/json",
-        system_instruction=system_prompt
-    )
 
-    response = client.models.generate_content_stream(
-        model=model,
-        contents=contents,
-        config=generate_content_config,
-    )
+def _open_stream(stream):
+    """Start a response stream and pull its first chunk, so connection and quota errors surface inside the retry loop."""
+    iterator = iter(stream)
+    return iterator, next(iterator, None)
 
-    full_response = ""
-    for chunk in response:
-        if chunk.text:
-            full_response += chunk.text
-            yield chunk.text
 
+def _iter_stream(iterator, first):
+    if first is not None:
+        yield first
+    yield from iterator
 
-def chat_agent(input_message: str, chat_history=None, system_prompt: str = "You are a helpful assistant.", model: str = "gemini-2.0-flash"):
 
-    client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
+def stream_universal_agent(input_message: str, system_prompt: str = "You are a helpful assistant.", priority: int = PRIORITY_INTERACTIVE, call_site: str = None):
     
+    provider = get_provider()
+    model = "gemini-2.0-flash"
+
+    with _metered(model, call_site, "stream", provider) as record:
+        # Hedging applies to the time to first chunk; a losing stream is closed
+        iterator, first = _hedge(
+            lambda: scheduler.call(
+                lambda: _open_stream(provider.complete_stream(model, system_prompt, _user_messages(input_message))),
+                priority=priority,
+                tokens=_request_tokens(input_message, system_prompt),
+                record=record
+            ),
+            priority, call_site, record,
+            discard=lambda opened: opened[0].close()
+        )
+
+        full_response = ""
+        try:
+            for chunk in _iter_stream(iterator, first):
+                if chunk:
+                    full_response += chunk
+                    yield chunk
+        finally:
+            # Whatever was streamed is billed, even if the consumer stopped reading early
+            _record_stream_usage(record, full_response, input_message, system_prompt)
+
+
+def _get_chat(chat_history, system_prompt, model):
+    if chat_history is not None:
+        return chat_history
+
+    # The system prompt travels as the native system instruction of every turn,
+    # so a new session costs no extra round-trip
+    return get_provider().create_chat(model, system_prompt)
+
+
+def create_chat(system_prompt: str = "You are a helpful assistant.", model: str = "gemini-2.0-flash"):
+    """Start a chat session up front, e.g. to stream its first reply with stream_chat_agent."""
+    return _get_chat(None, system_prompt, model)
+
+
+_warmed = set()
+
+
+def prewarm(model: str = "gemini-2.0-flash"):
+    """
+    Open the provider's pooled connection in the background, so the first request of a
+    session doesn't pay for the TLS handshake. Chat sessions themselves are local objects
+    and need no warming. Runs at most once per provider and model.
+    """
+    provider = get_provider()
+    with _lock:
+        if (provider.name, model) in _warmed:
+            return
+        _warmed.add((provider.name, model))
+    threading.Thread(target=provider.warm, args=(model,), name="llm-prewarm", daemon=True).start()
+
+
+def chat_agent(input_message: str, chat_history=None, system_prompt: str = "You are a helpful assistant.", model: str = "gemini-2.0-flash", priority: int = PRIORITY_INTERACTIVE, call_site: str = None, json_output: bool = False):
+
     # Create new chat or use existing one
-    if chat_history is None:
-        # Create a new chat session without system instruction
-        chat = client.chats.create(model=model)
-        
-        # Add system instruction as a separate message if provided
-        if system_prompt:
-            chat.send_message(f"System: {system_prompt}")
-    else:
-        chat = chat_history
+    chat = _get_chat(chat_history, system_prompt, model)
     
-    # Send message to the chat
-    response = chat.send_message(input_message)
+    with _metered(chat.model, call_site, "chat", chat.provider) as record:
+        # Each attempt runs on a copy of the chat, so retries and hedged duplicates never
+        # record a turn twice; the winning copy's history is adopted afterwards
+        tokens = _request_tokens(input_message)
+
+        def attempt():
+            session = chat.clone()
+            return session, scheduler.call(lambda: session.send_message(input_message, json_output=json_output), priority=priority, tokens=tokens, record=record)
+
+        session, response = _hedge(attempt, priority, call_site, record)
+        chat.history[:] = session.history
+        scheduler.settle(tokens, response.total_tokens)
+        _record_usage(record, response, input_message)
     
-    # Unlike generate_content, chat.send_message doesn't have response_mime_type
-    # Just return the text response directly
-    try:
-        parsed_json = json.loads(response.text)
-        return parsed_json, chat
-    except json.JSONDecodeError:
-        return response.text, chat
+    return _parse_chat_response(response.text), chat
 
 
-def stream_chat_agent(input_message: str, chat_history=None, system_prompt: str = "You are a helpful assistant."):
+def stream_chat_agent(input_message: str, chat_history=None, system_prompt: str = "You are a helpful assistant.", model: str = "gemini-2.0-flash", priority: int = PRIORITY_INTERACTIVE, call_site: str = None):
 
-    client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
-    
     # Create new chat or use existing one
-    if chat_history is None:
-        # Create a new chat session without system instruction
-        chat = client.chats.create(model="gemini-2.0-flash")
-        
-        # Add system instruction as a separate message if provided
-        if system_prompt:
-            chat.send_message(f"System: {system_prompt}")
-    else:
-        chat = chat_history
+    chat = _get_chat(chat_history, system_prompt, model)
     
-    # Send message and stream the response
-    response_stream = chat.send_message_streaming(input_message)
-    
-    full_response = ""
-    for chunk in response_stream:
-        if chunk.text:
-            full_response += chunk.text
-            yield chunk.text
+    with _metered(chat.model, call_site, "chat_stream", chat.provider) as record:
+        # Send message and stream the response on a copy of the chat (see chat_agent)
+        def attempt():
+            session = chat.clone()
+            iterator, first = scheduler.call(
+                lambda: _open_stream(session.send_message_stream(input_message)),
+                priority=priority,
+                tokens=_request_tokens(input_message),
+                record=record
+            )
+            return session, iterator, first
+
+        session, iterator, first = _hedge(attempt, priority, call_site, record, discard=lambda opened: opened[1].close())
+        
+        prompt_texts = [m["content"] for m in chat.history] + [input_message]
+        full_response = ""
+        try:
+            for chunk in _iter_stream(iterator, first):
+                if chunk:
+                    full_response += chunk
+                    yield chunk
+            chat.history[:] = session.history
+        finally:
+            _record_stream_usage(record, full_response, *prompt_texts)
     
     # Return the chat object after streaming is complete
     return chat
 
 
+async def _with_timeout(awaitable, timeout):
+    if timeout is None:
+        return await awaitable
+    return await asyncio.wait_for(awaitable, timeout)
+
+
+async def _aiter_with_deadline(iterator, timeout, first=None):
+    """Yield first (if any) then the rest of an async iterator, raising asyncio.TimeoutError once timeout seconds have passed."""
+    if first is not None:
+        yield first
+    if timeout is None:
+        async for chunk in iterator:
+            yield chunk
+        return
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            raise asyncio.TimeoutError()
+        try:
+            chunk = await asyncio.wait_for(iterator.__anext__(), remaining)
+        except StopAsyncIteration:
+            return
+        yield chunk
+
+
+async def _aopen_stream(stream):
+    """Async _open_stream: start an async stream and await its first chunk inside the retry loop."""
+    iterator = stream.__aiter__()
+    try:
+        first = await iterator.__anext__()
+    except StopAsyncIteration:
+        first = None
+    return iterator, first
+
+
+async def auniversal_agent(input_message: str, system_prompt: str = "You are a helpful assistant.", model: str = "gemini-2.0-flash", timeout: float = None, priority: int = PRIORITY_INTERACTIVE, call_site: str = None, cache_salt: str = None):
+    """
+    Async counterpart of universal_agent with the same JSON-parsing, caching and
+    coalescing behaviour. Raises asyncio.TimeoutError after timeout seconds;
+    cancelling the task aborts the request.
+    """
+    provider = get_provider()
+    with _metered(model, call_site, "generate", provider) as record:
+        key = _request_key(provider, model, system_prompt, input_message, cache_salt)
+        cache, cached = _cache_lookup(call_site, key)
+        if cached is not None:
+            record["cached"] = True
+            return cached
+
+        record["coalesced"] = True
+
+        async def generate():
+            record["coalesced"] = False
+            tokens = _request_tokens(input_message, system_prompt)
+
+            response = await _ahedge(
+                lambda: scheduler.acall(
+                    lambda: _with_timeout(
+                        provider.acomplete(model, system_prompt, _user_messages(input_message)),
+                        timeout
+                    ),
+                    priority=priority,
+                    tokens=tokens,
+                    record=record
+                ),
+                priority, call_site, record
+            )
+            scheduler.settle(tokens, response.total_tokens)
+            _record_usage(record, response, input_message, system_prompt)
+
+            result = _parse_json_response(response.text)
+            _cache_store(cache, key, call_site, result)
+            return result
+
+        return await single_flight.ado(key, generate)
+
+
+async def astream_universal_agent(input_message: str, system_prompt: str = "You are a helpful assistant.", model: str = "gemini-2.0-flash", timeout: float = None, priority: int = PRIORITY_INTERACTIVE, call_site: str = None):
+    """Async counterpart of stream_universal_agent; timeout bounds the whole stream."""
+    provider = get_provider()
+
+    with _metered(model, call_site, "stream", provider) as record:
+        iterator, first = await _ahedge(
+            lambda: scheduler.acall(
+                lambda: _with_timeout(
+                    _aopen_stream(provider.acomplete_stream(model, system_prompt, _user_messages(input_message))),
+                    timeout
+                ),
+                priority=priority,
+                tokens=_request_tokens(input_message, system_prompt),
+                record=record
+            ),
+            priority, call_site, record
+        )
+
+        full_response = ""
+        try:
+            async for chunk in _aiter_with_deadline(iterator, timeout, first):
+                if chunk:
+                    full_response += chunk
+                    yield chunk
+        finally:
+            # Whatever was streamed is billed, even if the consumer stopped reading early
+            _record_stream_usage(record, full_response, input_message, system_prompt)
+
+
+async def achat_agent(input_message: str, chat_history=None, system_prompt: str = "You are a helpful assistant.", model: str = "gemini-2.0-flash", timeout: float = None, priority: int = PRIORITY_INTERACTIVE, call_site: str = None, json_output: bool = False):
+    """
+    Async counterpart of chat_agent. Chat sessions are shared between the blocking and
+    async APIs, so chat_history may come from either.
+
+    Returns:
+        tuple: (parsed response, chat session)
+    """
+    chat = _get_chat(chat_history, system_prompt, model)
+
+    with _metered(chat.model, call_site, "chat", chat.provider) as record:
+        tokens = _request_tokens(input_message)
+
+        async def attempt():
+            session = chat.clone()
+            response = await scheduler.acall(
+                lambda: _with_timeout(session.asend_message(input_message, json_output=json_output), timeout),
+                priority=priority,
+                tokens=tokens,
+                record=record
+            )
+            return session, response
+
+        session, response = await _ahedge(attempt, priority, call_site, record)
+        chat.history[:] = session.history
+        scheduler.settle(tokens, response.total_tokens)
+        _record_usage(record, response, input_message)
+
+    return _parse_chat_response(response.text), chat
+
+
+async def astream_chat_agent(input_message: str, chat, timeout: float = None, priority: int = PRIORITY_INTERACTIVE, call_site: str = None):
+    """
+    Stream a reply on an existing chat session (create one with chat_agent, achat_agent
+    or get_provider().create_chat). The chat records the turn once the stream completes.
+    """
+    with _metered(chat.model, call_site, "chat_stream", chat.provider) as record:
+        async def attempt():
+            session = chat.clone()
+            iterator, first = await scheduler.acall(
+                lambda: _with_timeout(_aopen_stream(session.asend_message_stream(input_message)), timeout),
+                priority=priority,
+                tokens=_request_tokens(input_message),
+                record=record
+            )
+            return session, iterator, first
+
+        session, iterator, first = await _ahedge(attempt, priority, call_site, record)
+
+        prompt_texts = [m["content"] for m in chat.history] + [input_message]
+        full_response = ""
+        try:
+            async for chunk in _aiter_with_deadline(iterator, timeout, first):
+                if chunk:
+                    full_response += chunk
+                    yield chunk
+            chat.history[:] = session.history
+        finally:
+            _record_stream_usage(record, full_response, *prompt_texts)
+
+
+_loop_thread = None
+_loop = None
+
+
+def _background_loop():
+    """Event loop on a daemon thread, shared by every run_async call so async clients stay pooled."""
+    global _loop, _loop_thread
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_loop.run_forever, name="gemini-async-loop", daemon=True)
+            _loop_thread.start()
+    return _loop
+
+
+def run_async(coro, timeout: float = None):
+    """
+    Run a coroutine from blocking code and return its result, e.g. to fan out
+    independent calls with asyncio.gather:
+
+        async def both():
+            return await asyncio.gather(auniversal_agent(a), auniversal_agent(b))
+        first, second = run_async(both())
+
+    The coroutine runs on a shared background loop; if timeout expires it is cancelled.
+    """
+    loop = _background_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        raise RuntimeError("run_async cannot be called from the wrapper's own event loop; await the coroutine instead")
+
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
+
+
 def get_chat_history(chat_session):
 
-    history = []
-    for message in chat_session.get_history():
-        history.append({
-            "role": message.role,
-            "content": message.parts[0].text
-        })
-    return history
+    return [dict(message) for message in chat_session.get_history()]
 
 
 if __name__ == "__main__":
@@ -1,4 +1,4 @@
-from utils.gemini_wrapper import universal_agent
+from utils.gemini_wrapper import universal_agent, PRIORITY_BACKGROUND
 
 def hyde(user_query, model="gemini-2.0-flash"):
     """
@@ -22,7 +22,7 @@ def hyde(user_query, model="gemini-2.0-flash"):
     """
     
     system_prompt = "You are an expert technical assistant specializing in MATLAB and Simulink."
-    hypothetical_answer = universal_agent(hyde_prompt, system_prompt, model)
+    hypothetical_answer = universal_agent(hyde_prompt, system_prompt, model, priority=PRIORITY_BACKGROUND, call_site="hyde")
     
     # Handle both string and JSON responses
     if isinstance(hypothetical_answer, dict) and "answer" in hypothetical_answer:
@@ -50,7 +50,7 @@ def hyde(user_query, model="gemini-2.0-flash"):
 
     # Generate expanded query
     system_prompt = "You are a query expansion specialist working with MATLAB and Simulink documentation."
-    expansion_response = universal_agent(expansion_prompt, system_prompt, model)
+    expansion_response = universal_agent(expansion_prompt, system_prompt, model, priority=PRIORITY_BACKGROUND, call_site="hyde")
     
     # Parse the expanded query from the response
     if isinstance(expansion_response, dict) and "expanded_query" in expansion_response:
@@ -0,0 +1,118 @@
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+def intent_fingerprint(model, system_prompt):
+    """Identifies the configuration an intent decision was made with."""
+    return hashlib.sha256(f"{model}\n{system_prompt}".encode("utf-8")).hexdigest()[:16]
+
+
+class SemanticIntentCache:
+    """
+    Bounded intent-decision cache shared by every session.
+
+    Decisions are stored with the query's MiniLM embedding and reused for any later query
+    whose embedding lies within max_distance (squared L2 between normalized embeddings, as
+    in AnswerCache). Entries are scoped by a fingerprint of the intent model and system
+    prompt, so changing either never reuses decisions made under the old configuration.
+    Queries without an embedding fall back to exact matching. The least recently used
+    entry is evicted once max_entries is reached.
+    """
+
+    def __init__(self, max_entries=5000, max_distance=0.1):
+        """
+        Args:
+            max_entries: Maximum cached decisions across all fingerprints
+            max_distance: Nearest-neighbour distance below which a decision is reused
+        """
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self._entries = OrderedDict()  # (fingerprint, query) -> (slot, result)
+        self._slot_keys = [None] * max_entries
+        self._free = list(range(max_entries - 1, -1, -1))
+        self._embeddings = None  # (max_entries, dim) float32, allocated on first insert
+        self._fingerprints = np.full(max_entries, -1, dtype=np.int64)
+        self._fingerprint_ids = {}
+        self._lock = threading.Lock()
+        self.stats = {"lookups": 0, "exact_hits": 0, "semantic_hits": 0, "evictions": 0}
+
+    def _fingerprint_id(self, fingerprint):
+        return self._fingerprint_ids.setdefault(fingerprint, len(self._fingerprint_ids))
+
+    def get(self, fingerprint, query, embedding=None):
+        """
+        Returns:
+            dict: A copy of the cached decision, or None on a miss
+        """
+        with self._lock:
+            self.stats["lookups"] += 1
+            key = (fingerprint, query)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.stats["exact_hits"] += 1
+                return dict(self._entries[key][1])
+
+            if embedding is None or self._embeddings is None or fingerprint not in self._fingerprint_ids:
+                return None
+
+            candidates = np.flatnonzero(self._fingerprints == self._fingerprint_ids[fingerprint])
+            if not len(candidates):
+                return None
+            diffs = self._embeddings[candidates] - np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+            distances = np.einsum("ij,ij->i", diffs, diffs)
+            best = int(np.argmin(distances))
+            if distances[best] > self.max_distance:
+                return None
+
+            key = self._slot_keys[candidates[best]]
+            self._entries.move_to_end(key)
+            self.stats["semantic_hits"] += 1
+            return dict(self._entries[key][1])
+
+    def put(self, fingerprint, query, result, embedding=None):
+        """Cache a decision; without an embedding it can only be found by exact query."""
+        with self._lock:
+            key = (fingerprint, query)
+            if key in self._entries:
+                slot = self._entries.pop(key)[0]
+            else:
+                if not self._free:
+                    self._evict_oldest()
+                slot = self._free.pop()
+
+            self._entries[key] = (slot, dict(result))
+            self._slot_keys[slot] = key
+            if embedding is None:
+                self._fingerprints[slot] = -1
+                return
+            embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+            if self._embeddings is None:
+                self._embeddings = np.zeros((self.max_entries, embedding.shape[0]), dtype=np.float32)
+            self._embeddings[slot] = embedding
+            self._fingerprints[slot] = self._fingerprint_id(fingerprint)
+
+    def _evict_oldest(self):
+        _, (slot, _) = self._entries.popitem(last=False)
+        self._release(slot)
+        self.stats["evictions"] += 1
+
+    def _release(self, slot):
+        self._slot_keys[slot] = None
+        self._fingerprints[slot] = -1
+        self._free.append(slot)
+
+    def invalidate(self, fingerprint=None):
+        """Drop the decisions made under one fingerprint, or all of them."""
+        with self._lock:
+            for key in [key for key in self._entries if fingerprint is None or key[0] == fingerprint]:
+                self._release(self._entries.pop(key)[0])
+
+    def __len__(self):
+        return len(self._entries)
+
+    def hit_rate(self):
+        with self._lock:
+            hits = self.stats["exact_hits"] + self.stats["semantic_hits"]
+            return hits / self.stats["lookups"] if self.stats["lookups"] else 0.0
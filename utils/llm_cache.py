@@ -0,0 +1,263 @@
+import os
+import re
+import copy
+import asyncio
+import concurrent.futures
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+def normalize_prompt(prompt):
+    """Collapse whitespace so prompts built from indented f-strings hash identically."""
+    return re.sub(r"\s+", " ", prompt or "").strip()
+
+
+def cache_key(model, system_prompt, prompt, config=None, salt=None):
+    """
+    Stable hash of everything that determines an LLM response.
+
+    Args:
+        model: Model name
+        system_prompt: System instruction
+        prompt: User prompt (normalized before hashing)
+        config: JSON-serializable generation config
+        salt: Optional discriminator for call sites that deliberately repeat a prompt
+    """
+    payload = json.dumps(
+        [model, normalize_prompt(system_prompt), normalize_prompt(prompt), config, salt],
+        sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    Persistent LLM response cache shared by every session and replica on the host.
+
+    Entries are stored in SQLite with a per-entry expiry. When the stored size exceeds
+    max_bytes, the least recently used entries are evicted. Hit/miss counts are kept per
+    call site.
+    """
+
+    def __init__(self, db_path, max_bytes=64 * 1024 * 1024):
+        """
+        Args:
+            db_path: Path to the SQLite database file (created if missing)
+            max_bytes: Size budget for cached values before LRU eviction kicks in
+        """
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = {}  # call_site -> {"hits": n, "misses": n}
+
+        parent = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(parent, exist_ok=True)
+
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                call_site TEXT,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_access ON llm_cache (last_access)")
+        conn.commit()
+        self._total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30.0)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, call_site, outcome):
+        with self._lock:
+            site = self._stats.setdefault(call_site or "other", {"hits": 0, "misses": 0})
+            site[outcome] += 1
+
+    def get(self, key, call_site=None):
+        """
+        Returns:
+            The cached value, or None on a miss or an expired entry
+        """
+        now = time.time()
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT value FROM llm_cache WHERE key = ? AND expires_at > ?", (key, now)
+        ).fetchone()
+        if row is None:
+            self._count(call_site, "misses")
+            return None
+
+        with conn:
+            conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+        self._count(call_site, "hits")
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl, call_site=None):
+        """
+        Store a JSON-serializable value for ttl seconds.
+        """
+        data = json.dumps(value)
+        size = len(data.encode("utf-8"))
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            # Take the write lock before reading, so the replaced row's size can't change under us
+            conn.execute("BEGIN IMMEDIATE")
+            old = conn.execute("SELECT size FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, call_site, value, size, created_at, expires_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, call_site, data, size, now, now + ttl, now)
+            )
+        with self._lock:
+            # A refreshed key only adds the difference to the stored size
+            self._total_bytes += size - (old[0] if old else 0)
+            over_budget = self._total_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def evict(self):
+        """Drop expired entries, then least recently used ones until under 90% of max_bytes."""
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (time.time(),))
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+            target = int(self.max_bytes * 0.9)
+            if total > target:
+                # Walk entries oldest-access first and delete until enough bytes are freed
+                freed = 0
+                doomed = []
+                for key, size in conn.execute("SELECT key, size FROM llm_cache ORDER BY last_access"):
+                    doomed.append((key,))
+                    freed += size
+                    if total - freed <= target:
+                        break
+                conn.executemany("DELETE FROM llm_cache WHERE key = ?", doomed)
+                total -= freed
+        with self._lock:
+            self._total_bytes = total
+
+    def stats(self):
+        """
+        Returns:
+            dict: Per call site hits, misses and hit_rate, plus entry count and stored bytes
+        """
+        with self._lock:
+            sites = {
+                site: dict(counts, hit_rate=counts["hits"] / (counts["hits"] + counts["misses"]))
+                for site, counts in self._stats.items()
+            }
+            total_bytes = self._total_bytes
+        entries = self._connect().execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        return {"call_sites": sites, "entries": entries, "bytes": total_bytes}
+
+
+class _LeaderAbandoned(Exception):
+    """Set on a SingleFlight future when its leader stopped for a reason local to itself."""
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent requests.
+
+    The first caller for a key runs the request; callers arriving while it is in flight
+    wait for the same result instead of issuing their own upstream call. Works across
+    threads and event loops because the shared result is a concurrent.futures.Future.
+    Followers receive a deep copy so callers can mutate their result safely.
+
+    Only results and provider errors are shared. If the leader is cancelled or runs into
+    its own timeout, its followers don't inherit that: one of them retries as the new leader.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {}  # key -> concurrent.futures.Future
+        self.stats = {"leaders": 0, "coalesced": 0, "retried": 0}
+
+    def _join(self, key):
+        """Returns (future, is_leader)."""
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.stats["coalesced"] += 1
+                return future, False
+            future = concurrent.futures.Future()
+            self._inflight[key] = future
+            self.stats["leaders"] += 1
+            return future, True
+
+    def _finish(self, key):
+        with self._lock:
+            self._inflight.pop(key, None)
+
+    @staticmethod
+    def _is_leader_local(e):
+        # Cancellation, interpreter exits and the leader's own timeout/hedge deadline
+        return not isinstance(e, Exception) or isinstance(e, TimeoutError)
+
+    def _fail(self, key, future, e):
+        # Unregister first, so a retrying follower starts a fresh flight
+        self._finish(key)
+        future.set_exception(_LeaderAbandoned() if self._is_leader_local(e) else e)
+
+    def _succeed(self, key, future, result):
+        self._finish(key)
+        # Followers copy from a private snapshot, so the leader may mutate its own result
+        future.set_result(copy.deepcopy(result))
+
+    def _retry(self):
+        with self._lock:
+            self.stats["retried"] += 1
+
+    def do(self, key, fn):
+        """Run fn() once per key among concurrent callers and return its result."""
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                break
+            try:
+                return copy.deepcopy(future.result())
+            except (_LeaderAbandoned, concurrent.futures.CancelledError):
+                self._retry()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            self._fail(key, future, e)
+            raise
+        self._succeed(key, future, result)
+        return result
+
+    async def ado(self, key, coro_fn):
+        """Async do(): coro_fn is a zero-argument function returning a fresh coroutine."""
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                break
+            try:
+                # Shielded: cancelling this follower must not cancel the shared future
+                return copy.deepcopy(await asyncio.shield(asyncio.wrap_future(future)))
+            except _LeaderAbandoned:
+                self._retry()
+
+        try:
+            result = await coro_fn()
+        except BaseException as e:
+            self._fail(key, future, e)
+            raise
+        self._succeed(key, future, result)
+        return result
@@ -0,0 +1,204 @@
+import os
+import asyncio
+import threading
+import time
+import concurrent.futures
+from collections import deque
+
+
+class HedgePolicy:
+    """
+    Decides when to hedge a slow LLM call.
+
+    The hedge deadline for a call site is a high percentile of its recent latencies: if
+    the first attempt hasn't finished by then, a duplicate is sent and the first result
+    wins. Latencies are those of first attempts, losers included, so hedging doesn't
+    pull the deadline down. A budget caps duplicates at a fraction of all hedgeable calls, so the extra
+    load stays small. Call sites without enough latency samples are never hedged.
+    """
+
+    def __init__(self, enabled=False, percentile=0.95, budget=0.05, min_samples=20,
+                 min_delay=0.3, window=200):
+        """
+        Args:
+            enabled: Master switch
+            percentile: Latency percentile used as the hedge deadline
+            budget: Maximum hedges as a fraction of hedgeable calls
+            min_samples: Latency samples a call site needs before it is hedged
+            min_delay: Lower bound for the deadline in seconds
+            window: Recent latencies kept per call site
+        """
+        self.enabled = enabled
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.window = window
+        self._latencies = {}  # call_site -> deque of seconds
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "hedged": 0, "hedge_wins": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            enabled=os.environ.get("MATBOT_HEDGE", "0") == "1",
+            percentile=float(os.environ.get("MATBOT_HEDGE_PERCENTILE", 0.95)),
+            budget=float(os.environ.get("MATBOT_HEDGE_BUDGET", 0.05)),
+            min_delay=float(os.environ.get("MATBOT_HEDGE_MIN_DELAY", 0.3)),
+        )
+
+    def observe(self, call_site, seconds):
+        with self._lock:
+            self._latencies.setdefault(call_site, deque(maxlen=self.window)).append(seconds)
+
+    def delay(self, call_site):
+        """Seconds to wait before hedging this call, or None to not hedge it."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            self.stats["calls"] += 1
+            samples = self._latencies.get(call_site)
+            if not samples or len(samples) < self.min_samples:
+                return None
+            ordered = sorted(samples)
+        return max(self.min_delay, ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))])
+
+    def try_spend(self):
+        """Take one hedge from the budget; False if the budget is used up."""
+        with self._lock:
+            if self.stats["hedged"] + 1 > self.budget * self.stats["calls"]:
+                return False
+            self.stats["hedged"] += 1
+            return True
+
+    def won_by_hedge(self):
+        with self._lock:
+            self.stats["hedge_wins"] += 1
+
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix="llm-hedge")
+
+
+def _timed(fn, running=None):
+    if running is not None:
+        running.set()
+    started = time.perf_counter()
+    return fn(), time.perf_counter() - started
+
+
+def _observe_when_done(future, policy, call_site):
+    """Record a first attempt's latency whenever it finishes, whether it won or not."""
+    def callback(f):
+        if not f.cancelled() and f.exception() is None:
+            policy.observe(call_site, f.result()[1])
+    future.add_done_callback(callback)
+
+
+def _discard_when_done(future, discard):
+    def callback(f):
+        if not f.cancelled() and f.exception() is None:
+            discard(f.result()[0])
+    future.add_done_callback(callback)
+
+
+def hedged_call(fn, policy, call_site, record=None, discard=None):
+    """
+    Run fn(), sending a duplicate if it is slower than the call site's hedge deadline.
+
+    Blocking threads can't be interrupted, so a losing attempt runs to completion in the
+    background and its result is passed to discard (e.g. to close a stream).
+
+    Args:
+        fn: Zero-argument callable performing one request; must be safe to run twice
+        policy: HedgePolicy
+        call_site: Call site whose latency history sets the deadline
+        record: Optional metrics record; gets hedged=True when a duplicate is sent
+        discard: Optional callable receiving a losing attempt's result
+    """
+    delay = policy.delay(call_site)
+    if delay is None:
+        result, seconds = _timed(fn)
+        policy.observe(call_site, seconds)
+        return result
+
+    running = threading.Event()
+    primary = _executor.submit(_timed, fn, running)
+    _observe_when_done(primary, policy, call_site)
+    # The deadline runs from when the attempt starts, not while it waits for a pool thread
+    running.wait()
+    done, _ = concurrent.futures.wait([primary], timeout=delay)
+    if done or not policy.try_spend():
+        return primary.result()[0]
+
+    if record is not None:
+        record["hedged"] = True
+    hedge = _executor.submit(_timed, fn)
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None:
+                error = error or future.exception()
+                continue
+            result = future.result()[0]
+            if future is hedge:
+                policy.won_by_hedge()
+            if discard is not None:
+                for loser in pending:
+                    _discard_when_done(loser, discard)
+            return result
+    raise error
+
+
+async def _atimed(coro_fn):
+    started = time.perf_counter()
+    result = await coro_fn()
+    return result, time.perf_counter() - started
+
+
+async def ahedged_call(coro_fn, policy, call_site, record=None):
+    """
+    Async hedged_call(): coro_fn is a zero-argument function returning a fresh coroutine.
+    The losing attempt is cancelled.
+    """
+    delay = policy.delay(call_site)
+    if delay is None:
+        result, seconds = await _atimed(coro_fn)
+        policy.observe(call_site, seconds)
+        return result
+
+    primary_started = time.perf_counter()
+    primary = asyncio.ensure_future(_atimed(coro_fn))
+    pending = {primary}
+    hedge = None
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if not done and policy.try_spend():
+            if record is not None:
+                record["hedged"] = True
+            hedge = asyncio.ensure_future(_atimed(coro_fn))
+            pending.add(hedge)
+
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = error or task.exception()
+                    continue
+                result, seconds = task.result()
+                if task is hedge:
+                    policy.won_by_hedge()
+                else:
+                    policy.observe(call_site, seconds)
+                return result
+        raise error
+    finally:
+        if not primary.done():
+            # A cancelled first attempt took at least this long; recording it as a lower
+            # bound keeps the deadline from drifting down
+            primary.cancel()
+            policy.observe(call_site, time.perf_counter() - primary_started)
+        if hedge is not None and not hedge.done():
+            hedge.cancel()
@@ -0,0 +1,143 @@
+import sys
+import json
+import time
+import threading
+from collections import deque
+
+# USD per million (input, output) tokens, used for cost estimates
+MODEL_PRICES = {
+    "gemini-2.0-flash": (0.10, 0.40),
+    "gemini-1.5-flash": (0.075, 0.30),
+    "gemini-pro": (0.50, 1.50),
+}
+
+
+def estimate_cost(model, prompt_tokens, output_tokens):
+    """Estimated USD cost of one call, or 0.0 for models without a known price."""
+    input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return ((prompt_tokens or 0) * input_price + (output_tokens or 0) * output_price) / 1_000_000
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class LLMMetrics:
+    """
+    In-process registry of per-call LLM metrics.
+
+    Every wrapper call produces one record: model, call site, kind (generate, stream or
+    chat), prompt and output tokens, wall latency, seconds queued by the rate limiter,
+    retries, whether it was served from the response cache or coalesced onto an
+    identical in-flight call, whether a hedged duplicate was sent, and whether a stream
+    was abandoned by its consumer before it finished. Records are kept
+    in a bounded ring and, if export_path is set, appended to a JSONL file.
+    """
+
+    def __init__(self, export_path=None, max_records=10000):
+        """
+        Args:
+            export_path: JSONL file every record is appended to (None disables export)
+            max_records: Records kept in memory for summary()
+        """
+        self.export_path = export_path
+        self._records = deque(maxlen=max_records)
+        self._lock = threading.Lock()
+
+    def start(self, model, call_site, kind, provider=None):
+        """
+        Open a record for one call. The wrapper and scheduler fill it in, then pass it to finish().
+        """
+        return {
+            "ts": time.time(),
+            "model": model,
+            "call_site": call_site or "other",
+            "kind": kind,
+            "provider": provider,
+            "prompt_tokens": None,
+            "output_tokens": None,
+            "tokens_estimated": False,
+            "latency": None,
+            "queued_seconds": 0.0,
+            "retries": 0,
+            "cached": False,
+            "coalesced": False,
+            "hedged": False,
+            "abandoned": False,
+            "error": None,
+            "_started": time.perf_counter(),
+        }
+
+    def finish(self, record, error=None):
+        record["latency"] = time.perf_counter() - record.pop("_started")
+        if error is not None:
+            record["error"] = type(error).__name__
+        record["cost"] = estimate_cost(record["model"], record["prompt_tokens"], record["output_tokens"])
+
+        with self._lock:
+            self._records.append(record)
+            if self.export_path:
+                with open(self.export_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record) + "\n")
+
+    def records(self):
+        with self._lock:
+            return list(self._records)
+
+    def summary(self, records=None):
+        """
+        Aggregate records by call site.
+
+        Returns:
+            dict: call_site -> calls, cached, coalesced, hedged, abandoned, errors, retries,
+            prompt_tokens, output_tokens, cost, total_latency, p50_latency and p95_latency.
+            Abandoned streams count towards tokens and cost but not latency, which they
+            measure the consumer rather than the provider.
+        """
+        if records is None:
+            records = self.records()
+
+        grouped = {}
+        for record in records:
+            grouped.setdefault(record["call_site"], []).append(record)
+
+        summary = {}
+        for site, site_records in grouped.items():
+            upstream = [r for r in site_records if not r["cached"] and not r["coalesced"]]
+            latencies = [r["latency"] for r in upstream if not r.get("abandoned")]
+            summary[site] = {
+                "calls": len(site_records),
+                "cached": sum(r["cached"] for r in site_records),
+                "coalesced": sum(r["coalesced"] for r in site_records),
+                "hedged": sum(r.get("hedged", False) for r in site_records),
+                "abandoned": sum(r.get("abandoned", False) for r in site_records),
+                "errors": sum(1 for r in site_records if r["error"]),
+                "retries": sum(r["retries"] for r in site_records),
+                "prompt_tokens": sum(r["prompt_tokens"] or 0 for r in upstream),
+                "output_tokens": sum(r["output_tokens"] or 0 for r in upstream),
+                "cost": sum(r.get("cost", 0.0) for r in upstream),
+                "total_latency": sum(latencies),
+                "p50_latency": _percentile(latencies, 0.5),
+                "p95_latency": _percentile(latencies, 0.95),
+            }
+        return summary
+
+
+def load_records(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    # Usage: python -m utils.llm_metrics llm_metrics.jsonl
+    summary = LLMMetrics().summary(load_records(sys.argv[1]))
+    header = f"{'call site':<20}{'calls':>7}{'cached':>8}{'coal.':>7}{'hedged':>8}{'retries':>9}{'in tok':>10}{'out tok':>10}{'cost $':>10}{'total s':>10}{'p50 s':>8}{'p95 s':>8}"
+    print(header)
+    print("-" * len(header))
+    for site, s in sorted(summary.items(), key=lambda item: -item[1]["total_latency"]):
+        print(f"{site:<20}{s['calls']:>7}{s['cached']:>8}{s['coalesced']:>7}{s['hedged']:>8}{s['retries']:>9}"
+              f"{s['prompt_tokens']:>10}{s['output_tokens']:>10}{s['cost']:>10.4f}"
+              f"{s['total_latency']:>10.1f}{s['p50_latency']:>8.2f}{s['p95_latency']:>8.2f}")
@@ -0,0 +1,589 @@
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+import httpx
+from google import genai
+from google.genai import types
+from utils.llm_scheduler import estimate_tokens
+
+
+class LLMResponse:
+    """Provider-neutral response: the generated text plus token usage when the provider reports it."""
+
+    def __init__(self, text, prompt_tokens=None, output_tokens=None):
+        self.text = text
+        self.prompt_tokens = prompt_tokens
+        self.output_tokens = output_tokens
+
+    @property
+    def total_tokens(self):
+        if self.prompt_tokens is None and self.output_tokens is None:
+            return None
+        return (self.prompt_tokens or 0) + (self.output_tokens or 0)
+
+
+class ChatSession:
+    """
+    Multi-turn chat kept as a plain list of {"role": "user"|"model", "content": str} messages.
+
+    Every provider serves chats through this class, so chat state is independent of any SDK:
+    the full history is sent with each turn (as the Gemini SDK's own chat does) and a turn
+    is only recorded once its reply has completed, which keeps retries safe.
+    """
+
+    def __init__(self, provider, model, system_prompt=None, history=None):
+        self.provider = provider
+        self.model = model
+        self.system_prompt = system_prompt
+        self.history = [dict(m) for m in history] if history else []
+
+    def __getstate__(self):
+        # Providers hold SDK clients; a restored session uses the process-wide provider
+        state = dict(self.__dict__)
+        state["provider"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.provider = get_provider()
+
+    def _messages(self, message):
+        return self.history + [{"role": "user", "content": message}]
+
+    def _record(self, message, reply):
+        self.history.append({"role": "user", "content": message})
+        self.history.append({"role": "model", "content": reply})
+
+    def send_message(self, message, json_output=False):
+        response = self.provider.complete(self.model, self.system_prompt, self._messages(message), json_output)
+        self._record(message, response.text)
+        return response
+
+    def send_message_stream(self, message, json_output=False):
+        chunks = []
+        for chunk in self.provider.complete_stream(self.model, self.system_prompt, self._messages(message), json_output):
+            chunks.append(chunk)
+            yield chunk
+        self._record(message, "".join(chunks))
+
+    async def asend_message(self, message, json_output=False):
+        response = await self.provider.acomplete(self.model, self.system_prompt, self._messages(message), json_output)
+        self._record(message, response.text)
+        return response
+
+    async def asend_message_stream(self, message, json_output=False):
+        chunks = []
+        async for chunk in self.provider.acomplete_stream(self.model, self.system_prompt, self._messages(message), json_output):
+            chunks.append(chunk)
+            yield chunk
+        self._record(message, "".join(chunks))
+
+    def get_history(self):
+        return self.history
+
+    def clone(self):
+        """Independent copy of the session, e.g. for a duplicate (hedged) request."""
+        return ChatSession(self.provider, self.model, self.system_prompt, self.history)
+
+
+class LLMProvider:
+    """
+    Interface every LLM backend implements. messages is a list of
+    {"role": "user"|"model", "content": str}; json_output asks for a JSON response.
+    """
+
+    name = "base"
+
+    def complete(self, model, system_prompt, messages, json_output=True):
+        """Return an LLMResponse."""
+        raise NotImplementedError
+
+    def complete_stream(self, model, system_prompt, messages, json_output=True):
+        """Yield text chunks."""
+        raise NotImplementedError
+
+    async def acomplete(self, model, system_prompt, messages, json_output=True):
+        raise NotImplementedError
+
+    async def acomplete_stream(self, model, system_prompt, messages, json_output=True):
+        raise NotImplementedError
+        yield
+
+    def create_chat(self, model, system_prompt=None, history=None):
+        return ChatSession(self, model, system_prompt, history)
+
+    def warm(self, model):
+        """Open connections ahead of the first request; failures are ignored."""
+
+
+# Connection pool shared by every call made through one client. Keep-alive lets the
+# ~10 LLM calls of a chat turn reuse a warm TLS connection instead of handshaking each time.
+HTTP_POOL_LIMITS = {
+    "max_connections": int(os.environ.get("GEMINI_MAX_CONNECTIONS", 32)),
+    "max_keepalive_connections": int(os.environ.get("GEMINI_MAX_KEEPALIVE", 16)),
+    "keepalive_expiry": float(os.environ.get("GEMINI_KEEPALIVE_EXPIRY", 120)),
+}
+
+_clients = {}  # api_key -> genai.Client
+_async_clients = weakref.WeakKeyDictionary()  # event loop -> {api_key: genai.Client}
+_clients_lock = threading.Lock()
+
+
+def _new_client(api_key):
+    http_options = types.HttpOptions(
+        client_args={"limits": httpx.Limits(**HTTP_POOL_LIMITS)},
+        async_client_args={"limits": httpx.Limits(**HTTP_POOL_LIMITS)},
+    )
+    return genai.Client(api_key=api_key, http_options=http_options)
+
+
+def get_client(api_key=None):
+    """
+    Return the process-wide Gemini client for an API key, creating it on first use.
+    The client (and its pooled HTTP connections) is shared by all threads.
+
+    Args:
+        api_key: Gemini API key; defaults to the GEMINI_API_KEY environment variable
+    """
+    api_key = api_key or os.environ.get("GEMINI_API_KEY")
+    client = _clients.get(api_key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(api_key)
+            if client is None:
+                client = _new_client(api_key)
+                _clients[api_key] = client
+    return client
+
+
+def get_async_client(api_key=None):
+    """
+    Return the async (client.aio) surface for the running event loop.
+
+    Async HTTP connections are bound to the loop that opened them, so async clients are
+    pooled per event loop and dropped together with it. Must be called from a coroutine.
+    """
+    api_key = api_key or os.environ.get("GEMINI_API_KEY")
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        loop_clients = _async_clients.setdefault(loop, {})
+        client = loop_clients.get(api_key)
+        if client is None:
+            client = _new_client(api_key)
+            loop_clients[api_key] = client
+    return client.aio
+
+
+class GeminiProvider(LLMProvider):
+    """Google Gemini through the pooled genai clients."""
+
+    name = "gemini"
+
+    def _request(self, system_prompt, messages, json_output):
+        contents = [
+            types.Content(role=m["role"], parts=[types.Part.from_text(text=m["content"])])
+            for m in messages
+        ]
+        config = types.GenerateContentConfig(
+            response_mime_type="application/json" if json_output else None,
+            system_instruction=system_prompt or None
+        )
+        return contents, config
+
+    @staticmethod
+    def _response(response):
+        usage = getattr(response, "usage_metadata", None)
+        return LLMResponse(
+            response.text,
+            prompt_tokens=getattr(usage, "prompt_token_count", None),
+            output_tokens=getattr(usage, "candidates_token_count", None)
+        )
+
+    def warm(self, model):
+        try:
+            get_client().models.get(model=model)
+        except Exception as e:
+            print(f"Failed to warm Gemini connection: {e}")
+
+    def complete(self, model, system_prompt, messages, json_output=True):
+        contents, config = self._request(system_prompt, messages, json_output)
+        response = get_client().models.generate_content(model=model, contents=contents, config=config)
+        return self._response(response)
+
+    def complete_stream(self, model, system_prompt, messages, json_output=True):
+        contents, config = self._request(system_prompt, messages, json_output)
+        for chunk in get_client().models.generate_content_stream(model=model, contents=contents, config=config):
+            if chunk.text:
+                yield chunk.text
+
+    async def acomplete(self, model, system_prompt, messages, json_output=True):
+        contents, config = self._request(system_prompt, messages, json_output)
+        response = await get_async_client().models.generate_content(model=model, contents=contents, config=config)
+        return self._response(response)
+
+    async def acomplete_stream(self, model, system_prompt, messages, json_output=True):
+        contents, config = self._request(system_prompt, messages, json_output)
+        stream = await get_async_client().models.generate_content_stream(model=model, contents=contents, config=config)
+        async for chunk in stream:
+            if chunk.text:
+                yield chunk.text
+
+
+class GroqProvider(LLMProvider):
+    """
+    Groq chat completions. Gemini model names used across the app are mapped to GROQ_MODEL,
+    since Groq serves different models.
+    """
+
+    name = "groq"
+
+    def __init__(self, api_key=None, default_model=None):
+        import groq
+
+        api_key = api_key or os.environ.get("GROQ_API_KEY")
+        self.default_model = default_model or os.environ.get("GROQ_MODEL", "llama-3.3-70b-versatile")
+        self.client = groq.Groq(api_key=api_key)
+        self.async_client = groq.AsyncGroq(api_key=api_key)
+
+    def _request(self, model, system_prompt, messages, json_output):
+        if not model or model.startswith("gemini"):
+            model = self.default_model
+        groq_messages = []
+        if system_prompt or json_output:
+            # Groq's JSON mode requires the word "JSON" to appear in the prompt
+            system = (system_prompt or "") + ("\nRespond in JSON." if json_output else "")
+            groq_messages.append({"role": "system", "content": system.strip()})
+        for m in messages:
+            groq_messages.append({"role": "assistant" if m["role"] == "model" else "user", "content": m["content"]})
+
+        request = {"model": model, "messages": groq_messages}
+        if json_output:
+            request["response_format"] = {"type": "json_object"}
+        return request
+
+    @staticmethod
+    def _response(response):
+        usage = getattr(response, "usage", None)
+        return LLMResponse(
+            response.choices[0].message.content,
+            prompt_tokens=getattr(usage, "prompt_tokens", None),
+            output_tokens=getattr(usage, "completion_tokens", None)
+        )
+
+    def warm(self, model):
+        try:
+            self.client.models.list()
+        except Exception as e:
+            print(f"Failed to warm Groq connection: {e}")
+
+    def complete(self, model, system_prompt, messages, json_output=True):
+        request = self._request(model, system_prompt, messages, json_output)
+        return self._response(self.client.chat.completions.create(**request))
+
+    def complete_stream(self, model, system_prompt, messages, json_output=True):
+        request = self._request(model, system_prompt, messages, json_output)
+        for chunk in self.client.chat.completions.create(stream=True, **request):
+            text = chunk.choices[0].delta.content if chunk.choices else None
+            if text:
+                yield text
+
+    async def acomplete(self, model, system_prompt, messages, json_output=True):
+        request = self._request(model, system_prompt, messages, json_output)
+        return self._response(await self.async_client.chat.completions.create(**request))
+
+    async def acomplete_stream(self, model, system_prompt, messages, json_output=True):
+        request = self._request(model, system_prompt, messages, json_output)
+        stream = await self.async_client.chat.completions.create(stream=True, **request)
+        async for chunk in stream:
+            text = chunk.choices[0].delta.content if chunk.choices else None
+            if text:
+                yield text
+
+
+def request_key(model, system_prompt, messages, json_output):
+    """Hash identifying one request, used by the replay store."""
+    payload = json.dumps([model, system_prompt or "", messages, bool(json_output)], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LatencyModel:
+    """
+    Synthetic latency distribution, parsed from a spec such as:
+        "zero", "fixed:0.8", "uniform:0.3,1.5" or "lognormal:0.8,0.5" (median seconds, sigma)
+    """
+
+    def __init__(self, spec="lognormal:0.8,0.5"):
+        name, _, args = spec.partition(":")
+        self.name = name.strip().lower()
+        self.args = [float(a) for a in args.split(",") if a.strip()]
+        if self.name not in ("zero", "fixed", "uniform", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+    def sample(self, rng):
+        if self.name == "zero":
+            return 0.0
+        if self.name == "fixed":
+            return self.args[0]
+        if self.name == "uniform":
+            return rng.uniform(self.args[0], self.args[1])
+        median, sigma = self.args
+        return rng.lognormvariate(0, sigma) * median
+
+
+# Matches JSON field names a prompt asks for, e.g. "score": ... or a field named "expanded_query"
+_JSON_KEY_PATTERN = re.compile(r"""["']([A-Za-z_][\w ]{0,40})["']\s*:|named\s+["'](\w+)["']""")
+_SENTENCE_WORDS = ("MATLAB", "Simulink", "sample", "time", "block", "signal", "function", "error",
+                   "matrix", "workspace", "solver", "model", "parameter", "toolbox", "script")
+
+
+class LocalProvider(LLMProvider):
+    """
+    Offline stand-in backend for load tests and benchmarks on air-gapped machines.
+
+    In "replay" mode, responses recorded by RecordingProvider are served by request hash;
+    requests missing from the store fall back to the synthetic generator. In "synthetic"
+    mode, deterministic responses are generated from the prompt: JSON requests get an
+    object with the field names the prompt asks for, text requests get markdown.
+    Latency is drawn from a LatencyModel seeded per request and attempt, so runs are
+    reproducible.
+    """
+
+    name = "local"
+
+    def __init__(self, mode="synthetic", replay_path=None, latency="lognormal:0.8,0.5",
+                 seed=0, output_words=180, max_tracked_requests=10000):
+        """
+        Args:
+            mode: "synthetic" or "replay"
+            replay_path: JSONL file written by RecordingProvider (replay mode)
+            latency: LatencyModel spec
+            seed: Seed mixed into every per-request random generator
+            output_words: Length of synthetic text responses
+            max_tracked_requests: Requests whose attempt count is remembered; the least
+                recently seen are forgotten and start again at attempt 0
+        """
+        self.mode = mode
+        self.latency = LatencyModel(latency)
+        self.seed = seed
+        self.output_words = output_words
+        self.replay = {}
+        self.stats = {"replayed": 0, "synthetic": 0}
+        self.max_tracked_requests = max_tracked_requests
+        self._attempts = OrderedDict()  # request key -> times requested, least recent first
+        self._lock = threading.Lock()
+        if mode == "replay":
+            if not replay_path or not os.path.exists(replay_path):
+                raise ValueError(f"Replay store not found: {replay_path}")
+            with open(replay_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.replay[record["key"]] = record
+
+    def _rng(self, key):
+        return random.Random(f"{self.seed}:{key}")
+
+    def _latency(self, key):
+        # Repeats of a request (retries, hedged duplicates) draw fresh latencies, like a real
+        # backend, while a run of the same requests stays reproducible
+        with self._lock:
+            attempt = self._attempts.pop(key, 0)
+            self._attempts[key] = attempt + 1
+            while len(self._attempts) > self.max_tracked_requests:
+                self._attempts.popitem(last=False)
+        return self.latency.sample(random.Random(f"{self.seed}:{key}:{attempt}"))
+
+    def _sentence(self, rng, words=12):
+        text = " ".join(rng.choice(_SENTENCE_WORDS) for _ in range(words))
+        return text[0].upper() + text[1:] + "."
+
+    def _json_value(self, field, rng):
+        name = field.lower()
+        if name in ("score", "confidence"):
+            return round(rng.uniform(0.6, 0.95), 2)
+        if name == "response_type":
+            return rng.choice(["CONCISE", "DETAILED"])
+        if name.startswith("statement"):
+            return rng.random() < 0.8
+        if name in ("alternatives", "strengths", "weaknesses", "statements", "questions", "sentences"):
+            return [self._sentence(rng, 8) for _ in range(3)]
+        if name == "question":
+            return self._sentence(rng, 8)[:-1] + "?"
+        return self._sentence(rng)
+
+    def _synthetic_text(self, system_prompt, messages, json_output, rng):
+        if json_output:
+            prompt = (system_prompt or "") + "\n" + messages[-1]["content"]
+            fields = []
+            for match in _JSON_KEY_PATTERN.finditer(prompt):
+                field = match.group(1) or match.group(2)
+                if field not in fields:
+                    fields.append(field)
+            if not fields:
+                fields = ["answer"]
+            return json.dumps({field: self._json_value(field, rng) for field in fields})
+
+        paragraphs = []
+        words_left = self.output_words
+        while words_left > 0:
+            paragraphs.append(" ".join(self._sentence(rng) for _ in range(3)))
+            words_left -= 36
+        paragraphs.insert(1, "```matlab\nx = linspace(0, 1, 100);\ny = sin(2*pi*x);\nplot(x, y)\n```")
+        return "\n\n".join(paragraphs)
+
+    def _generate(self, model, system_prompt, messages, json_output):
+        key = request_key(model, system_prompt, messages, json_output)
+        rng = self._rng(key)
+        delay = self._latency(key)
+
+        record = self.replay.get(key)
+        if record is not None:
+            with self._lock:
+                self.stats["replayed"] += 1
+            response = LLMResponse(record["text"], record.get("prompt_tokens"), record.get("output_tokens"))
+        else:
+            with self._lock:
+                self.stats["synthetic"] += 1
+            text = self._synthetic_text(system_prompt, messages, json_output, rng)
+            prompt_tokens = estimate_tokens(system_prompt, *[m["content"] for m in messages])
+            response = LLMResponse(text, prompt_tokens, estimate_tokens(text))
+        return response, delay
+
+    @staticmethod
+    def _chunks(text, size=24):
+        return [text[i:i + size] for i in range(0, len(text), size)] or [""]
+
+    def complete(self, model, system_prompt, messages, json_output=True):
+        response, delay = self._generate(model, system_prompt, messages, json_output)
+        time.sleep(delay)
+        return response
+
+    def complete_stream(self, model, system_prompt, messages, json_output=True):
+        response, delay = self._generate(model, system_prompt, messages, json_output)
+        chunks = self._chunks(response.text)
+        # Time to first token is ~30% of the latency; the rest is spread over the chunks
+        time.sleep(delay * 0.3)
+        for chunk in chunks:
+            yield chunk
+            time.sleep(delay * 0.7 / len(chunks))
+
+    async def acomplete(self, model, system_prompt, messages, json_output=True):
+        response, delay = self._generate(model, system_prompt, messages, json_output)
+        await asyncio.sleep(delay)
+        return response
+
+    async def acomplete_stream(self, model, system_prompt, messages, json_output=True):
+        response, delay = self._generate(model, system_prompt, messages, json_output)
+        chunks = self._chunks(response.text)
+        await asyncio.sleep(delay * 0.3)
+        for chunk in chunks:
+            yield chunk
+            await asyncio.sleep(delay * 0.7 / len(chunks))
+
+
+class RecordingProvider(LLMProvider):
+    """Wraps a real provider and appends every completed response to a JSONL replay store."""
+
+    def __init__(self, inner, path):
+        self.inner = inner
+        self.name = inner.name
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _save(self, model, system_prompt, messages, json_output, text, prompt_tokens=None, output_tokens=None):
+        record = {
+            "key": request_key(model, system_prompt, messages, json_output),
+            "model": model,
+            "text": text,
+            "prompt_tokens": prompt_tokens,
+            "output_tokens": output_tokens,
+        }
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def warm(self, model):
+        self.inner.warm(model)
+
+    def complete(self, model, system_prompt, messages, json_output=True):
+        response = self.inner.complete(model, system_prompt, messages, json_output)
+        self._save(model, system_prompt, messages, json_output, response.text, response.prompt_tokens, response.output_tokens)
+        return response
+
+    def complete_stream(self, model, system_prompt, messages, json_output=True):
+        chunks = []
+        for chunk in self.inner.complete_stream(model, system_prompt, messages, json_output):
+            chunks.append(chunk)
+            yield chunk
+        self._save(model, system_prompt, messages, json_output, "".join(chunks))
+
+    async def acomplete(self, model, system_prompt, messages, json_output=True):
+        response = await self.inner.acomplete(model, system_prompt, messages, json_output)
+        self._save(model, system_prompt, messages, json_output, response.text, response.prompt_tokens, response.output_tokens)
+        return response
+
+    async def acomplete_stream(self, model, system_prompt, messages, json_output=True):
+        chunks = []
+        async for chunk in self.inner.acomplete_stream(model, system_prompt, messages, json_output):
+            chunks.append(chunk)
+            yield chunk
+        self._save(model, system_prompt, messages, json_output, "".join(chunks))
+
+
+def provider_from_env():
+    """
+    Build the provider selected by environment variables:
+        MATBOT_LLM_PROVIDER: gemini (default), groq or local
+        MATBOT_LOCAL_MODE: synthetic (default) or replay
+        MATBOT_LOCAL_REPLAY: replay store path for local replay mode
+        MATBOT_LOCAL_LATENCY: LatencyModel spec for the local provider
+        MATBOT_LOCAL_SEED: seed for the local provider
+        MATBOT_LLM_RECORD: if set, record every real response to this JSONL file
+    """
+    name = os.environ.get("MATBOT_LLM_PROVIDER", "gemini").lower()
+    if name == "gemini":
+        provider = GeminiProvider()
+    elif name == "groq":
+        provider = GroqProvider()
+    elif name == "local":
+        return LocalProvider(
+            mode=os.environ.get("MATBOT_LOCAL_MODE", "synthetic"),
+            replay_path=os.environ.get("MATBOT_LOCAL_REPLAY"),
+            latency=os.environ.get("MATBOT_LOCAL_LATENCY", "lognormal:0.8,0.5"),
+            seed=int(os.environ.get("MATBOT_LOCAL_SEED", 0))
+        )
+    else:
+        raise ValueError(f"Unknown LLM provider: {name}")
+
+    record_path = os.environ.get("MATBOT_LLM_RECORD")
+    if record_path:
+        provider = RecordingProvider(provider, record_path)
+    return provider
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_provider():
+    """Return the process-wide provider, building it from the environment on first use."""
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                _provider = provider_from_env()
+    return _provider
+
+
+def set_provider(provider):
+    """Replace the process-wide provider (e.g. a LocalProvider in a benchmark harness)."""
+    global _provider
+    with _provider_lock:
+        _provider = provider
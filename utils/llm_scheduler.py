@@ -0,0 +1,212 @@
+import asyncio
+import heapq
+import itertools
+import random
+import threading
+import time
+import httpx
+
+# Priority classes: lower values are admitted first when the quota is contended
+PRIORITY_INTERACTIVE = 0  # Generation the user is waiting on (debugger, concise, intent, rrr)
+PRIORITY_BACKGROUND = 1  # Evaluation, RAGAS and HyDE work
+
+# HTTP statuses worth retrying: quota exhaustion, timeouts and transient server errors
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def is_retryable(error):
+    """Whether an exception raised by an LLM call is transient and worth retrying."""
+    if isinstance(error, httpx.TransportError):
+        return True
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    return code in RETRYABLE_STATUS_CODES
+
+
+def estimate_tokens(*texts):
+    """Rough token count (about four characters per token) used for rate-limit accounting."""
+    return sum(len(text) for text in texts if text) // 4
+
+
+class RateLimitScheduler:
+    """
+    Admission control for every LLM request in the process.
+
+    Requests wait in a priority queue and are admitted in (priority, arrival) order once
+    both token buckets, requests per minute and tokens per minute, can cover them.
+    Retryable failures are retried with exponential backoff and full jitter, and a
+    quota error empties the request bucket so other callers back off as well.
+    """
+
+    def __init__(self, requests_per_minute=60, tokens_per_minute=1_000_000, max_retries=4,
+                 base_delay=1.0, max_delay=30.0):
+        """
+        Args:
+            requests_per_minute: Request quota
+            tokens_per_minute: Token quota (prompt plus expected output)
+            max_retries: Retries after the first attempt for retryable errors
+            base_delay: Backoff base in seconds
+            max_delay: Backoff cap in seconds
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._cond = threading.Condition()
+        self._request_level = float(requests_per_minute)
+        self._token_level = float(tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._waiters = []  # heap of (priority, sequence) tickets
+        self._sequence = itertools.count()
+        self.stats = {"admitted": 0, "retries": 0, "failures": 0, "throttled_seconds": 0.0}
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._request_level = min(self.requests_per_minute,
+                                  self._request_level + elapsed * self.requests_per_minute / 60)
+        self._token_level = min(self.tokens_per_minute,
+                                self._token_level + elapsed * self.tokens_per_minute / 60)
+
+    def _try_admit(self, ticket, tokens):
+        """
+        Admit the ticket if it is first in line and the buckets allow it.
+        Must be called with the lock held.
+
+        Returns:
+            0 when admitted, otherwise seconds to wait (None: wait until notified)
+        """
+        self._refill()
+        if self._waiters[0] != ticket:
+            return None
+
+        tokens = min(tokens, self.tokens_per_minute)
+        wait = max(
+            (1 - self._request_level) * 60 / self.requests_per_minute,
+            (tokens - self._token_level) * 60 / self.tokens_per_minute,
+            0
+        )
+        if wait > 0:
+            return wait
+
+        heapq.heappop(self._waiters)
+        self._request_level -= 1
+        self._token_level -= tokens
+        self.stats["admitted"] += 1
+        self._cond.notify_all()
+        return 0
+
+    def _withdraw(self, ticket):
+        with self._cond:
+            if ticket in self._waiters:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    def acquire(self, priority=PRIORITY_INTERACTIVE, tokens=0):
+        """Block until the request may be sent; returns the seconds spent waiting."""
+        ticket = (priority, next(self._sequence))
+        started = time.monotonic()
+        try:
+            with self._cond:
+                heapq.heappush(self._waiters, ticket)
+                while True:
+                    wait = self._try_admit(ticket, tokens)
+                    if wait == 0:
+                        break
+                    self._cond.wait(timeout=wait)
+        except BaseException:
+            self._withdraw(ticket)
+            raise
+        waited = time.monotonic() - started
+        self.stats["throttled_seconds"] += waited
+        return waited
+
+    async def aacquire(self, priority=PRIORITY_INTERACTIVE, tokens=0):
+        """Async acquire; waits without blocking the event loop and leaves the queue if cancelled."""
+        ticket = (priority, next(self._sequence))
+        started = time.monotonic()
+        with self._cond:
+            heapq.heappush(self._waiters, ticket)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_admit(ticket, tokens)
+                if wait == 0:
+                    break
+                await asyncio.sleep(wait if wait is not None else 0.05)
+        except BaseException:
+            self._withdraw(ticket)
+            raise
+        waited = time.monotonic() - started
+        self.stats["throttled_seconds"] += waited
+        return waited
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """Correct the token bucket once the real usage of an admitted request is known."""
+        if actual_tokens is None:
+            return
+        with self._cond:
+            self._token_level = min(self.tokens_per_minute,
+                                    self._token_level + estimated_tokens - actual_tokens)
+            self._cond.notify_all()
+
+    def _on_failure(self, error, attempt):
+        """Return the backoff delay for a retryable error, or None to give up."""
+        if not is_retryable(error) or attempt >= self.max_retries:
+            self.stats["failures"] += 1
+            return None
+        if (getattr(error, "code", None) or getattr(error, "status_code", None)) == 429:
+            # Quota exhausted upstream: make everyone wait for the bucket to refill
+            with self._cond:
+                self._request_level = min(self._request_level, 0)
+        self.stats["retries"] += 1
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        print(f"Retrying LLM call in {delay:.1f}s after error: {error}")
+        return delay
+
+    @staticmethod
+    def _note(record, field, value):
+        if record is not None:
+            record[field] += value
+
+    def call(self, fn, priority=PRIORITY_INTERACTIVE, tokens=0, record=None):
+        """
+        Run fn() under admission control, retrying transient failures.
+
+        Args:
+            fn: Zero-argument callable performing one LLM request
+            priority: PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND
+            tokens: Estimated tokens the request will consume
+            record: Optional metrics record (see LLMMetrics.start) that receives the
+                seconds queued and the number of retries
+        """
+        attempt = 0
+        while True:
+            self._note(record, "queued_seconds", self.acquire(priority, tokens))
+            try:
+                return fn()
+            except Exception as e:
+                delay = self._on_failure(e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                self._note(record, "retries", 1)
+                time.sleep(delay)
+
+    async def acall(self, coro_fn, priority=PRIORITY_INTERACTIVE, tokens=0, record=None):
+        """Async call(): coro_fn is a zero-argument function returning a fresh coroutine."""
+        attempt = 0
+        while True:
+            self._note(record, "queued_seconds", await self.aacquire(priority, tokens))
+            try:
+                return await coro_fn()
+            except Exception as e:
+                delay = self._on_failure(e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                self._note(record, "retries", 1)
+                await asyncio.sleep(delay)
@@ -0,0 +1,82 @@
+import queue
+import threading
+
+
+class SelfMemoryIngestor:
+    """
+    Background ingestion queue for self-memory.
+
+    submit() only checks the quality score and enqueues, so the user's turn never waits
+    on embedding or persistence. A daemon worker drains the queue in batches, embeds each
+    batch with a single encode call and stores it through the clusterer.
+    """
+
+    def __init__(self, clusterer, batch_size=16, max_wait=0.5, on_persist=None):
+        """
+        Args:
+            clusterer: RAGClusterer that owns the self-memory
+            batch_size: Maximum candidates embedded together
+            max_wait: Seconds to wait for more candidates before embedding a partial batch
+            on_persist: Optional callable run after each stored batch (e.g. save to JSON)
+        """
+        self.clusterer = clusterer
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.on_persist = on_persist
+        self.stats = {"submitted": 0, "rejected": 0, "stored": 0, "errors": 0}
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="self-memory-ingest", daemon=True)
+        self._worker.start()
+
+    def submit(self, query, context, output, score, heading=None, concise=None):
+        """
+        Queue a response for self-memory.
+
+        Returns:
+            bool: True if the candidate was queued, False if its score is too low
+        """
+        if score <= self.clusterer.self_memory_min_score:
+            self.stats["rejected"] += 1
+            return False
+
+        self._queue.put({
+            'query': query,
+            'context': context,
+            'output': output,
+            'score': score,
+            'heading': heading,
+            'concise': concise
+        })
+        self.stats["submitted"] += 1
+        return True
+
+    def pending(self):
+        return self._queue.unfinished_tasks
+
+    def flush(self):
+        """Block until every queued candidate has been stored."""
+        self._queue.join()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get(timeout=self.max_wait))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                stored = self.clusterer.add_batch_to_self_memory(batch)
+                self.stats["stored"] += stored
+                if stored and self.on_persist:
+                    self.on_persist()
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"Error ingesting self-memory batch: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
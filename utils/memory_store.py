@@ -0,0 +1,189 @@
+import os
+import sqlite3
+import threading
+import time
+import json
+import numpy as np
+
+# Evaluated inside each write, which holds SQLite's write lock, so versions never repeat
+_NEXT_VERSION = "(SELECT COALESCE(MAX(version), 0) + 1 FROM self_memory)"
+
+
+class SQLiteMemoryStore:
+    """
+    Self-memory backend shared by every app replica on the same host.
+
+    Records and their embeddings live in one SQLite database opened in WAL mode,
+    so several processes can append while others read. Every insert and embedding update
+    stamps the row with the next value of a table-wide version counter, which lets readers
+    fetch only the rows added or changed since their last refresh.
+    """
+
+    def __init__(self, db_path, timeout=30.0):
+        """
+        Args:
+            db_path: Path to the SQLite database file (created if missing)
+            timeout: Seconds to wait on a locked database before failing
+        """
+        self.db_path = db_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+        parent = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(parent, exist_ok=True)
+
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS self_memory (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                query TEXT NOT NULL,
+                context TEXT,
+                output TEXT NOT NULL,
+                score REAL,
+                embedding BLOB NOT NULL,
+                dim INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        # Databases created before concise answers were remembered lack this column
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(self_memory)")]
+        if 'concise' not in columns:
+            conn.execute("ALTER TABLE self_memory ADD COLUMN concise TEXT")
+        # Which text the embedding was built from (see clustering.MEMORY_EMBEDDING_KEYS);
+        # NULL for rows written before it was recorded
+        if 'embedding_key' not in columns:
+            conn.execute("ALTER TABLE self_memory ADD COLUMN embedding_key TEXT")
+        if 'heading' not in columns:
+            conn.execute("ALTER TABLE self_memory ADD COLUMN heading TEXT")
+        if 'version' not in columns:
+            conn.execute("ALTER TABLE self_memory ADD COLUMN version INTEGER")
+            conn.execute("UPDATE self_memory SET version = id")
+        conn.execute("CREATE INDEX IF NOT EXISTS self_memory_version ON self_memory (version)")
+        conn.commit()
+
+    def _connect(self):
+        """Return this thread's connection (sqlite3 connections are not shared across threads)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=self.timeout)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def add(self, query, context, output, score, embedding, concise=None, embedding_key=None, heading=None):
+        """
+        Append one memory record.
+
+        Args:
+            embedding_key: Name of the text the embedding was built from
+            heading: Heading of the best source, needed to rebuild 'query_heading' embeddings
+
+        Returns:
+            int: The row id of the new record
+        """
+        embedding = np.asarray(embedding, dtype=np.float32)
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO self_memory (query, context, output, concise, score, embedding, dim, created_at, "
+                f"embedding_key, heading, version) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, {_NEXT_VERSION})",
+                (query, context, output, concise, float(score), embedding.tobytes(), int(embedding.shape[0]), time.time(),
+                 embedding_key, heading)
+            )
+        return cursor.lastrowid
+
+    def update_embeddings(self, updates, embedding_key):
+        """
+        Replace the embeddings of existing records, e.g. after re-embedding them with
+        another embedding key. The rows get a new version, so every reader refetches them.
+
+        Args:
+            updates: List of (row id, embedding) pairs
+            embedding_key: Name of the text the new embeddings were built from
+        """
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                f"UPDATE self_memory SET embedding = ?, dim = ?, embedding_key = ?, version = {_NEXT_VERSION} WHERE id = ?",
+                [(np.asarray(emb, dtype=np.float32).tobytes(), int(np.asarray(emb).shape[0]), embedding_key, int(row_id))
+                 for row_id, emb in updates]
+            )
+
+    def fetch_since(self, last_version=0, limit=None):
+        """
+        Fetch records added or updated after last_version, in version order.
+
+        Returns:
+            List of memory dicts with numpy embeddings, their 'id' and 'version'
+        """
+        sql = ("SELECT id, query, context, output, concise, score, embedding, embedding_key, heading, version "
+               "FROM self_memory WHERE version > ? ORDER BY version")
+        params = [last_version]
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+
+        records = []
+        for row_id, query, context, output, concise, score, blob, embedding_key, heading, version in self._connect().execute(sql, params):
+            records.append({
+                'id': row_id,
+                'query': query,
+                'context': context,
+                'output': output,
+                'concise': concise,
+                'score': score,
+                'embedding': np.frombuffer(blob, dtype=np.float32).copy(),
+                'embedding_key': embedding_key,
+                'heading': heading,
+                'version': version
+            })
+        return records
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM self_memory").fetchone()[0]
+
+    def import_json(self, file_path):
+        """
+        One-off migration of a legacy self_memory.json file into an empty store.
+        Records keep the embedding key they were saved with; legacy files predate it, so
+        their rows get none and are re-embedded by the clusterer when it attaches the store.
+
+        Returns:
+            int: Number of records imported
+        """
+        if not os.path.exists(file_path):
+            return 0
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                serialized_memory = json.load(f)
+        except json.JSONDecodeError:
+            return 0
+
+        now = time.time()
+        rows = []
+        for mem in serialized_memory:
+            embedding = np.asarray(mem['embedding'], dtype=np.float32)
+            rows.append((mem['query'], mem.get('context', ''), mem['output'], mem.get('concise'),
+                         float(mem.get('score', 1.0)), embedding.tobytes(), int(embedding.shape[0]), now,
+                         mem.get('embedding_key'), mem.get('heading')))
+
+        conn = self._connect()
+        with conn:
+            # The emptiness check and the inserts share one write transaction, so replicas
+            # starting together can't both import the file
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("SELECT COUNT(*) FROM self_memory").fetchone()[0] > 0:
+                return 0
+            conn.executemany(
+                "INSERT INTO self_memory (query, context, output, concise, score, embedding, dim, created_at, "
+                f"embedding_key, heading, version) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, {_NEXT_VERSION})",
+                rows
+            )
+        return len(rows)
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -2,6 +2,10 @@ from typing import List, Dict
 import numpy as np
 from sentence_transformers import SentenceTransformer
 import os
+import re
+import ast
+import json
+import asyncio
 from dotenv import load_dotenv
 import sys
 sys.path.append('/home/arka/Desktop/Hackathons/HCLTech_CS671')
@@ -11,6 +15,36 @@ load_dotenv()
 
 embedder = SentenceTransformer('all-MiniLM-L6-v2')
 
+# "batched" fuses statement extraction with verification and generates all questions in one
+# call, running the three metric branches concurrently; "sequential" is the original flow.
+# Both compute the full LLM-judged metrics. "local" approximates them from MiniLM sentence
+# similarities without any LLM call, using thresholds calibrated against the full metrics.
+RAGAS_MODES = ["batched", "sequential", "local"]
+RAGAS_MODE = os.environ.get("MATBOT_RAGAS_MODE", "batched")
+
+RAGAS_CALIBRATION = os.environ.get(
+    "MATBOT_RAGAS_CALIBRATION",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ragas_calibration.json")
+)
+DEFAULT_CALIBRATION = {
+    "support_threshold": 0.6,  # Answer sentence counts as supported above this similarity to the context
+    "relevance_threshold": 0.4,  # Context sentence counts as relevant above this similarity to the question
+    "answer_relevance_scale": 1.0,
+    "answer_relevance_offset": 0.0,
+}
+
+
+def load_calibration(path: str = RAGAS_CALIBRATION) -> Dict[str, float]:
+    """Local-mode thresholds from a calibrate() run, or the defaults."""
+    calibration = dict(DEFAULT_CALIBRATION)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            calibration.update({k: v for k, v in json.load(f).items() if k in DEFAULT_CALIBRATION})
+    return calibration
+
+
+calibration = load_calibration()
+
 def get_statements(answer: str, question: str) -> List[str]:
     """Extract statements from the answer using Gemini."""
     prompt = f"""
@@ -33,7 +67,9 @@ Answer: {answer}
     response = gw.universal_agent(
         prompt,
         "",    # No system prompt
-        model="gemini-2.0-flash"
+        model="gemini-2.0-flash",
+        priority=gw.PRIORITY_BACKGROUND,
+        call_site="ragas_statements"
     )
     # extracted = response.strip()
     # statements = [line.strip() for line in extracted.split("\n") if line.strip()]
@@ -58,7 +94,9 @@ def verify_statements(statements: List[str], context: str) -> List[bool]:
     response = gw.universal_agent(
         verification_prompt,
         "",    # No system prompt
-        model="gemini-2.0-flash"
+        model="gemini-2.0-flash",
+        priority=gw.PRIORITY_BACKGROUND,
+        call_site="ragas_verify"
     )
 
     verdicts = response.values()
@@ -68,18 +106,100 @@ def verify_statements(statements: List[str], context: str) -> List[bool]:
 def generate_questions(answer: str, n: int = 3) -> List[str]:
     """Generate questions from the answer using Gemini."""
     generated_questions = []
-    for _ in range(n):
+    for i in range(n):
         prompt = "Generate a question for the given answer. In format: {'question': 'your  generated question'}\n\n" + f"answer: {answer}"
         response = gw.universal_agent(
             prompt,
             "",    # No system prompt
-            model="gemini-2.0-flash"
+            model="gemini-2.0-flash",
+            priority=gw.PRIORITY_BACKGROUND,
+            call_site="ragas_questions",
+            cache_salt=str(i)
         )       
         # print(response)
         generated_questions.append(response['question'])
     return generated_questions
 
 
+def _is_true(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() == "true"
+    return bool(value)
+
+
+async def aget_verified_statements(answer: str, question: str, context: str) -> List[bool]:
+    """Extract statements from the answer and verify them against the context in one call."""
+    prompt = f"""
+Your task has two steps.
+
+1. Extract **precise standalone factual statements** from the given **answer**.
+ Very strict rules:
+- Each statement **must be directly present in the answer** (verbatim or minimal rephrasing).
+- Do NOT add any external knowledge or inferred information.
+Only include statements that are **fully supported by the answer** itself.
+
+2. For each statement, determine whether it is supported by the information present in the
+**context**. Provide a verdict (True/False) without any explanation.
+
+Format to be followed is:
+    {{
+        "statement 1": {{"text": "first statement", "supported": true/false}},
+        "statement 2": {{"text": "second statement", "supported": true/false}}, ...
+    }}
+Do not deviate from the specified format. Return {{}} if the answer contains no statements.
+
+---
+
+Question: {question}
+
+Answer: {answer}
+
+context:
+{context}
+"""
+    response = await gw.auniversal_agent(
+        prompt,
+        "",    # No system prompt
+        model="gemini-2.0-flash",
+        priority=gw.PRIORITY_BACKGROUND,
+        call_site="ragas_faithfulness"
+    )
+    if not isinstance(response, dict):
+        return []
+    verdicts = []
+    for key, value in response.items():
+        if not str(key).lower().startswith("statement"):
+            continue
+        verdicts.append(_is_true(value.get("supported") if isinstance(value, dict) else value))
+    return verdicts
+
+
+async def agenerate_questions_batch(answer: str, n: int = 3) -> List[str]:
+    """Generate n questions for the answer in one call."""
+    prompt = f"Generate {n} different questions for the given answer. In format: {{\"questions\": [\"question 1\", \"question 2\", ...]}}\n\n" + f"answer: {answer}"
+    response = await gw.auniversal_agent(
+        prompt,
+        "",    # No system prompt
+        model="gemini-2.0-flash",
+        priority=gw.PRIORITY_BACKGROUND,
+        call_site="ragas_questions"
+    )
+    questions = response.get("questions", []) if isinstance(response, dict) else []
+    return [str(q) for q in questions[:n]]
+
+
+async def aextract_relevant_sentences(context: str, question: str) -> List[str]:
+    """Async extract_relevant_sentences(), with the same prompt."""
+    response = await gw.auniversal_agent(
+        _relevant_sentences_prompt(context, question),
+        "",    # No system prompt
+        model="gemini-2.0-flash",
+        priority=gw.PRIORITY_BACKGROUND,
+        call_site="ragas_relevant"
+    )
+    return response
+
+
 def get_embedding(text: str) -> np.ndarray:
     """Get embedding using SentenceTransformers locally."""
     embedding = embedder.encode(text)
@@ -91,46 +211,58 @@ def cosine_similarity(vec1: np.ndarray, vec2: np.ndarray) -> float:
     return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
 
 
-def extract_relevant_sentences(context: str, question: str) -> List[str]:
-    """Extract relevant sentences from context using Gemini."""
-    prompt = f"""
+def _relevant_sentences_prompt(context: str, question: str) -> str:
+    return f"""
 Please extract relevant sentences from the provided context that can potentially help answer the following question. If no relevant sentences are found, or if you believe the question cannot be answered from the given context, return the phrase "Insufficient Information". While extracting candidate sentences you're not allowed to make any changes to sentences from given context. Format: ['sentence 1', 'sentence 2', ...]
 
 question: {question}
 context:
 {context}
 """
+
+
+def extract_relevant_sentences(context: str, question: str) -> List[str]:
+    """Extract relevant sentences from context using Gemini."""
     response = gw.universal_agent(
-        prompt,
+        _relevant_sentences_prompt(context, question),
         "",    # No system prompt
-        model="gemini-2.0-flash"
+        model="gemini-2.0-flash",
+        priority=gw.PRIORITY_BACKGROUND,
+        call_site="ragas_relevant"
     )
 
     return response
 
 
-def evaluate_ragas(answer: str, context: str, question: str) -> Dict[str, float]:
+def _as_sentence_list(extracted) -> List[str]:
     """
-    Main function to evaluate using Ragas methodology with Gemini + local embeddings.
-
-    Returns a dictionary with:
-    - faithfulness score
-    - answer relevance score
-    - context relevance score
+    Normalize the relevant-sentence extraction output to a list. The model may answer with
+    "Insufficient Information" or a list rendered as a string instead of a JSON list.
     """
-    # print("get_statements()")
-    statements = get_statements(answer, question)
-    if not statements:
+    if isinstance(extracted, list):
+        return [str(s) for s in extracted if str(s).strip()]
+    if isinstance(extracted, dict):
+        return [str(s) for value in extracted.values() for s in (value if isinstance(value, list) else [value]) if str(s).strip()]
+    text = str(extracted or "").strip()
+    if not text or "insufficient information" in text.lower():
+        return []
+    try:
+        parsed = ast.literal_eval(text)
+        if isinstance(parsed, (list, tuple)):
+            return [str(s) for s in parsed if str(s).strip()]
+    except (ValueError, SyntaxError):
+        pass
+    return [line.strip(" -*'\"") for line in text.splitlines() if line.strip(" -*'\"")]
+
+
+def _score(verdicts, generated_qs, extracted_sentences, context: str, question: str) -> Dict[str, float]:
+    """Compute the three metrics from the LLM outputs; shared by both modes."""
+    if not verdicts:
         faithfulness_score = 0.0
     else:
-        # print("verify_statements()")
-        verdicts = verify_statements(statements, context)
         faithfulness_score = sum(verdicts) / len(verdicts)
 
     # Answer Relevance
-    # print("generate_questions()")
-    generated_qs = generate_questions(answer, n=3)
-    # print("get_embedding()")
     question_emb = get_embedding(question)
     similarities = []
     for gen_q in generated_qs:
@@ -140,13 +272,12 @@ def evaluate_ragas(answer: str, context: str, question: str) -> Dict[str, float]
     answer_relevance_score = np.mean(similarities) if similarities else 0.0
 
     # Context Relevance
-    # print("extract_relevant_sentences()")
     context_sentences = [sent.strip() for sent in context.split(".") if sent.strip()]
-    extracted_sentences = extract_relevant_sentences(context, question)
     if not context_sentences:
         context_relevance_score = 0.0
     else:
-        context_relevance_score = len(extracted_sentences) / len(context_sentences)
+        extracted_sentences = _as_sentence_list(extracted_sentences)
+        context_relevance_score = min(1.0, len(extracted_sentences) / len(context_sentences))
 
     return {
         "faithfulness": round(float(faithfulness_score), 3),
@@ -155,8 +286,174 @@ def evaluate_ragas(answer: str, context: str, question: str) -> Dict[str, float]
     }
 
 
+async def aevaluate_ragas_batched(answer: str, context: str, question: str) -> Dict[str, float]:
+    """
+    Batched evaluate_ragas(): three concurrent calls (verified statements, all questions,
+    relevant sentences) instead of up to six sequential ones, with the same metrics.
+    """
+    verdicts, generated_qs, extracted_sentences = await asyncio.gather(
+        aget_verified_statements(answer, question, context),
+        agenerate_questions_batch(answer, n=3),
+        aextract_relevant_sentences(context, question)
+    )
+    return _score(verdicts, generated_qs, extracted_sentences, context, question)
+
+
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+|\n+")
+_CODE_BLOCK = re.compile(r"```.*?(```|$)", re.DOTALL)
+
+
+def _split_sentences(text: str) -> List[str]:
+    # Code blocks aren't factual statements, so they are left out of the local metrics
+    text = _CODE_BLOCK.sub(" ", text or "")
+    return [s.strip(" -*#") for s in _SENTENCE_SPLIT.split(text) if len(s.strip(" -*#")) > 3]
+
+
+def _local_similarities(samples):
+    """
+    Sentence similarity statistics for (answer, context, question) samples, with every
+    sentence of every sample embedded in a single batch.
+
+    Returns:
+        list: (support, relevance, answer_similarity) per sample, where support holds each
+        answer sentence's best cosine similarity to any context sentence and relevance each
+        context sentence's similarity to the question
+    """
+    split = [(_split_sentences(answer), _split_sentences(context), question) for answer, context, question in samples]
+    texts = []
+    for answer_sents, context_sents, question in split:
+        texts += [question] + answer_sents + context_sents
+    embeddings = embedder.encode(texts, normalize_embeddings=True, show_progress_bar=False) if texts else None
+
+    results = []
+    pos = 0
+    for answer_sents, context_sents, _ in split:
+        q = embeddings[pos]
+        a = embeddings[pos + 1:pos + 1 + len(answer_sents)]
+        c = embeddings[pos + 1 + len(answer_sents):pos + 1 + len(answer_sents) + len(context_sents)]
+        pos += 1 + len(answer_sents) + len(context_sents)
+
+        support = (a @ c.T).max(axis=1) if len(a) and len(c) else np.zeros(0)
+        relevance = c @ q if len(c) else np.zeros(0)
+        if len(a):
+            centroid = a.mean(axis=0)
+            answer_similarity = float(cosine_similarity(q, centroid))
+        else:
+            answer_similarity = 0.0
+        results.append((support, relevance, answer_similarity))
+    return results
+
+
+def _local_scores(support, relevance, answer_similarity, cal) -> Dict[str, float]:
+    faithfulness_score = float(np.mean(support >= cal["support_threshold"])) if len(support) else 0.0
+    context_relevance_score = float(np.mean(relevance >= cal["relevance_threshold"])) if len(relevance) else 0.0
+    answer_relevance_score = float(np.clip(cal["answer_relevance_scale"] * answer_similarity + cal["answer_relevance_offset"], 0.0, 1.0))
+    return {
+        "faithfulness": round(faithfulness_score, 3),
+        "answer_relevance": round(answer_relevance_score, 3),
+        "context_relevance": round(context_relevance_score, 3),
+    }
+
+
+def evaluate_ragas_local_batch(samples, cal: Dict[str, float] = None) -> List[Dict[str, float]]:
+    """
+    Approximate the three metrics for many (answer, context, question) samples at once,
+    without LLM calls:
+    - faithfulness: share of answer sentences whose closest context sentence is similar enough
+    - answer relevance: similarity of the question to the answer's sentence centroid
+    - context relevance: share of context sentences similar enough to the question
+    """
+    cal = cal or calibration
+    return [_local_scores(*stats, cal) for stats in _local_similarities(samples)]
+
+
+def evaluate_ragas_local(answer: str, context: str, question: str) -> Dict[str, float]:
+    return evaluate_ragas_local_batch([(answer, context, question)])[0]
+
+
+def calibrate(samples, mode: str = "batched", path: str = RAGAS_CALIBRATION) -> Dict[str, float]:
+    """
+    Fit the local-mode thresholds to the full metrics: each threshold is chosen to minimize
+    the mean absolute error against the LLM-judged score, and answer relevance gets a
+    linear fit. The result is saved to path and used by later local evaluations.
+
+    Args:
+        samples: (answer, context, question) tuples, ideally a few dozen real turns
+        mode: Full mode to calibrate against ("batched" or "sequential")
+    """
+    global calibration
+    full = [evaluate_ragas(answer, context, question, mode=mode) for answer, context, question in samples]
+    stats = _local_similarities(samples)
+    grid = np.arange(0.1, 0.95, 0.01)
+
+    def fit_threshold(values_index, metric):
+        errors = [
+            np.mean([abs((float(np.mean(s[values_index] >= t)) if len(s[values_index]) else 0.0) - f[metric])
+                     for s, f in zip(stats, full)])
+            for t in grid
+        ]
+        return float(grid[int(np.argmin(errors))]), float(min(errors))
+
+    support_threshold, faithfulness_mae = fit_threshold(0, "faithfulness")
+    relevance_threshold, context_mae = fit_threshold(1, "context_relevance")
+
+    x = np.array([s[2] for s in stats])
+    y = np.array([f["answer_relevance"] for f in full])
+    scale, offset = np.polyfit(x, y, 1) if len(set(x.round(6))) > 1 else (1.0, 0.0)
+
+    fitted = {
+        "support_threshold": round(support_threshold, 2),
+        "relevance_threshold": round(relevance_threshold, 2),
+        "answer_relevance_scale": float(scale),
+        "answer_relevance_offset": float(offset),
+    }
+    local = evaluate_ragas_local_batch(samples, fitted)
+    report = dict(fitted, samples=len(samples), mae={
+        metric: round(float(np.mean([abs(l[metric] - f[metric]) for l, f in zip(local, full)])), 3)
+        for metric in ("faithfulness", "answer_relevance", "context_relevance")
+    })
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    calibration = load_calibration(path)
+    return report
+
+
+def evaluate_ragas(answer: str, context: str, question: str, mode: str = None) -> Dict[str, float]:
+    """
+    Main function to evaluate using Ragas methodology with Gemini + local embeddings.
+
+    Args:
+        mode: One of RAGAS_MODES; defaults to MATBOT_RAGAS_MODE
+
+    Returns a dictionary with:
+    - faithfulness score
+    - answer relevance score
+    - context relevance score
+    """
+    mode = mode or RAGAS_MODE
+    if mode == "local":
+        return evaluate_ragas_local(answer, context, question)
+    if mode == "batched":
+        return gw.run_async(aevaluate_ragas_batched(answer, context, question))
+
+    statements = get_statements(answer, question)
+    verdicts = list(verify_statements(statements, context)) if statements else []
+    generated_qs = generate_questions(answer, n=3)
+    extracted_sentences = extract_relevant_sentences(context, question)
+    return _score(verdicts, generated_qs, extracted_sentences, context, question)
+
+
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] == "calibrate":
+    # Usage: python -m utils.ragas calibrate samples.jsonl [batched|sequential]
+    # Each line: {"question": ..., "answer": ..., "context": ...}
+    with open(sys.argv[2], "r", encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    report = calibrate([(r["answer"], r["context"], r["question"]) for r in rows],
+                       mode=sys.argv[3] if len(sys.argv) > 3 else "batched")
+    print(json.dumps(report, indent=2))
+
 # Example use:
-if __name__ == "__main__":
+elif __name__ == "__main__":
     answer = "Christopher Nolan directed Oppenheimer, and Cillian Murphy starred as J. Robert Oppenheimer."
     context = "Oppenheimer is a 2023 biographical thriller film written and directed by Christopher Nolan. Based on the 2005 biography American Prometheus by Kai Bird and Martin J. Sherwin, the film chronicles the life of J. Robert Oppenheimer, a theoretical physicist who was pivotal in developing the first nuclear weapons as part of the Manhattan Project, and thereby ushering in the Atomic Age. Cillian Murphy stars as Oppenheimer."
     question = "Who directed the film Oppenheimer and who stars as J. Robert Oppenheimer in the film?"
@@ -36,7 +36,7 @@ def get_similar_queries(user_query, num_alternatives=3, model="gemini-2.0-flash"
     system_prompt = "You are a query rephrasing specialist for technical documentation search systems."
     
     # Generate response using universal_agent
-    response = universal_agent(prompt, system_prompt, model)
+    response = universal_agent(prompt, system_prompt, model, call_site="rrr")
     
     # Process the response to extract the alternatives
     alternatives = []
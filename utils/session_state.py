@@ -0,0 +1,308 @@
+import os
+import time
+import zlib
+import contextlib
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# Per-turn dicts keyed by chat message index; only the newest turns keep their entries
+AUX_KEYS = (
+    "alternative_versions", "source_clusters", "image_results", "stage_timings",
+    "intent_analysis", "show_images", "expanded_details", "expanded_summary",
+    "source_memory", "memory_added", "improved_responses", "evaluation_history",
+)
+
+# Keys moved to disk while a session is idle. Shared objects (e.g. the image search
+# engine) and unpicklable values (pending futures) always stay in memory.
+SPILL_KEYS = (
+    "chat_history", "debugger_agent", "concise_agent", "intent_agent", "cached_responses",
+    "last_evaluation", "retrieved_context", "feedback_messages",
+    "feedback_given", "query_alternatives",
+) + AUX_KEYS
+
+SPILLED_FLAG = "_session_spilled"
+
+
+class LRUDict(OrderedDict):
+    """Dict holding at most maxsize entries; reading an entry marks it as recently used."""
+
+    def __init__(self, maxsize=50, *args, **kwargs):
+        self.maxsize = maxsize
+        super().__init__(*args, **kwargs)
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
+    def __reduce__(self):
+        return self.__class__, (self.maxsize,), None, None, iter(list(self.items()))
+
+
+class SQLiteSessionStore:
+    """
+    Holds the spilled state of idle sessions, one compressed pickle per session.
+    Uses the same per-thread connection and WAL setup as SQLiteMemoryStore.
+    """
+
+    def __init__(self, db_path, timeout=30.0):
+        self.db_path = db_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+        parent = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(parent, exist_ok=True)
+
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS spilled_sessions (
+                session_id TEXT PRIMARY KEY,
+                data BLOB NOT NULL,
+                spilled_at REAL NOT NULL
+            )
+        """)
+        conn.commit()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=self.timeout)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def save(self, session_id, values):
+        """
+        Args:
+            values: dict of key -> pickled value
+
+        Returns:
+            int: Compressed size in bytes
+        """
+        data = zlib.compress(pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL))
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO spilled_sessions (session_id, data, spilled_at) VALUES (?, ?, ?)",
+                (session_id, data, time.time())
+            )
+        return len(data)
+
+    def pop(self, session_id):
+        """Load and delete a session's spilled values (still pickled); None if nothing was spilled."""
+        conn = self._connect()
+        with conn:
+            row = conn.execute("SELECT data FROM spilled_sessions WHERE session_id = ?", (session_id,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("DELETE FROM spilled_sessions WHERE session_id = ?", (session_id,))
+        return pickle.loads(zlib.decompress(row[0]))
+
+    def delete(self, session_id):
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM spilled_sessions WHERE session_id = ?", (session_id,))
+
+    def purge(self, older_than):
+        """Drop sessions spilled more than older_than seconds ago (their browser tab is long gone)."""
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute("DELETE FROM spilled_sessions WHERE spilled_at < ?", (time.time() - older_than,))
+        return cursor.rowcount
+
+
+class SessionStateManager:
+    """
+    Keeps per-session state bounded for long-lived and idle sessions.
+
+    trim() caps what a session accumulates: only the newest max_turns turns keep their
+    auxiliary data (sources, alternative versions, timings, images, evaluations...), and
+    the response cache and the concise agent's summary cache are LRUs of
+    max_cached_responses.
+
+    Sessions untouched for idle_seconds are spilled: their SPILL_KEYS are pickled into a
+    SQLiteSessionStore and removed from memory. activate(), called at the top of every
+    script run, restores a spilled session before anything reads its state. Spilling of
+    other sessions is checked from activate() too, at most every check_interval seconds.
+    """
+
+    def __init__(self, store, max_turns=20, max_cached_responses=50, idle_seconds=900,
+                 check_interval=60, retention_seconds=86400, session_alive=None):
+        """
+        Args:
+            store: SQLiteSessionStore for spilled sessions
+            max_turns: Newest turns that keep their auxiliary data
+            max_cached_responses: Capacity of each session's cached_responses LRU
+            idle_seconds: Inactivity after which a session is spilled
+            check_interval: Minimum seconds between scans for idle sessions
+            retention_seconds: Sessions idle for longer than this are forgotten
+            session_alive: Optional callable(session_id) -> bool; closed sessions are
+                forgotten at the next scan instead of after retention_seconds
+        """
+        self.store = store
+        self.max_turns = max_turns
+        self.max_cached_responses = max_cached_responses
+        self.idle_seconds = idle_seconds
+        self.check_interval = check_interval
+        self.retention_seconds = retention_seconds
+        self.session_alive = session_alive
+        self._sessions = {}  # session_id -> {"state", "last_active", "lock"}
+        self._lock = threading.Lock()
+        self._last_check = 0.0
+        self.stats = {"spilled": 0, "restored": 0, "spilled_bytes": 0, "trimmed_turns": 0}
+
+    def activate(self, session_id, state):
+        """
+        Mark a session active and restore its state if it was spilled.
+
+        Args:
+            session_id: Streamlit session id
+            state: The session's runtime state object, which stays usable from other threads
+                once the script run has ended
+
+        Returns:
+            bool: False if the session had been spilled and its state is lost (e.g. purged
+            after retention_seconds); the caller should reinitialize it
+        """
+        with self._lock:
+            entry = self._sessions.setdefault(session_id, {"lock": threading.Lock()})
+            entry["state"] = state
+            entry["last_active"] = time.time()
+
+        restored = True
+        with entry["lock"]:
+            if SPILLED_FLAG in state:
+                values = self.store.pop(session_id)
+                restored = values is not None
+                for key, blob in (values or {}).items():
+                    state[key] = pickle.loads(blob)
+                del state[SPILLED_FLAG]
+                self.stats["restored"] += 1
+
+        self.spill_idle()
+        return restored
+
+    def is_spilled(self, state):
+        return SPILLED_FLAG in state
+
+    @contextlib.contextmanager
+    def hold(self, session_id, state):
+        """
+        Keep a session from being spilled while the block runs, for code that reads its state
+        without activating it (e.g. a fragment rerun). Yields False if it is already spilled.
+        """
+        with self._lock:
+            entry = self._sessions.get(session_id)
+        if entry is None:
+            yield SPILLED_FLAG not in state
+            return
+        with entry["lock"]:
+            yield SPILLED_FLAG not in state
+
+    def trim(self, state):
+        """Apply the per-session limits; call once per script run after the turn is processed."""
+        if "cached_responses" in state and not isinstance(state["cached_responses"], LRUDict):
+            state["cached_responses"] = LRUDict(self.max_cached_responses, state["cached_responses"])
+        concise_agent = state["concise_agent"] if "concise_agent" in state else None
+        if concise_agent is not None and not isinstance(concise_agent.response_cache, LRUDict):
+            # Agents restored from before the summary cache was bounded
+            concise_agent.response_cache = LRUDict(self.max_cached_responses, concise_agent.response_cache)
+
+        if "chat_history" not in state:
+            return
+        # Assistant messages sit at odd indices; keep the newest max_turns of them
+        cutoff = len(state["chat_history"]) - 2 * self.max_turns
+        if cutoff <= 0:
+            return
+
+        for key in AUX_KEYS:
+            if key not in state:
+                continue
+            old = [idx for idx in state[key] if isinstance(idx, int) and idx < cutoff]
+            for idx in old:
+                del state[key][idx]
+            if key == "alternative_versions":
+                self.stats["trimmed_turns"] += len(old)
+
+        # Summaries still generating for old turns stay in memory (futures can't be spilled);
+        # finished ones were already collected by the app, so the rest are cancelled and dropped
+        pending = state["pending_concise"] if "pending_concise" in state else {}
+        for idx in [idx for idx in pending if isinstance(idx, int) and idx < cutoff]:
+            pending.pop(idx)[0].cancel()
+
+    def spill_idle(self, now=None):
+        """Spill every session idle for longer than idle_seconds."""
+        now = now or time.time()
+        with self._lock:
+            if now - self._last_check < self.check_interval:
+                return 0
+            self._last_check = now
+            idle = []
+            for session_id, entry in list(self._sessions.items()):
+                idle_for = now - entry["last_active"]
+                closed = self.session_alive is not None and not self.session_alive(session_id)
+                if closed or idle_for > self.retention_seconds:
+                    del self._sessions[session_id]
+                    self.store.delete(session_id)
+                elif idle_for > self.idle_seconds:
+                    idle.append(session_id)
+
+        spilled = sum(1 for session_id in idle if self.spill(session_id))
+        self.store.purge(self.retention_seconds)
+        return spilled
+
+    def spill(self, session_id):
+        """
+        Move a session's spillable state to the store.
+
+        Returns:
+            bool: True if anything was spilled
+        """
+        with self._lock:
+            entry = self._sessions.get(session_id)
+        if entry is None:
+            return False
+        state = entry["state"]
+
+        with entry["lock"]:
+            # The session may have become active again since it was found idle
+            if SPILLED_FLAG in state or time.time() - entry["last_active"] <= self.idle_seconds:
+                return False
+            values = {}
+            for key in SPILL_KEYS:
+                if key not in state:
+                    continue
+                try:
+                    values[key] = pickle.dumps(state[key], protocol=pickle.HIGHEST_PROTOCOL)
+                except Exception:
+                    continue  # e.g. still references a running future; stays in memory
+            if not values:
+                return False
+
+            self.stats["spilled_bytes"] += self.store.save(session_id, values)
+            for key in values:
+                del state[key]
+            state[SPILLED_FLAG] = True
+            self.stats["spilled"] += 1
+        return True
+
+    def session_counts(self):
+        """
+        Returns:
+            dict: tracked sessions and how many of them are currently spilled
+        """
+        with self._lock:
+            entries = list(self._sessions.values())
+        return {
+            "sessions": len(entries),
+            "spilled": sum(1 for entry in entries if SPILLED_FLAG in entry["state"])
+        }
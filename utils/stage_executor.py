@@ -0,0 +1,102 @@
+import time
+import concurrent.futures
+
+
+class StageGraph:
+    """
+    Runs the stages of a chat turn as a small dependency graph.
+
+    Each stage starts as soon as the stages it depends on have finished, and receives
+    their results as keyword arguments. Stages run on a thread pool unless marked
+    main_thread, in which case they run on the calling thread (required for anything
+    that writes to the Streamlit UI). Start and end times of every stage are recorded.
+    """
+
+    def __init__(self, max_workers=4, on_thread_start=None):
+        """
+        Args:
+            max_workers: Thread pool size for background stages
+            on_thread_start: Optional callable run in the worker thread before each
+                background stage (e.g. to attach the Streamlit script context)
+        """
+        self.max_workers = max_workers
+        self.on_thread_start = on_thread_start
+        self.stages = {}  # name -> (fn, deps, main_thread)
+        self.timings = {}  # name -> {"start", "end", "seconds", "thread"}
+
+    def add(self, name, fn, deps=(), main_thread=False):
+        """
+        Add a stage.
+
+        Args:
+            name: Stage name; its result is passed to dependents under this keyword
+            fn: Callable taking the results of deps as keyword arguments
+            deps: Names of stages that must finish first
+            main_thread: Run on the thread that calls run()
+        """
+        self.stages[name] = (fn, tuple(deps), main_thread)
+        return self
+
+    def _run_stage(self, name, kwargs, started, on_worker):
+        if on_worker and self.on_thread_start:
+            self.on_thread_start()
+        start = time.perf_counter()
+        try:
+            return self.stages[name][0](**kwargs)
+        finally:
+            end = time.perf_counter()
+            self.timings[name] = {
+                "start": start - started,
+                "end": end - started,
+                "seconds": end - start,
+                "thread": "pool" if on_worker else "main"
+            }
+
+    def run(self):
+        """
+        Execute every stage and return {stage name: result}.
+        The first exception raised by a stage is re-raised once running stages settle.
+        """
+        for name, (_, deps, _) in self.stages.items():
+            missing = [dep for dep in deps if dep not in self.stages]
+            if missing:
+                raise ValueError(f"Stage '{name}' depends on unknown stages: {missing}")
+
+        started = time.perf_counter()
+        results = {}
+        waiting = dict(self.stages)
+        running = {}  # future -> stage name
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="stage") as pool:
+            try:
+                while waiting or running:
+                    ready = [name for name, (_, deps, _) in waiting.items() if all(dep in results for dep in deps)]
+                    for name in ready:
+                        if not waiting[name][2]:
+                            kwargs = {dep: results[dep] for dep in waiting.pop(name)[1]}
+                            running[pool.submit(self._run_stage, name, kwargs, started, True)] = name
+
+                    main_ready = [name for name in ready if name in waiting]
+                    if main_ready:
+                        # Background stages keep running while this one occupies the calling thread
+                        name = main_ready[0]
+                        kwargs = {dep: results[dep] for dep in waiting.pop(name)[1]}
+                        results[name] = self._run_stage(name, kwargs, started, False)
+                        continue
+
+                    if not running:
+                        raise RuntimeError(f"Stages can never run (dependency cycle): {list(waiting)}")
+                    done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        results[running.pop(future)] = future.result()
+            except BaseException:
+                for future in running:
+                    future.cancel()
+                raise
+        return results
+
+    def wall_seconds(self):
+        """Wall time from the first stage start to the last stage end."""
+        if not self.timings:
+            return 0.0
+        return max(t["end"] for t in self.timings.values()) - min(t["start"] for t in self.timings.values())